@@ -1100,6 +1100,36 @@ typeSignature2Type = {
 }
 
 
+class ICCTagTable(AODict):
+    """
+    The tag table of an ICCProfile. It counts its own mutations in 'generation',
+    so the profile knows when the data it assembled from the tags is out of date.
+    
+    """
+    generation = 0
+    
+    def __setattr__(self, name, value):
+        if name == "generation":
+            object.__setattr__(self, name, value)
+        else:
+            AODict.__setattr__(self, name, value)
+
+def _counts_mutation(name):
+    method = getattr(AODict, name)
+    def mutator(self, *args, **kwargs):
+        out = method(self, *args, **kwargs)
+        self.generation += 1
+        return out
+    mutator.__name__ = name
+    mutator.__doc__ = method.__doc__
+    return mutator
+
+# everything that adds, replaces, removes or reorders tags
+for name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+             'clear', 'insert', 'pop', 'reverse', 'sort'):
+    setattr(ICCTagTable, name, _counts_mutation(name))
+
+
 class ICCProfileInvalidError(IOError):
 
     def __str__(self):
@@ -1117,13 +1147,19 @@ class ICCProfile(object):
     loading of the tags will be deferred to when they are accessed the
     first time.
     
+    The assembled profile data, its ID and its LittleCMS handle are cached, and
+    only recomputed after the tag table changes (see ICCTagTable) or touch() is
+    called -- so after the first time, they cost a dict lookup.
+    
     """
 
     def __init__(self, profile=None, load=False):
         self.ID = "\0" * 16
         self._data = None
         self._file = None
-        self._tags = AODict()
+        self._tags = ICCTagTable()
+        self._generation = 0
+        self._cache = {}
         self.fileName = None
         self.is_loaded = False
         self.size = 0
@@ -1205,19 +1241,52 @@ class ICCProfile(object):
     def __del__(self):
         self.close()
     
+    def __getstate__(self):
+        # neither the parsed tags nor the LittleCMS handle will pickle,
+        # but the profile data they came from will
+        return { 'data': self.data, 'ID': self.ID }
+    
+    def __setstate__(self, state):
+        ICCProfile.__init__(self, state.get('data', None))
+        self.ID = state.get('ID', self.ID)
+    
+    def touch(self):
+        """
+        Drop the cached data, ID and LittleCMS handle. Adding, replacing or removing
+        tags does this by itself; call it after changing a tag in place.
+        
+        """
+        self._generation += 1
+        self._cache = {}
+    
+    def _cached(self, name, key, compute):
+        hit = self._cache.get(name)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+        value = compute()
+        self._cache[name] = (key, value)
+        return value
+    
+    def _datakey(self):
+        return (self.tags.generation, self._generation, self.ID)
+    
     @property
     def data(self):
         """
         Get raw binary profile data.
         
         This will re-assemble the various profile parts (header, 
-        tag table and data) on-the-fly.
+        tag table and data) the first time, and whenever the tags change.
         
         """
-        # Assemble tag table and tag data
-        tagCount = len(self.tags)
+        self.tags # loads the tags, the first time
         if not self._data or len(self._data) < 128:
             return None
+        return self._cached('data', self._datakey(), self._assemble)
+    
+    def _assemble(self):
+        # Assemble tag table and tag data
+        tagCount = len(self.tags)
         tagTable = []
         tagTableSize = tagCount * 12
         tagsData = []
@@ -1320,8 +1389,9 @@ class ICCProfile(object):
         """
         Calculates, sets, and returns the profile's ID (checksum).
         
-        Calling this function always recalculates the checksum on-the-fly, 
-        in contrast to just accessing the ID property.
+        In contrast to just accessing the ID property, this returns the
+        checksum of the profile's current tags -- it's recalculated when
+        they've changed since the last time, and cached otherwise.
         
         The entire profile, based on the size field in the header, is used 
         to calculate the ID after the values in the Profile Flags field 
@@ -1330,12 +1400,15 @@ class ICCProfile(object):
         temporarily replaced with zeros.
         
         """
-        data = self.data[:44] + "\0\0\0\0" + self.data[48:64] + "\0\0\0\0" + \
-               self.data[68:84] + "\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0" + \
-               self.data[100:]
-        self.ID = md5(data).digest()
+        self.ID = self._cached('ID', (self.tags.generation, self._generation), self._checksum)
         return self.ID
     
+    def _checksum(self):
+        data = self.data
+        return md5(data[:44] + "\0\0\0\0" + data[48:64] + "\0\0\0\0" + \
+                   data[68:84] + "\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0" + \
+                   data[100:]).digest()
+    
     def close(self):
         """
         Closes the associated file object (if any).
@@ -1426,7 +1499,8 @@ class ICCProfile(object):
     def getLittleCMSInstance(self):
         from django.core.files.base import ContentFile
         from PIL import ImageCms
-        return ImageCms.ImageCmsProfile(ContentFile(self.data))
+        data = self.data
+        return self._cached('lcms', self._datakey(), lambda: ImageCms.ImageCmsProfile(ContentFile(data)))
     
     lcmsinstance = property(getLittleCMSInstance)
     
@@ -1480,6 +1554,7 @@ class ICCProfile(object):
             self._data += self._file.read(self.size - len(self._data))
             self._file.close()
             self.is_loaded = True
+            self.touch()
     
     def read(self, profile):
         """
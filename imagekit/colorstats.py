@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+colorstats.py
+
+Vectorized color statistics for PIL images, with NumPy.
+
+ColorStats makes one pass over an image's pixels: each RGB triple is packed into
+a uint32 (0xRRGGBB), the packed values are sorted, and the runs of equal values
+give every distinct color in the image along with its pixel count. The mean,
+median (most frequent) color, the top N colors and the most saturated of those
+all come from these arrays -- there's no per-pixel Python and no list of tuples.
+
+ImageModel.colorstats() computes one of these per decoded image, and the color
+extractors on ImageModel (_median(), _topcolors(), _topsat() et al.) use it when
+NumPy is available. Set IK_COLORSTATS_PROXY = True to compute the statistics from
+ImageModel.analysis_image() -- a downsampled copy -- instead of every pixel.
+
+Created by FI$H 2000 on 2011-09-01.
+Copyright (c) 2011 Objects In Space And Time, LLC. All rights reserved.
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def unpack(packed):
+    """ Split packed 0xRRGGBB values back into (r, g, b) tuples. """
+    return [(int(value) >> 16 & 0xFF, int(value) >> 8 & 0xFF, int(value) & 0xFF) for value in packed]
+
+
+class ColorStats(object):
+    """
+    Color statistics for one PIL image -- see the module notes above.
+    
+    """
+    def __init__(self, im):
+        if numpy is None:
+            raise TypeError("ColorStats requires NumPy.")
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        
+        pixels = numpy.fromstring(im.tostring(), dtype=numpy.uint8).reshape((-1, 3))
+        self.size = len(pixels)
+        self.mean = [float(channel) for channel in pixels.mean(axis=0)]
+        
+        packed = (pixels[:, 0].astype(numpy.uint32) << 16) | \
+                 (pixels[:, 1].astype(numpy.uint32) << 8) | \
+                  pixels[:, 2].astype(numpy.uint32)
+        packed.sort()
+        
+        # the start of each run of equal values is a distinct color
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(packed)) + 1))
+        self.colors = packed[starts]
+        self.counts = numpy.diff(numpy.concatenate((starts, [self.size])))
+    
+    def __len__(self):
+        return len(self.colors)
+    
+    def top(self, n=3):
+        """ The n most frequent colors, most frequent first, as (count, (r, g, b)) pairs like getcolors(). """
+        n = min(n, len(self.colors))
+        if n < 1:
+            return []
+        if n < len(self.counts) and hasattr(numpy, 'argpartition'):
+            idx = numpy.argpartition(-self.counts, n - 1)[:n]
+        else:
+            idx = numpy.arange(len(self.counts))
+        idx = idx[numpy.argsort(-self.counts[idx], kind='mergesort')][:n]
+        return zip([int(count) for count in self.counts[idx]], unpack(self.colors[idx]))
+    
+    @property
+    def median(self):
+        """ The most frequent color, as a (count, (r, g, b)) pair. """
+        top = self.top(1)
+        return top and top[0] or None
+    
+    def most_saturated(self, n=10):
+        """ Of the n most frequent colors, the one with the highest HLS saturation, as (r, g, b). """
+        top = self.top(n)
+        if not top:
+            return None
+        rgb = numpy.array([color for count, color in top], dtype=numpy.float64) / 255.0
+        maxc = rgb.max(axis=1)
+        minc = rgb.min(axis=1)
+        spread = maxc - minc
+        total = maxc + minc
+        
+        # the same saturation as colorsys.rgb_to_hls()
+        saturation = numpy.zeros(len(rgb))
+        chromatic = spread > 0
+        light = chromatic & (total / 2.0 > 0.5)
+        dark = chromatic & ~light
+        saturation[dark] = spread[dark] / total[dark]
+        saturation[light] = spread[light] / (2.0 - total[light])
+        
+        return top[int(numpy.argmax(saturation))][1]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+iccbenchmark.py
+
+Time single-shot ImageCmsTransform.apply() against the tiled, threaded
+conversion in imagekit.processors.icc_apply(), on a synthetic image:
+
+    python iccbenchmark.py [megapixels] [destination.icc] [strip height] [workers ...]
+
+Without a destination profile, the image is converted from sRGB to sRGB.
+
+Created by FI$H 2000 on 2011-09-02.
+Copyright (c) 2011 Objects In Space And Time, LLC. All rights reserved.
+
+"""
+import sys, time
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from imagekit.lib import Image, ImageCms, IK_sRGB
+from imagekit.ICCProfile import ICCProfile
+from imagekit.processors import icc_apply
+
+
+def noise(megapixels):
+    """ An RGB image of about the given size, with smooth-ish gradients in it. """
+    width = int((megapixels * 10 ** 6 * 1.5) ** 0.5)
+    height = int(megapixels * 10 ** 6 / width)
+    gradient = Image.new('L', (256, 256))
+    gradient.putdata([y for y in xrange(256) for x in xrange(256)])
+    return Image.merge('RGB', (
+        gradient.resize((width, height)),
+        gradient.rotate(90).resize((width, height)),
+        gradient.rotate(45).resize((width, height)),
+    ))
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    out = function(*args, **kwargs)
+    return out, time.time() - start
+
+def benchmark(megapixels=25, destination=None, strip_height=256, workers=(1, 2, 4, 8)):
+    destination = destination and ICCProfile(destination) or IK_sRGB
+    transformer = ImageCms.ImageCmsTransform(
+        IK_sRGB.lcmsinstance, destination.lcmsinstance,
+        'RGB', 'RGB', ImageCms.INTENT_RELATIVE_COLORIMETRIC)
+    
+    img = noise(megapixels)
+    img.load()
+    print "Converting %sx%s RGB (%.1f MP) to %s" % (
+        img.size[0], img.size[1], img.size[0] * img.size[1] / 10.0 ** 6, destination.getDescription())
+    
+    whole, single = timed(transformer.apply, img)
+    print "%-28s %8.3fs" % ("apply(), single-shot", single)
+    
+    for count in workers:
+        tiled, elapsed = timed(icc_apply, transformer, img, mode='RGB',
+            strip_height=strip_height, workers=count, min_pixels=0)
+        print "%-28s %8.3fs   %5.2fx   %s" % (
+            "icc_apply(), %s thread%s" % (count, count != 1 and 's' or ''),
+            elapsed, single / max(elapsed, 1e-9),
+            tiled.tostring() == whole.tostring() and 'identical' or 'DIFFERENT')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    benchmark(
+        megapixels=len(args) > 0 and float(args[0]) or 25,
+        destination=len(args) > 1 and args[1] or None,
+        strip_height=len(args) > 2 and int(args[2]) or 256,
+        workers=len(args) > 3 and [int(count) for count in args[3:]] or (1, 2, 4, 8),
+    )
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+histindex.py
+
+Nearest-neighbour search over the stored histograms of ImageWithMetadata subclasses.
+
+Each indexed image is a row in one float32 NumPy matrix: its luma and RGB histograms,
+rebinned to IK_HISTOGRAM_INDEX_BINS bins per channel (32 by default) and normalized
+so that every channel sums to 1. Queries are answered by scanning the matrix in
+vectorized blocks -- with the default 32 bins a row is 512 bytes, so a million
+images make a 512MB matrix, scanned in well under a second.
+
+If IK_HISTOGRAM_INDEX_DIR is set, the matrix and its pk column are saved there as
+.npy files, and memory-mapped read-only (rather than read in) when the index is next
+loaded. The index is kept up to date as histograms are saved (see
+Histogram.save_related_histogram) but only in processes that have already loaded it,
+each in its own overlay; they pick up the generations other processes save
+(HistogramIndex.save()) within IK_HISTOGRAM_INDEX_CHECK seconds.
+
+Created by FI$H 2000 on 2011-09-01.
+Copyright (c) 2011 Objects In Space And Time, LLC. All rights reserved.
+
+"""
+import os, time, threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.contenttypes.models import ContentType
+from imagekit.utils import logg, chunked
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+The channels that make up an index row, in order: (colorspace, channel) pairs,
+where colorspace is a key into imagekit.models.HISTOGRAMS.
+
+"""
+INDEX_CHANNELS = (
+    ('luma', 'L'),
+    ('rgb', 'R'), ('rgb', 'G'), ('rgb', 'B'),
+)
+
+METRICS = ('chisquare', 'intersection', 'emd')
+
+def rebin(channel_data, bins):
+    """ Rebin a 256-bin histogram channel to 'bins' bins, normalized to sum to 1. """
+    data = numpy.asarray(channel_data, dtype=numpy.float64)
+    if len(data) != 256:
+        return numpy.zeros(bins, dtype=numpy.float32)
+    data = data.reshape(bins, 256 // bins).sum(axis=1)
+    total = data.sum()
+    if total > 0:
+        data = data / total
+    return data.astype(numpy.float32)
+
+def distances(rows, vector, metric, channels, bins):
+    """
+    Distances from one vector to each of a block of rows. All three metrics are 0
+    for identical histograms, and each is summed over the channels.
+    
+    """
+    if metric == 'chisquare':
+        total = rows + vector
+        total[total == 0] = 1.0
+        return 0.5 * (((rows - vector) ** 2) / total).sum(axis=1)
+    
+    elif metric == 'intersection':
+        return channels - numpy.minimum(rows, vector).sum(axis=1)
+    
+    elif metric == 'emd':
+        # for 1-dimensional histograms, the Earth Mover's distance is
+        # the L1 distance between their cumulative distributions
+        shape = (rows.shape[0], channels, bins)
+        cdfs = rows.reshape(shape).cumsum(axis=2)
+        return numpy.abs(cdfs - vector.reshape((1, channels, bins)).cumsum(axis=2)).sum(axis=2).sum(axis=1)
+    
+    raise ValueError("Unknown histogram metric '%s' (must be one of: %s)" % (metric, ', '.join(METRICS)))
+
+
+class HistogramIndex(object):
+    """
+    Histogram index for one ImageWithMetadata subclass -- see the module notes above.
+    
+    The bulk of the rows live in a snapshot -- built from the database, or a saved
+    index memory-mapped read-only -- which is never written to. update() and remove()
+    mask out snapshot rows and keep new rows in a small per-process overlay, which
+    is folded into a fresh (in-memory) snapshot once it grows past block_size rows.
+    
+    """
+    
+    block_size = 2 ** 16
+    
+    def __init__(self, modl, bins=None, path=None):
+        if numpy is None:
+            raise ImproperlyConfigured("HistogramIndex requires NumPy.")
+        self.modl = modl
+        self.bins = int(bins or getattr(settings, 'IK_HISTOGRAM_INDEX_BINS', 32))
+        if 256 % self.bins:
+            raise ValueError("HistogramIndex bins must divide 256 evenly (got %s)" % self.bins)
+        self.channels = len(INDEX_CHANNELS)
+        self.path = path
+        self.generation = None
+        self.checked = 0
+        self._lock = threading.RLock()
+        self._snapshot(numpy.zeros(0, dtype=numpy.int64),
+            numpy.zeros((0, self.dimensions), dtype=numpy.float32))
+    
+    def _snapshot(self, pks, rows, overlay=None):
+        """ Swap in a new snapshot, masking any of its rows the overlay supersedes. """
+        self.pks, self.rows = pks, rows
+        self.size = len(pks)
+        self.positions = dict([(int(pk), idx) for idx, pk in enumerate(pks)])
+        self.masked = numpy.zeros(self.size, dtype=bool)
+        self.overlay = {}
+        for pk, vector in (overlay or {}).items():
+            self._put(pk, vector)
+    
+    def _put(self, pk, vector):
+        position = self.positions.pop(pk, None)
+        if position is not None:
+            self.masked[position] = True
+        # None marks a removal, so that it outlives reloading the snapshot
+        self.overlay[pk] = vector
+    
+    @property
+    def dimensions(self):
+        return self.channels * self.bins
+    
+    def __len__(self):
+        return len(self.positions) + len([v for v in self.overlay.values() if v is not None])
+    
+    def __contains__(self, pk):
+        pk = int(pk)
+        return pk in self.positions or self.overlay.get(pk) is not None
+    
+    def vector(self, instance):
+        """ Build an index row from an instance's stored histograms. """
+        out = []
+        for colorspace, channel in INDEX_CHANNELS:
+            histogram = getattr(instance, "histogram_%s" % colorspace, None)
+            out.append(rebin(getattr(histogram, channel, []), self.bins))
+        return numpy.concatenate(out)
+    
+    def _merged(self):
+        """ The live snapshot rows plus the overlay, as in-memory (pks, rows) arrays. """
+        live = numpy.array(sorted(self.positions.values()), dtype=numpy.int64)
+        added = sorted([pk for pk, vector in self.overlay.items() if vector is not None])
+        pks = numpy.zeros(len(live) + len(added), dtype=numpy.int64)
+        rows = numpy.zeros((len(pks), self.dimensions), dtype=numpy.float32)
+        if len(live):
+            pks[:len(live)] = self.pks[live]
+            rows[:len(live)] = self.rows[live]
+        for idx, pk in enumerate(added):
+            pks[len(live) + idx] = pk
+            rows[len(live) + idx] = self.overlay[pk]
+        return pks, rows
+    
+    def compact(self):
+        """ Fold the overlay into a new in-memory snapshot. """
+        with self._lock:
+            pks, rows = self._merged()
+            self._snapshot(pks, rows)
+    
+    def build(self, chunk_size=1000):
+        """
+        (Re)build the index from the database. Histogram rows are read straight from
+        the histogram tables, a chunk at a time, without loading the images themselves;
+        images with no stored histograms are left out.
+        
+        """
+        from imagekit.models import HISTOGRAMS
+        
+        pks = numpy.array(list(self.modl.objects.order_by('pk').values_list('pk', flat=True)), dtype=numpy.int64)
+        positions = dict([(int(pk), idx) for idx, pk in enumerate(pks)])
+        rows = numpy.zeros((len(pks), self.dimensions), dtype=numpy.float32)
+        filled = numpy.zeros(len(pks), dtype=bool)
+        
+        content_type = ContentType.objects.get_for_model(self.modl)
+        for colorspace in sorted(set([colorspace for colorspace, channel in INDEX_CHANNELS])):
+            offsets = [(idx, channel) for idx, (cs, channel) in enumerate(INDEX_CHANNELS) if cs == colorspace]
+            histograms = HISTOGRAMS[colorspace].objects.filter(content_type=content_type)
+            
+            for histogram in chunked(histograms, chunk_size):
+                position = positions.get(histogram.object_id)
+                if position is None:
+                    continue
+                for idx, channel in offsets:
+                    rows[position, idx*self.bins:(idx+1)*self.bins] = rebin(
+                        getattr(histogram, channel), self.bins)
+                filled[position] = rows[position].any()
+        
+        keep = numpy.flatnonzero(filled)
+        with self._lock:
+            self._snapshot(pks[keep], rows[keep])
+        
+        logg.info("Built histogram index for %s: %s images (%s without histograms)" % (
+            self.modl.__name__, len(keep), len(pks) - len(keep)))
+    
+    def update(self, instance):
+        """ Add or replace the row for one instance (or drop it, if it has no histograms). """
+        vector = self.vector(instance)
+        with self._lock:
+            if vector.any():
+                self._put(int(instance.pk), vector)
+            else:
+                self._put(int(instance.pk), None)
+            if len(self.overlay) > self.block_size:
+                self.compact()
+    
+    def remove(self, pk):
+        with self._lock:
+            self._put(int(pk), None)
+    
+    def search(self, vector, k=20, metric='chisquare', exclude=()):
+        """
+        Return up to k (pk, distance) pairs for the rows closest to a vector,
+        closest first. The snapshot is scanned block_size rows at a time.
+        
+        """
+        exclude = set([int(pk) for pk in exclude])
+        candidates = []
+        
+        with self._lock:
+            blocks = [(self.pks[start:start + self.block_size],
+                       self.rows[start:start + self.block_size],
+                       self.masked[start:start + self.block_size])
+                for start in xrange(0, self.size, self.block_size)]
+            added = [(pk, row) for pk, row in self.overlay.items() if row is not None]
+            if added:
+                blocks.append((numpy.array([pk for pk, row in added], dtype=numpy.int64),
+                               numpy.array([row for pk, row in added], dtype=numpy.float32),
+                               numpy.zeros(len(added), dtype=bool)))
+            
+            for pks, rows, masked in blocks:
+                dist = distances(rows, vector, metric, self.channels, self.bins)
+                dist[masked | numpy.isnan(dist)] = numpy.inf
+                
+                keep = min(k + len(exclude), len(dist))
+                if keep < len(dist) and hasattr(numpy, 'argpartition'):
+                    best = numpy.argpartition(dist, keep)[:keep]
+                else:
+                    best = numpy.argsort(dist)[:keep]
+                candidates.extend([(float(dist[idx]), int(pks[idx])) for idx in best
+                    if numpy.isfinite(dist[idx])])
+        
+        candidates.sort()
+        return [(pk, distance) for distance, pk in candidates if pk not in exclude][:k]
+    
+    def similar(self, instance, k=20, metric='chisquare'):
+        """ The k images whose histograms are closest to an instance's, as (pk, distance) pairs. """
+        return self.search(self.vector(instance), k=k, metric=metric, exclude=(instance.pk,))
+    
+    def _files(self, generation=None):
+        name = "%s.%s-%s" % (self.modl._meta.app_label, self.modl.__name__.lower(), self.bins)
+        if generation is None:
+            return os.path.join(self.path, "%s.generation" % name)
+        return (os.path.join(self.path, "%s.%s.pks.npy" % (name, generation)),
+                os.path.join(self.path, "%s.%s.rows.npy" % (name, generation)))
+    
+    def saved_generation(self):
+        """ The generation of the index last saved to IK_HISTOGRAM_INDEX_DIR, or None. """
+        if not self.path:
+            return None
+        try:
+            with open(self._files(), 'rb') as fp:
+                return fp.read().strip() or None
+        except (OSError, IOError):
+            return None
+    
+    def save(self):
+        """
+        Write the index, overlay included, out to its directory as a new generation:
+        the .npy files are written first under the new generation's name, then the
+        generation file is swapped in by renaming it, so a process loading the index
+        never sees a half-written one. Earlier generations are removed -- processes
+        that still have them mapped keep reading them until they reload.
+        
+        """
+        if not self.path:
+            return
+        previous = self.saved_generation()
+        generation = "%x.%s" % (int(time.time() * 10 ** 6), os.getpid())
+        
+        with self._lock:
+            pks, rows = self._merged()
+            for path, data in zip(self._files(generation), (pks, rows)):
+                with open("%s.tmp" % path, 'wb') as fp:
+                    numpy.save(fp, data)
+                os.rename("%s.tmp" % path, path)
+            
+            pointer = self._files()
+            with open("%s.%s.tmp" % (pointer, os.getpid()), 'wb') as fp:
+                fp.write(generation)
+            os.rename("%s.%s.tmp" % (pointer, os.getpid()), pointer)
+            
+            self._snapshot(pks, rows)
+            self.generation = generation
+        
+        if previous and previous != generation:
+            for path in self._files(previous):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+    
+    def load(self):
+        """
+        Memory-map the saved index, read-only, keeping this process' overlay on top of it.
+        Returns False if there's nothing saved to load.
+        
+        """
+        generation = self.saved_generation()
+        if generation is None:
+            return False
+        pks_file, rows_file = self._files(generation)
+        try:
+            pks = numpy.load(pks_file)
+            rows = numpy.load(rows_file, mmap_mode='r')
+        except (OSError, IOError), err:
+            # superseded (and removed) since we read the generation file
+            logg.info("--- couldn't load histogram index generation %s: %s" % (generation, err))
+            return False
+        with self._lock:
+            self._snapshot(pks, rows, overlay=self.overlay)
+            self.generation = generation
+        return True
+    
+    def refresh(self, interval=None):
+        """
+        Reload the index if another process has saved a newer generation of it --
+        checking at most once every IK_HISTOGRAM_INDEX_CHECK seconds (60 by default).
+        
+        """
+        if interval is None:
+            interval = getattr(settings, 'IK_HISTOGRAM_INDEX_CHECK', 60)
+        now = time.time()
+        if not self.path or now - self.checked < interval:
+            return False
+        self.checked = now
+        generation = self.saved_generation()
+        if generation is None or generation == self.generation:
+            return False
+        return self.load()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(modl, build=True):
+    """
+    Return the HistogramIndex for a model, loading it from IK_HISTOGRAM_INDEX_DIR
+    or building (and saving) it the first time it's asked for in this process,
+    and reloading it when another process has saved a newer one.
+    With build=False, returns None unless the index is already loaded.
+    
+    """
+    with _indexes_lock:
+        index = _indexes.get(modl)
+        if index is None and build:
+            index = HistogramIndex(modl, path=getattr(settings, 'IK_HISTOGRAM_INDEX_DIR', None))
+            if not index.load():
+                index.build()
+                index.save()
+            _indexes[modl] = index
+        elif index is not None:
+            index.refresh()
+        return index
+
+def update_index(instance):
+    """ Update an instance's row in its model's index, if this process has one loaded. """
+    if numpy is None:
+        return
+    index = get_index(instance.__class__, build=False)
+    if index is not None and instance.pk is not None:
+        index.update(instance)
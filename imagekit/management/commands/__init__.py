@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # encoding: utf-8
+from imagekit.utils import chunked
 
 def echo_banner():
     print ""
@@ -7,4 +8,3 @@ def echo_banner():
     print u"+++ color management components by Alexander Böhn -- http://objectsinspaceandtime.com/"
     print u"+++ profileinfo() and ICCProfile base class from DispcalGUI by Florian Höch -- http://dispcalgui.hoech.net/"
     print ""
-
@@ -11,7 +11,7 @@ from imagekit.models import ImageWithMetadata, ICCModel
 from imagekit.modelfields import *
 from imagekit.utils import icchash
 
-from . import echo_banner
+from . import echo_banner, chunked
 
 class Command(BaseCommand):
     
@@ -19,6 +19,10 @@ class Command(BaseCommand):
         make_option('--ids', '-i', dest='ids',
             help="Optional range of IDs like low:high",
         ),
+        make_option('--chunk-size', dest='chunk_size',
+            default=500, type="int",
+            help="Number of objects read from the database at a time (default 500)",
+        ),
     )
     
     help = ('Updates all ImageKit cached profiles stored as ICCModels.')
@@ -92,12 +96,42 @@ def update_icc_cache(apps, options):
                     verb = int(options.get('verbosity', 1)) > 1
                     i = 0
                     ii = 0
+                    examined = 0
+                    
+                    # the stored icchash tells us whether an object has a profile, and which --
+                    # the icc and exif columns stay deferred, and icc is only loaded on access
+                    objs = objs.only('pk', 'icchash', modl._ik.image_field)
+                    known = set([hsh.lower() for hsh in ICCModel.objects.values_list('icchash', flat=True) if hsh])
                     
-                    for obj in objs:
+                    for obj in chunked(objs, int(options.get('chunk_size') or 500)):
+                        
+                        examined += 1
+                        hsh = obj.icchash and obj.icchash.lower() or None
+                        if not hsh and obj.icc:
+                            # embedded data without a stored hash (rows that predate the hashes)
+                            hsh = icchash(obj.icc)
                         
-                        if obj.icc:
+                        if hsh:
                             
                             i += 1
+                            if hsh in known:
+                                if verb:
+                                    print "--- %0d --- %s : %s" % (
+                                        i,
+                                        "                       (exists)",
+                                        hsh,
+                                    )
+                                continue
+                            
+                            if not obj.icc:
+                                # a stale hash, left over from a profile that's since been removed
+                                print "--- %0d --- %s : %s (no ICC data, skipping)" % (
+                                    i,
+                                    ((" " * 50) + obj._imgfield.name)[30:],
+                                    hsh,
+                                )
+                                continue
+                            
                             if verb:
                                 print ""
                                 print ">>> %0d >>> %30s : %s %s" % (
@@ -107,7 +141,7 @@ def update_icc_cache(apps, options):
                                     '',
                                 )
                             try:
-                                ICCModel.objects.get(icchash__iexact=icchash(obj.icc))
+                                ICCModel.objects.get(icchash__iexact=hsh)
                             
                             except ObjectDoesNotExist:
                                 new_icc = ICCModel()
@@ -117,6 +151,7 @@ def update_icc_cache(apps, options):
                                     File(new_icc_file),
                                 )
                                 new_icc.save() # may be technically unnecessary
+                                known.add(new_icc.icchash.lower())
                                 ii += 1
                                 
                                 if verb:
@@ -127,6 +162,7 @@ def update_icc_cache(apps, options):
                                     )
                             
                             else:
+                                known.add(hsh)
                                 if verb:
                                     print "--- %0d --- %s : %s %s" % (
                                         i,
@@ -139,7 +175,7 @@ def update_icc_cache(apps, options):
                         print ""
                         print "================================================================================="
                         
-                        print "::: Examined %s objects." % len(objs)
+                        print "::: Examined %s objects." % examined
                     print "::: Found %s possible profiles," % i
                     print "::: Committed %s unique instances of which to the database." % ii
                     
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import os, sys, time
+from multiprocessing import Pool
+from django.conf import settings as django_settings
+from django.db import connections
 from django.db.models import Q
 from django.db.models.loading import cache
 from django.core.management.base import BaseCommand
 from django.core.exceptions import ImproperlyConfigured
 from optparse import make_option
 
-from . import echo_banner
+from imagekit.utils import json, logg
+from . import echo_banner, chunked
 
 class Command(BaseCommand):
     
@@ -37,6 +42,40 @@ class Command(BaseCommand):
             (e.g. Histograms, ICCMetaFields, et al)
             """,
         ),
+        make_option('--workers', '-w', dest='workers',
+            default=0, type="int",
+            help="""
+            Render cached images in a pool of this many worker processes, each with
+            its own database connection, instead of re-saving each object in turn.
+            Outputs that already exist are kept, and skipped -- unless --rerender is given.
+            """,
+        ),
+        make_option('--rerender', action="store_true", dest='rerender',
+            default=False,
+            help="""
+            With --workers, delete the cached images before rendering them again.
+            Content-addressed images are kept when another object has the same source hash.
+            """,
+        ),
+        make_option('--chunk-size', dest='chunk_size',
+            default=500, type="int",
+            help="""
+            Number of objects read from the database -- or, with --workers,
+            handed to a worker -- at a time (default 500).
+            """,
+        ),
+        make_option('--all-specs', action="store_true", dest='all_specs',
+            default=False,
+            help="""
+            With --workers, render every spec -- not just the pre_cache specs.
+            """,
+        ),
+        make_option('--resume', dest='resume',
+            help="""
+            With --workers, record the last completed ID for each model in this file,
+            and on the next run, pick up after it.
+            """,
+        ),
     )
     
     help = ('Clears all ImageKit cached image files.')
@@ -56,7 +95,7 @@ class Command(BaseCommand):
         from imagekit import signals as iksignals
         
         runmode_name = options.get('runmode').upper()
-        queue_name = options.get('queuename', "default")
+        queue_name = options.get('queue_name') or "default"
         queues = backends.ConnectionHandler(django_settings.SQ_QUEUES, runmodes.get(runmode_name))
         signalqueue = queues[queue_name]
         
@@ -97,6 +136,9 @@ def flush_image_cache(apps, signalqueue, options):
                         modls.append(putativemodel)
                 
                 clear_cache = options.get('clear_cache', True)
+                if int(options.get('workers') or 0) > 0:
+                    # with workers, existing outputs are skipped rather than re-rendered
+                    clear_cache = options.get('rerender', False)
                 print '>>> Cached ImageKit images will be %s.' % (clear_cache and "deleted" or "preserved")
                 
                 # set the runmode, if provided
@@ -137,9 +179,17 @@ def flush_image_cache(apps, signalqueue, options):
                                     Q(id__gte=int(bottom)) & Q(id__lte=int(top))
                                 )
                     
+                    if int(options.get('workers') or 0) > 0:
+                        print '>>> Rendering image file cache for "%s.%s" with %s workers' % (
+                            app_parts[0], modl.__name__, options.get('workers'))
+                        render_parallel(modl, objs, options)
+                        continue
+                    
                     print '>>> Flushing image file cache for %s objects in "%s.%s"' % (objs.count(), app_parts[0], modl.__name__)
                     
-                    for obj in objs:
+                    # no only()/defer() here: save() and the ImageKit signals are keyed
+                    # on the model class, and deferred instances are of a subclass
+                    for obj in chunked(objs, int(options.get('chunk_size') or 500)):
                         
                         if int(options.get('verbosity', 1)) > 1:
                             try:
@@ -166,3 +216,133 @@ def flush_image_cache(apps, signalqueue, options):
     else:
         print '+++ Please specify one or more app names'
 
+
+def pk_ranges(objs, chunk_size):
+    """
+    Split a queryset into pk-ordered chunks, yielding (first_pk, last_pk, count)
+    for each -- only the pks are read from the database.
+    
+    """
+    low = high = None
+    count = 0
+    for pk in objs.order_by('pk').values_list('pk', flat=True).iterator():
+        if low is None:
+            low = pk
+        high = pk
+        count += 1
+        if count == chunk_size:
+            yield (low, high, count)
+            low = None
+            count = 0
+    if count:
+        yield (low, high, count)
+
+def init_worker():
+    """ Runs in each of render_parallel()'s worker processes as it starts. """
+    from imagekit.processors import ICCProofTransform
+    ICCProofTransform.warmup()
+
+def render_chunk(job):
+    """
+    Worker function for render_parallel(): renders the cached images of every
+    object in one pk range. Returns (first_pk, last_pk, objects, images rendered).
+    
+    """
+    app_label, model_name, low, high, clear_cache, all_specs = job
+    modl = cache.get_model(app_label, model_name)
+    
+    if all_specs:
+        spec_names = None
+    else:
+        spec_names = [spec_name for spec_name, spec in modl._ik.specs.items()
+            if spec.pre_cache and spec_name not in ('imagespec', 'spec', None)]
+    
+    count = rendered = 0
+    for obj in modl.objects.filter(pk__gte=low, pk__lte=high).order_by('pk').iterator():
+        count += 1
+        if not obj._imgfield.name:
+            continue
+        try:
+            if clear_cache:
+                obj.clear_cache()
+            rendered += len(obj._ik.render_specs(obj, spec_names))
+        except Exception, err:
+            logg.error("ikflush: couldn't render cached images for %s %s: %s" % (
+                model_name, obj.pk, err))
+    
+    return (low, high, count, rendered)
+
+def load_resume_state(path):
+    if path and os.path.exists(path):
+        with open(path, 'rb') as fp:
+            return json.loads(fp.read())
+    return {}
+
+def save_resume_state(path, state):
+    # write-then-rename, so a crash mid-write leaves the old state intact
+    with open("%s.tmp" % path, 'wb') as fp:
+        fp.write(json.dumps(state))
+    os.rename("%s.tmp" % path, path)
+
+def render_parallel(modl, objs, options):
+    """
+    Renders the cached images for a queryset in a pool of worker processes.
+    
+    The queryset is split into pk-ranged chunks up front; the parent's database
+    connections are then closed, so that each forked worker opens its own.
+    Chunks can complete out of order -- the resume file only ever records the
+    highest pk below which every chunk has completed.
+    
+    Outputs that already exist are skipped, unless options['rerender'] is set,
+    in which case each object's cache is cleared before it's rendered.
+    
+    """
+    model_key = "%s.%s" % (modl._meta.app_label, modl.__name__)
+    resume = options.get('resume')
+    state = load_resume_state(resume)
+    
+    if state.get(model_key) is not None:
+        print '>>> Resuming after ID %s' % state[model_key]
+        objs = objs.filter(pk__gt=state[model_key])
+    
+    ranges = list(pk_ranges(objs, int(options.get('chunk_size') or 500)))
+    total = sum([count for low, high, count in ranges])
+    jobs = [(modl._meta.app_label, modl.__name__, low, high,
+        options.get('rerender', False), options.get('all_specs', False))
+        for low, high, count in ranges]
+    
+    for conn in connections.all():
+        conn.close()
+    
+    pool = Pool(processes=int(options.get('workers')), initializer=init_worker)
+    started = time.time()
+    done = rendered = 0
+    completed = set()
+    watermark = 0
+    
+    try:
+        for low, high, count, chunk_rendered in pool.imap_unordered(render_chunk, jobs):
+            done += count
+            rendered += chunk_rendered
+            completed.add(low)
+            
+            while watermark < len(jobs) and jobs[watermark][2] in completed:
+                watermark += 1
+            if resume and watermark:
+                state[model_key] = jobs[watermark-1][3]
+                save_resume_state(resume, state)
+            
+            elapsed = max(time.time() - started, 0.001)
+            rate = done / elapsed
+            sys.stdout.write("\r>>> %s/%s objects, %s images rendered -- %.1f images/sec, ETA %ds      " % (
+                done, total, rendered, rendered / elapsed, (total - done) / max(rate, 0.001)))
+            sys.stdout.flush()
+    
+    finally:
+        pool.close()
+        pool.join()
+    
+    print ''
+    elapsed = max(time.time() - started, 0.001)
+    print '>>> Rendered %s images for %s objects in %.1f sec (%.1f images/sec)' % (
+        rendered, done, elapsed, rendered / elapsed)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, re, itertools
+from datetime import datetime, timedelta
+from django.db.models.loading import cache
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from imagekit.models import ImageModel
+from imagekit.specs import ImageSpec, get_spec_cache
+from imagekit.utils import logg
+
+from . import echo_banner, chunked
+
+# content-addressed outputs are named <cache_dir>/<key[:2]>/<key[2:4]>/<key>.<extension>
+KEYED_FILENAME = re.compile(r'^([0-9a-f]{40})\.\w+$')
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size',
+            default=500, type="int",
+            help="Number of objects read from the database at a time (default 500)",
+        ),
+        make_option('--min-age', dest='min_age',
+            default=3600, type="int",
+            help="Leave files younger than this many seconds alone (default 3600)",
+        ),
+        make_option('--dry-run', '-n', dest='dry_run', action="store_true",
+            default=False,
+            help="List the orphaned files without deleting them.",
+        ),
+    )
+    
+    help = ('Deletes content-addressed cached images that no image and spec maps to any longer, '
+        'and those rendered before their source hash was computed.')
+    args = '[apps]'
+    requires_model_validation = True
+    can_import_settings = True
+    
+    def handle(self, *args, **options):
+        echo_banner()
+        return collect_garbage(args, options)
+
+def live_names(modl, chunk_size=500):
+    """
+    The storage names of every content-addressed output an instance of modl maps to,
+    and those of the outputs rendered under the filename before the instance's source
+    hash was computed -- which nothing maps to any longer.
+    
+    """
+    spec_names = [spec_name for spec_name, spec in modl._ik.specs.items()
+        if issubclass(spec, ImageSpec) and spec_name not in ('imagespec', 'spec', None)]
+    names = set()
+    leftovers = set()
+    for obj in chunked(modl.objects.all(), chunk_size):
+        if not obj._imgfield.name:
+            continue
+        for spec_name in spec_names:
+            accessor = modl._ik._props.get(spec_name).accessor(obj, modl._ik.specs[spec_name])
+            if accessor.key:
+                names.add(accessor.name)
+                leftovers.add(accessor.unkeyed_name)
+    return names, leftovers
+
+def stored_names(storage, cache_dir):
+    """ The storage names of the content-addressed files under cache_dir. """
+    def listdir(path):
+        try:
+            return storage.listdir(path)
+        except (OSError, IOError, NotImplementedError):
+            return [], []
+    
+    for first in listdir(cache_dir)[0]:
+        if len(first) != 2:
+            continue
+        for second in listdir(os.path.join(cache_dir, first))[0]:
+            if len(second) != 2:
+                continue
+            path = os.path.join(cache_dir, first, second)
+            for filename in listdir(path)[1]:
+                match = KEYED_FILENAME.match(filename)
+                if match and match.group(1).startswith(first + second):
+                    yield os.path.join(path, filename)
+
+def collect_garbage(apps, options):
+    """
+    Deletes the content-addressed outputs (see IKOptions.cache_keying) that no
+    (instance, spec) pair maps to -- left behind when source images or specs change,
+    as FileAccessor._delete() can't tell whether another instance still uses them --
+    along with the outputs rendered under the filename before the source hash
+    was computed.
+    
+    Models sharing a storage and cache_dir are collected together, and files
+    younger than --min-age are kept, as they may belong to an instance saved
+    since its model was scanned. A cache_dir that's a callable can't be listed,
+    so those models are skipped.
+    
+    """
+    apps = [a.strip(',') for a in apps]
+    modls = [m for m in cache.get_models() if issubclass(m, ImageModel)
+        and getattr(m._ik, 'cache_keying', 'filename') == 'content']
+    
+    groups = dict()
+    for modl in modls:
+        if callable(modl._ik.cache_dir):
+            print '--- %s.%s has a callable cache_dir, skipping' % (modl._meta.app_label, modl.__name__)
+            continue
+        groups.setdefault((id(modl._ik.storage), modl._ik.cache_dir), []).append(modl)
+    
+    chunk_size = int(options.get('chunk_size') or 500)
+    min_age = timedelta(seconds=int(options.get('min_age') or 0))
+    dry_run = options.get('dry_run', False)
+    verb = int(options.get('verbosity', 1)) > 1
+    deleted = 0
+    
+    for (storage_id, cache_dir), group in groups.items():
+        # the models in a group share the directory, so all of them count towards what's live --
+        # but only the named apps' directories are collected
+        if apps and not [m for m in group if m._meta.app_label in apps]:
+            continue
+        storage = group[0]._ik.storage
+        
+        print '>>> Collecting "%s" for %s...' % (cache_dir, ', '.join(["%s.%s" % (
+            m._meta.app_label, m.__name__) for m in group]))
+        
+        live = set()
+        leftovers = set()
+        for modl in group:
+            names, unkeyed = live_names(modl, chunk_size)
+            live.update(names)
+            leftovers.update(unkeyed)
+        
+        examined = orphaned = 0
+        candidates = itertools.chain(stored_names(storage, cache_dir),
+            [name for name in sorted(leftovers) if storage.exists(name)])
+        for name in candidates:
+            examined += 1
+            if name in live:
+                continue
+            try:
+                if datetime.now() - storage.modified_time(name) < min_age:
+                    continue
+            except (OSError, IOError, NotImplementedError):
+                pass
+            
+            orphaned += 1
+            if verb or dry_run:
+                print ">>> %s" % name
+            if not dry_run:
+                try:
+                    storage.delete(name)
+                except (NotImplementedError, IOError), err:
+                    logg.info("--- exception thrown when deleting: %s" % err)
+                    continue
+                for modl in group:
+                    spec_cache = getattr(modl._ik, 'spec_cache', None) or get_spec_cache()
+                    if spec_cache is not None:
+                        spec_cache.delete(name)
+                deleted += 1
+        
+        print "::: Examined %s files, %s orphaned." % (examined, orphaned)
+    
+    return deleted
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.db.models.loading import cache
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from imagekit.models import HistogramBase
+from imagekit.modelfields import HistogramChannelField, pack_histogram
+
+from . import echo_banner, chunked
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size',
+            default=500, type="int",
+            help="Number of histograms read from the database at a time (default 500)",
+        ),
+        make_option('--force', '-f', dest='force', action="store_true",
+            default=False,
+            help="Repack histograms whose packed columns are already filled in.",
+        ),
+    )
+    
+    help = ('Copies histogram data from the 256-column layout into packed histogram columns.')
+    args = '[apps]'
+    requires_model_validation = True
+    can_import_settings = True
+    
+    def handle(self, *args, **options):
+        echo_banner()
+        return pack_histograms(args, options)
+
+def pack_histograms(apps, options):
+    """
+    Fills in the packed columns of every HistogramChannelField set up with
+    layout='both', from the 256 HistogramColumns it still has alongside them.
+    
+    Rows are written with QuerySet.update(), so the histograms aren't
+    recomputed from their images on the way through.
+    
+    """
+    apps = [a.strip(',') for a in apps]
+    modls = [m for m in cache.get_models() if issubclass(m, HistogramBase)]
+    if apps:
+        modls = [m for m in modls if m._meta.app_label in apps]
+    
+    verb = int(options.get('verbosity', 1)) > 1
+    force = options.get('force', False)
+    
+    for modl in modls:
+        
+        channel_fields = [field for field in modl._meta.fields
+            if isinstance(field, HistogramChannelField) and field.layout == 'both']
+        
+        if not channel_fields:
+            print '--- %s.%s has no histogram channels with layout="both"' % (modl._meta.app_label, modl.__name__)
+            continue
+        
+        colnames = dict([(field.original_channel, ["_%s_%02X" % (field.original_channel, i) for i in xrange(256)])
+            for field in channel_fields])
+        only = ['pk'] + [field.packed_name for field in channel_fields] + sum(colnames.values(), [])
+        
+        print '>>> Packing %s histogram channels in "%s.%s"...' % (
+            ', '.join([field.original_channel for field in channel_fields]),
+            modl._meta.app_label, modl.__name__)
+        
+        examined = packed = 0
+        for histogram in chunked(modl.objects.only(*only), int(options.get('chunk_size') or 500)):
+            examined += 1
+            updates = dict()
+            
+            for field in channel_fields:
+                if force or not getattr(histogram, field.packed_name):
+                    updates[field.packed_name] = pack_histogram(
+                        [getattr(histogram, colname) for colname in colnames[field.original_channel]])
+            
+            if updates:
+                modl.objects.filter(pk=histogram.pk).update(**updates)
+                packed += 1
+                if verb:
+                    print ">>> %s #%s : %s" % (modl.__name__, histogram.pk, ', '.join(sorted(updates.keys())))
+        
+        print "::: Examined %s histograms, packed %s." % (examined, packed)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.db.models.loading import cache
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from imagekit.lib import ImageCms
+from imagekit.models import ImageWithMetadata, ICCModel
+
+from . import echo_banner
+
+INTENTS = {
+    'perceptual':       ImageCms.INTENT_PERCEPTUAL,
+    'saturation':       ImageCms.INTENT_SATURATION,
+    'absolute':         ImageCms.INTENT_ABSOLUTE_COLORIMETRIC,
+    'relative':         ImageCms.INTENT_RELATIVE_COLORIMETRIC,
+}
+
+class Command(BaseCommand):
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--profile', '-p', dest='profile',
+            help="The proofing profile: an ICCModel's pk or icchash (required)",
+        ),
+        make_option('--intent', dest='intent',
+            default=None, type="choice", choices=sorted(INTENTS.keys()),
+            help="Render intent (default perceptual)",
+        ),
+        make_option('--proof-intent', dest='proofintent',
+            default=None, type="choice", choices=sorted(INTENTS.keys()),
+            help="Proof render intent (default absolute)",
+        ),
+        make_option('--workers', '-w', dest='workers',
+            default=None, type="int",
+            help="Number of threads proofing images (default IK_PROOF_WORKERS, or the number of CPUs)",
+        ),
+        make_option('--chunk-size', dest='chunk_size',
+            default=100, type="int",
+            help="Number of images read from the database at a time (default 100)",
+        ),
+        make_option('--replace', dest='replace', action="store_true",
+            default=False,
+            help="Regenerate proofs that already exist.",
+        ),
+    )
+    
+    help = ('Soft-proofs every image of the ImageWithMetadata models in the named apps against one ICC profile.')
+    args = '[apps]'
+    requires_model_validation = True
+    can_import_settings = True
+    
+    def handle(self, *args, **options):
+        echo_banner()
+        return proof_images(args, options)
+
+def proof_images(apps, options):
+    """
+    Creates Proof objects for the images of every ImageWithMetadata subclass in the
+    given apps (or app.Model names) -- all of them, by default -- in bulk,
+    with ImageWithMetadataQuerySet.proofimages().
+    
+    """
+    profile = options.get('profile')
+    if not profile:
+        raise CommandError("A proofing profile is required (--profile=<ICCModel pk or icchash>)")
+    try:
+        if profile.isdigit():
+            proofprofile = ICCModel.objects.get(pk=int(profile))
+        else:
+            proofprofile = ICCModel.objects.get(icchash__iexact=profile)
+    except ICCModel.DoesNotExist:
+        raise CommandError("No ICCModel found for proofing profile '%s'" % profile)
+    
+    apps = [a.strip(',') for a in apps]
+    modls = [m for m in cache.get_models() if issubclass(m, ImageWithMetadata)]
+    if apps:
+        modls = [m for m in modls if m._meta.app_label in apps or \
+            "%s.%s" % (m._meta.app_label, m.__name__) in apps]
+    
+    intent = options.get('intent')
+    if intent is not None:
+        intent = INTENTS[intent]
+    proofintent = options.get('proofintent')
+    if proofintent is not None:
+        proofintent = INTENTS[proofintent]
+    
+    for modl in modls:
+        print '>>> Proofing "%s.%s" images against %s...' % (
+            modl._meta.app_label, modl.__name__, proofprofile.icc.getDescription())
+        
+        proofs = modl.objects.proofimages(proofprofile,
+            intent=intent,
+            proofintent=proofintent,
+            replace=options.get('replace', False),
+            workers=options.get('workers'),
+            chunk_size=int(options.get('chunk_size') or 100))
+        
+        if int(options.get('verbosity', 1)) > 1:
+            for proof in proofs:
+                print ">>> %s #%s : %s" % (modl.__name__, proof.object_id, proof.image.name)
+        
+        print "::: Created %s proofs." % len(proofs)
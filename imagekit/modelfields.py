@@ -1,4 +1,4 @@
-import base64, hashlib, uuid
+import base64, hashlib, struct, uuid
 from django.conf import settings
 from django.db import models
 from django.db.models import fields
@@ -12,8 +12,10 @@ from django.contrib.contenttypes import generic
 
 from ICCProfile import ICCProfile
 from imagekit import colors
-from imagekit.utils import logg
+from imagekit.lib import Image
+from imagekit.utils import logg, open_source, hash_file, hash_pixels
 from imagekit.utils import EXIF
+from imagekit.perceptual import PERCEPTUAL_MODES, image_hash, update_index, remove_from_index
 from imagekit import signals as iksignals
 from imagekit.widgets import RGBColorFieldWidget
 
@@ -56,6 +58,35 @@ VALID_COLORSPACES = (
 # it provides consistent return types when accessing HistogramChannelField data.
 to_matrix = lambda l: numpy.array(l, dtype=int)
 
+# True if an instance's metadata fields are left to the one refresh_metadata job
+# (see Options.refresh_metadata()) rather than enqueueing signals of their own.
+batched_metadata = lambda instance: getattr(getattr(instance, '_ik', None), 'batch_metadata', False)
+
+# True during the save_base() with which ImageModel.save() inserts a new instance --
+# it's followed by a second save, so post_save handlers wait for that one.
+inserting = lambda instance: getattr(instance, '_ik_inserting', False)
+
+"""
+HistogramChannelField storage layouts (see the field's notes below):
+
+    'columns'   -- 256 HistogramColumn integer columns per channel (the original layout)
+    'packed'    -- one HistogramPackedColumn per channel, holding 256 little-endian
+                   uint32 values, base64-encoded
+    'both'      -- write both, read the packed column when it's filled in; use this
+                   while migrating from 'columns' to 'packed' (see ikpackhistograms)
+
+"""
+HISTOGRAM_LAYOUTS = ('columns', 'packed', 'both')
+HISTOGRAM_LAYOUT = getattr(settings, 'IK_HISTOGRAM_LAYOUT', 'columns')
+
+def pack_histogram(values):
+    """ Pack 256 histogram bin counts into the base64 blob stored by HistogramPackedColumn. """
+    return base64.b64encode(struct.pack('<256I', *[int(value) for value in list(values)[:256]]))
+
+def unpack_histogram(packed):
+    """ Read a packed histogram blob as a 256-element uint32 array, without copying the decoded bytes. """
+    return numpy.frombuffer(base64.b64decode(packed), dtype='<u4')
+
 def get_modified_time(instance):
     if instance is not None:
         storage = getattr(instance, '_storage', None)
@@ -181,7 +212,7 @@ class ICCMetaField(ICCDataField):
             dispatch_uid='iccmetafield-clear-cache')
     
     def check_icc_field(self, **kwargs): # signal, sender, instance
-        if not kwargs.get('raw', False):
+        if not kwargs.get('raw', False) and not batched_metadata(kwargs.get('instance')):
             instance = kwargs.get('instance')
             sender = kwargs.get('sender')
             
@@ -310,7 +341,9 @@ class EXIFMetaField(models.TextField):
             dispatch_uid='exifmetafield-clear-cache')
     
     def check_exif_field(self, **kwargs): # signal, sender, instance
-        if not kwargs.get('raw', False):
+        if inserting(kwargs.get('instance')):
+            return
+        if not kwargs.get('raw', False) and not batched_metadata(kwargs.get('instance')):
             instance = kwargs.get('instance')
             sender = kwargs.get('sender')
             
@@ -432,6 +465,31 @@ class HistogramColumn(models.IntegerField):
         return ('django.db.models.IntegerField', args, kwargs)
 
 
+class HistogramPackedColumn(models.TextField):
+    """
+    Model field holding all 256 columns of an 8-bit histogram channel, packed
+    as little-endian uint32 values and base64-encoded -- one column per channel,
+    instead of 256 HistogramColumns. Like HistogramColumn, these are added for
+    you by HistogramChannelField, when it's set up with layout='packed' or 'both'.
+    
+    """
+    def __init__(self, *args, **kwargs):
+        self.channel = kwargs.pop('channel', None)
+        if self.channel:
+            kwargs.setdefault('default', '')
+            kwargs.setdefault('editable', False)
+            kwargs.setdefault('blank', True)
+            kwargs.setdefault('null', False)
+        else:
+            raise TypeError("Can't create a HistogramPackedColumn without specifying a channel.")
+        super(HistogramPackedColumn, self).__init__(*args, **kwargs)
+    
+    def south_field_triple(self):
+        from south.modelsinspector import introspector
+        args, kwargs = introspector(self)
+        return ('django.db.models.TextField', args, kwargs)
+
+
 class HistogramChannelDescriptor(object):
     """
     Histogram channel descriptor for accessing the histogram channel data,
@@ -462,6 +520,12 @@ class HistogramChannelDescriptor(object):
         
         # get the fucking histogram channel data out of the database here
         elif isinstance(histogram_channel, (basestring, type(None))):
+            if histogram_channel and self.field.layout in ('packed', 'both'):
+                packed = getattr(instance, self.field.packed_name, None)
+                if packed:
+                    return unpack_histogram(packed)
+                if self.field.layout == 'packed':
+                    return to_matrix([])
             out = []
             if histogram_channel:
                 for i in xrange(256):
@@ -508,12 +572,23 @@ class HistogramChannelField(models.CharField):
     The arrangement with VALID_CHANNELS will go away in the future (just like
     all specious architectural decisions in eveyone's code everywhere.)
     
+    The 'layout' kwarg (default: settings.IK_HISTOGRAM_LAYOUT, or 'columns')
+    picks how the channel is stored -- 256 HistogramColumns named e.g. '_R_00'
+    through '_R_FF', or one HistogramPackedColumn named e.g. '_R_packed', which
+    reads back as a uint32 array via numpy.frombuffer() instead of 256 getattr()
+    calls. To move an existing table over: switch to layout='both' and add the
+    packed columns, fill them in with the ikpackhistograms command, then switch
+    to layout='packed' and drop the old columns.
+    
     """
     
     def __init__(self, channel="L", *args, **kwargs):
         # see https://bitbucket.org/carljm/django-markitup/src/tip/markitup/fields.py
         self.pil_reference = kwargs.pop('pil_reference', 'pilimage')
         self.add_columns = not kwargs.pop('add_columns', False)
+        self.layout = kwargs.pop('layout', HISTOGRAM_LAYOUT)
+        if self.layout not in HISTOGRAM_LAYOUTS:
+            raise TypeError("Invalid layout %s was specified for HistogramChannelField" % self.layout)
         
         for arg in ('primary_key', 'unique'):
             if arg in kwargs:
@@ -521,6 +596,7 @@ class HistogramChannelField(models.CharField):
         if channel not in VALID_CHANNELS:
             raise TypeError("Invalid channel type %s was specified for HistogramChannelField" % channel)
         self.channel = self.original_channel = channel
+        self.packed_name = "_%s_packed" % channel
         
         kwargs['max_length'] = 1
         kwargs.setdefault('default', channel)
@@ -550,7 +626,14 @@ class HistogramChannelField(models.CharField):
             dispatch_uid='histogramchannelfield-clear-histogram-channels-%s' % self.channel)
         
         if self.add_columns and not cls._meta.abstract:
-            if hasattr(self, 'original_channel'):
+            if self.layout in ('packed', 'both'):
+                packedcol = HistogramPackedColumn(channel=self.original_channel)
+                packedcol.db_column = self.packed_name
+                packedcol.verbose_name = self.packed_name
+                self.creation_counter = packedcol.creation_counter + 1
+                cls.add_to_class(self.packed_name, packedcol)
+            
+            if self.layout in ('columns', 'both'):
                 for i in xrange(256):
                     histocol = HistogramColumn(channel=self.original_channel)
                     histocolname = "_%s_%02X" % (self.original_channel, i)
@@ -559,6 +642,15 @@ class HistogramChannelField(models.CharField):
                     self.creation_counter = histocol.creation_counter + 1
                     cls.add_to_class(histocolname, histocol)
     
+    def store_histogram_channel(self, instance, channel_data):
+        """ Write 256 bin counts to the instance, in whichever layout this field uses. """
+        if self.layout in ('packed', 'both'):
+            setattr(instance, self.packed_name, pack_histogram(channel_data))
+        if self.layout in ('columns', 'both'):
+            for i in xrange(256):
+                histocolname = "_%s_%02X" % (self.original_channel, i)
+                setattr(instance, histocolname, int(channel_data[i]))
+    
     def refresh_histogram_channel(self, **kwargs):
         """ Stores histogram column values in their respective db fields before saving. """
         if not kwargs.get('raw', False):
@@ -566,9 +658,14 @@ class HistogramChannelField(models.CharField):
             image = instance.image
             
             pil_reference = self.pil_reference
+            channels = None
             
             try:
-                if callable(pil_reference):
+                if pil_reference == 'pilimage' and hasattr(image, 'histogram_channels'):
+                    # one decode and one histogram() call, shared by every channel
+                    # of every histogram computed from this image instance
+                    channels = image.histogram_channels()
+                elif callable(pil_reference):
                     pilimage = pil_reference(image)
                 else:
                     pilimage = getattr(image, getattr(self, 'pil_reference', 'pilimage'))
@@ -583,12 +680,15 @@ class HistogramChannelField(models.CharField):
                 logg.warning("*** Couldn't refresh histogram channel '%s' with callable (IOError was thrown: %s)" % (self.original_channel, err))
                 return
             
-            if pilimage:
+            if channels is not None:
+                if self.original_channel in channels:
+                    self.store_histogram_channel(instance, channels[self.original_channel])
+                    logg.info("Refreshed histogram channel %s" % self.original_channel)
+            
+            elif pilimage:
                 if self.original_channel in pilimage.mode:
                     channel_data = pilimage.split()[pilimage.mode.index(self.original_channel)].histogram()[:256]
-                    for i in xrange(256):
-                        histocolname = "_%s_%02X" % (self.original_channel, i)
-                        setattr(instance, histocolname, int(channel_data[i]))
+                    self.store_histogram_channel(instance, channel_data)
                     logg.info("Refreshed histogram channel %s" % self.original_channel)
     
     def clear_histogram_channels(self, **kwargs): # signal, sender, instance
@@ -600,9 +700,7 @@ class HistogramChannelField(models.CharField):
             self.channel,
             image.__class__.__name__, self.name, image.id))
         
-        for i in xrange(256):
-            histocolname = "_%s_%02X" % (self.original_channel, i)
-            setattr(instance, histocolname, 0)
+        self.store_histogram_channel(instance, [0] * 256)
     
     def save_form_data(self, instance, data):
         """ Not sure about this one. """
@@ -645,10 +743,15 @@ class HistogramDescriptor(object):
                 raise AttributeError("No histogram relation found for %s" % instance)
             
             try:
-                return histogram_rel.get()
+                histogram = histogram_rel.get()
             except ObjectDoesNotExist:
                 ThisHistogramClass = imagekit.models.HISTOGRAMS.get(self.field.original_colorspace.lower(), None)
                 return ThisHistogramClass(imagewithmetadata=instance)
+            else:
+                # point the histogram back at this very instance, rather than letting
+                # the generic relation fetch another copy, so they share decoded data
+                histogram.imagewithmetadata = instance
+                return histogram
         
         else:
             # not sure what this is
@@ -725,7 +828,9 @@ class Histogram(fields.CharField):
             cls.add_to_class('_%s_histogram_relation' % self.original_colorspace.lower(), histogram)
     
     def queue_related_histogram_update(self, **kwargs): # signal, sender, instance
-        if not kwargs.get('raw', False):
+        if inserting(kwargs.get('instance')):
+            return
+        if not kwargs.get('raw', False) and not batched_metadata(kwargs.get('instance')):
             instance = kwargs.get('instance')
             sender = kwargs.get('sender')
             logg.info("--- Enqueueing async signal 'save_related_histogram' for %s %s." % (
@@ -741,6 +846,9 @@ class Histogram(fields.CharField):
             
             if related_histogram:
                 related_histogram.save()
+                
+                from imagekit.histindex import update_index
+                update_index(instance)
             
             if not related_histogram:
                 logg.info("--X DID NOT SAVE A HISTOGRAM OF ANY TYPE -- RelatedHistogramClass came up NoneType")
@@ -791,7 +899,20 @@ class ImageHashField(fields.CharField):
            that you're naming a hash algorithm from the hashlib module. If it's a callable,
            it should take the value of tostring() from a pil Image instance as its one
            argument, and return a string that uniquely and deterministically identifies
-           the stringified image data it was given.
+           the stringified image data it was given. As it's handed the whole buffer at once,
+           a callable hasher costs one full-size copy of the decoded image; a hashlib algorithm,
+           which can be fed a strip at a time, doesn't (see below).
+    
+    The 'mode' kwarg (default: settings.IK_IMAGEHASH_MODE, or 'pixels') says what gets hashed:
+    
+        * 'pixels' hashes the decoded image data. With a hashlib algorithm as the hasher,
+           it's fed to hashlib a strip at a time (see utils.hash_pixels) and comes out the
+           same as hashing tostring() in one go, without a second copy of the image.
+    
+        * 'file' streams the stored file's bytes through the hashlib algorithm named by
+           'hasher', in fixed-size chunks -- no PIL, no decoding, and bounded memory. The
+           hash identifies the file, though, not the picture: the same image re-encoded
+           will hash differently.
     
     NOTE: ImageHashField is a subclass of django.db.models.CharField, which requires 
     max_length to be specified. We default to 40, which is the value of:
@@ -803,13 +924,24 @@ class ImageHashField(fields.CharField):
     and your max_length should be whatever that number is; otherwise make sure you set it
     to something that accommodates your hash length (and not more).
     
+    The 'mode' kwarg can also name one of the perceptual hashes in imagekit.perceptual --
+    'ahash', 'dhash' or 'phash' -- which are computed from a small thumbnail of the image,
+    come out the same (or nearly) for re-encoded or resized copies, and are stored as 16 hex
+    digits (the default max_length for these modes). Similar images have hashes that
+    differ in only a few bits: see ImageWithMetadata.objects.near_duplicates(). ImageWithMetadata
+    doesn't declare one of these -- add it to your subclass if you want near-duplicate lookups.
+    
     """
     def __init__(self, *args, **kwargs):
         self.pil_reference = kwargs.pop('pil_reference', 'pilimage')
         self.hasher = kwargs.pop('hasher', 'sha1')
+        self.mode = kwargs.pop('mode', getattr(settings, 'IK_IMAGEHASH_MODE', 'pixels'))
+        
+        if self.mode not in ('pixels', 'file') + PERCEPTUAL_MODES:
+            raise TypeError("Invalid mode %s was specified for ImageHashField" % self.mode)
         
         kwargs.setdefault('db_index', True)
-        kwargs.setdefault('max_length', 40) # size of sha1, the deafult
+        kwargs.setdefault('max_length', self.mode in PERCEPTUAL_MODES and 16 or 40) # size of sha1, the deafult
         kwargs.setdefault('editable', False)
         kwargs.setdefault('unique', False)
         kwargs.setdefault('blank', True)
@@ -819,14 +951,21 @@ class ImageHashField(fields.CharField):
     def contribute_to_class(self, cls, name):
         super(ImageHashField, self).contribute_to_class(cls, name)
         signals.pre_save.connect(self.check_hash_field, sender=cls,
-            dispatch_uid='imagehashfield-pre-save')
+            dispatch_uid='imagehashfield-pre-save-%s' % name)
         iksignals.refresh_hash.connect(self.refresh_hash, sender=cls,
-            dispatch_uid='imagehashfield-refresh-hash')
+            dispatch_uid='imagehashfield-refresh-hash-%s' % name)
         iksignals.clear_cache.connect(self.clear_hash, sender=cls,
-            dispatch_uid='imagehashfield-clear-cache')
+            dispatch_uid='imagehashfield-clear-cache-%s' % name)
+        if self.mode in PERCEPTUAL_MODES:
+            signals.post_delete.connect(self.remove_perceptual_hash, sender=cls,
+                dispatch_uid='imagehashfield-post-delete-%s' % name)
+    
+    def remove_perceptual_hash(self, **kwargs): # signal, sender, instance
+        """ Drops a deleted instance's perceptual hash from the near-duplicate index. """
+        remove_from_index(kwargs.get('instance'), self.name)
     
     def check_hash_field(self, **kwargs): # signal, sender, instance
-        if not kwargs.get('raw', False):
+        if not kwargs.get('raw', False) and not batched_metadata(kwargs.get('instance')):
             instance = kwargs.get('instance')
             sender = kwargs.get('sender')
             
@@ -843,6 +982,11 @@ class ImageHashField(fields.CharField):
         """ Stores image hash data in the field before saving. """
         instance = kwargs.get('instance')
         
+        if self.mode in PERCEPTUAL_MODES:
+            return self.refresh_perceptual_hash(**kwargs)
+        if self.mode == 'file':
+            return self.refresh_file_hash(**kwargs)
+        
         try:
             pil_reference = self.pil_reference
             
@@ -864,16 +1008,16 @@ class ImageHashField(fields.CharField):
         if pilimage:
             try:
                 hash_string = ''
-                hashee = pilimage.tostring()
                 hasher = self.hasher
                 
                 if callable(hasher):
-                    # use the custom callable
-                    hash_string = hasher(pil_reference)
+                    # a custom callable takes the image data as one string, so we can't feed
+                    # it strips -- it gets the single full-size copy that tostring() makes
+                    hash_string = hasher(pilimage.tostring())
                     setattr(instance, self.name, hash_string)
                 else:
                     # use the specified alorithm in hashlib to create a digest
-                    hash_string = getattr(hashlib, hasher)(hashee).hexdigest()
+                    hash_string = hash_pixels(pilimage, hasher)
                     setattr(instance, self.name, hash_string)
             
             except AttributeError, err:
@@ -897,6 +1041,70 @@ class ImageHashField(fields.CharField):
                 if not dequeue_runmode == enqueue_runmode:
                     instance.save_base(cls=instance.__class__)
     
+    def refresh_file_hash(self, **kwargs): # signal, sender, instance
+        """ Stores a hash of the stored image file's bytes in the field. """
+        instance = kwargs.get('instance')
+        
+        if not instance._imgfield.name:
+            return
+        
+        try:
+            setattr(instance, self.name, hash_file(instance._storage, instance._imgfield.name, self.hasher))
+        
+        except AttributeError, err:
+            logg.warning("*** Couldn't refresh image file hash (AttributeError was thrown: %s)" % err)
+            return
+        except IOError, err:
+            logg.warning("*** Couldn't refresh image file hash (IOError was thrown: %s)" % err)
+            return
+        
+        logg.info("Updated image file hash: %s.%s %s" % (
+            instance.__class__.__name__, self.name, instance.id))
+        
+        # save if sent asynchronously
+        dequeue_runmode = kwargs.get('dequeue_runmode', None)
+        enqueue_runmode = kwargs.get('enqueue_runmode', None)
+        if dequeue_runmode is not None:
+            if not dequeue_runmode == enqueue_runmode:
+                instance.save_base(cls=instance.__class__)
+    
+    def refresh_perceptual_hash(self, **kwargs): # signal, sender, instance
+        """
+        Stores a perceptual hash of the image in the field. The image is opened afresh
+        (not via pilimage, which may already be decoded in full) so that JPEGs can be
+        drafted down to thumbnail size as they're decoded.
+        
+        """
+        instance = kwargs.get('instance')
+        
+        if not instance._imgfield.name:
+            return
+        
+        try:
+            fp = open_source(instance._storage, instance._imgfield.name)
+            try:
+                setattr(instance, self.name, image_hash(Image.open(fp), self.mode))
+            finally:
+                fp.close()
+        
+        except IOError, err:
+            logg.warning("*** Couldn't refresh perceptual image hash (IOError was thrown: %s)" % err)
+            return
+        except TypeError, err:
+            logg.warning("*** Couldn't refresh perceptual image hash (TypeError was thrown: %s)" % err)
+            return
+        
+        logg.info("Updated perceptual image hash (%s): %s.%s %s" % (
+            self.mode, instance.__class__.__name__, self.name, instance.id))
+        update_index(instance, self.name)
+        
+        # save if sent asynchronously
+        dequeue_runmode = kwargs.get('dequeue_runmode', None)
+        enqueue_runmode = kwargs.get('enqueue_runmode', None)
+        if dequeue_runmode is not None:
+            if not dequeue_runmode == enqueue_runmode:
+                instance.save_base(cls=instance.__class__)
+    
     def clear_hash(self, **kwargs): # signal, sender, instance
         """ Clear the image hash. """
         instance = kwargs.get('instance')
@@ -1015,7 +1223,7 @@ class RGBColorField(models.CharField):
             dispatch_uid='rgbcolorfield-clear-color-%s' % self.name and self.name or self.verbose_name)
     
     def check_rgb_color_field(self, **kwargs):
-        if not kwargs.get('raw', False):
+        if not kwargs.get('raw', False) and not batched_metadata(kwargs.get('instance')):
             instance = kwargs.get('instance')
             sender = kwargs.get('sender')
             
@@ -1,6 +1,9 @@
-import os, random, hashlib, math
+import os, random, hashlib, math, threading
 import cStringIO as StringIO
 from datetime import datetime
+from itertools import islice
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
 from django.core.files import File
 from django.core.urlresolvers import reverse
@@ -8,7 +11,7 @@ from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
 from django.core.exceptions import ImproperlyConfigured
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.base import ModelBase
 from django.contrib.contenttypes import generic
@@ -19,13 +22,14 @@ from colorsys import rgb_to_hls, hls_to_rgb
 
 from delegate import DelegateManager, delegate
 from imagekit import signals as iksignals
-from imagekit import specs
+from imagekit import specs, colorstats
 from imagekit.lib import Image, ImageFile, ImageCms, ImageStat, IK_sRGB, cv
 from imagekit.options import Options
+from imagekit.processors import icc_apply
 from imagekit.modelfields import VALID_CHANNELS, to_matrix
 from imagekit.ICCProfile import ICCProfile
-from imagekit.utils import logg, hexstr
-from imagekit.utils import itersubclasses
+from imagekit.utils import logg, hexstr, histogram_channels, open_source
+from imagekit.utils import itersubclasses, chunked
 from imagekit.utils import icchash as icchasher
 from imagekit.utils.memoize import memoize
 from imagekit.modelfields import ICCField, ICCHashField, RGBColorField
@@ -125,22 +129,109 @@ class ImageModel(models.Model):
     def _storage(self):
         return getattr(self._ik, 'storage')
     
+    def _decoded(self):
+        """
+        Per-instance cache of the decoded image and everything derived from it --
+        mode conversions, the analysis proxy, histograms. It's thrown out whenever
+        the image field's name changes, or by clear_decoded().
+        
+        """
+        name = self._imgfield.name
+        cache = self.__dict__.get('_decoded_cache')
+        if cache is None or cache.get('name') != name:
+            cache = self.__dict__['_decoded_cache'] = { 'name': name }
+        return cache
+    
+    def clear_decoded(self):
+        self.__dict__.pop('_decoded_cache', None)
+    
     @property
     def pilimage(self):
-        if hasattr(self, '_pilimage'):
-            return self._pilimage
+        cache = self._decoded()
+        if 'pilimage' in cache:
+            return cache['pilimage']
         
         if self.pk:
             if self._imgfield.name:
                 try:
-                    out = Image.open(self._storage.open(self._imgfield.name))
+                    out = Image.open(open_source(self._storage, self._imgfield.name))
                 except IOError:
                     return None
                 else:
-                    self._pilimage = out
+                    cache['pilimage'] = out
                     return out
         return None
     
+    def pilimage_as(self, mode):
+        """
+        The image converted to a PIL mode ('RGB', 'L', ...) -- each conversion is done once
+        and shared by everything that asks for it until the image changes. Treat the result
+        as read-only: copy() it before modifying it.
+        
+        """
+        cache = self._decoded()
+        if mode not in cache:
+            pilimage = self.pilimage
+            if pilimage is None:
+                return None
+            cache[mode] = pilimage.mode == mode and pilimage or pilimage.convert(mode)
+        return cache[mode]
+    
+    def analysis_image(self, size=None):
+        """
+        A small RGB copy of the image -- no more than 'size' pixels on a side
+        (settings.IK_ANALYSIS_SIZE, 256 by default) -- for color statistics
+        that don't need every pixel. Cached like pilimage_as().
+        
+        """
+        if size is None:
+            size = getattr(settings, 'IK_ANALYSIS_SIZE', 256)
+        cache = self._decoded()
+        key = ('analysis', size)
+        if key not in cache:
+            rgb = self.pilimage_as('RGB')
+            if rgb is None:
+                return None
+            proxy = rgb.copy()
+            proxy.thumbnail((size, size), Image.ANTIALIAS)
+            cache[key] = proxy
+        return cache[key]
+    
+    def colorstats(self):
+        """
+        A colorstats.ColorStats for the image (or for its analysis_image(), if
+        settings.IK_COLORSTATS_PROXY is set), cached like pilimage_as() --
+        or None, without NumPy.
+        
+        """
+        if colorstats.numpy is None:
+            return None
+        cache = self._decoded()
+        if 'colorstats' not in cache:
+            if getattr(settings, 'IK_COLORSTATS_PROXY', False):
+                im = self.analysis_image()
+            else:
+                im = self.pilimage_as('RGB')
+            if im is None:
+                return None
+            cache['colorstats'] = colorstats.ColorStats(im)
+        return cache['colorstats']
+    
+    def histogram_channels(self):
+        """
+        All of the image's 256-bin channel histograms (see utils.histogram_channels),
+        from one decode of the image. They're kept on the instance until the image
+        changes, so every HistogramChannelField computed from this instance shares them.
+        
+        """
+        cache = self._decoded()
+        if 'histograms' not in cache:
+            pilimage = self.pilimage
+            if pilimage is None:
+                return {}
+            cache['histograms'] = histogram_channels(pilimage, luma=self.pilimage_as('L'))
+        return cache['histograms']
+    
     def _cvimage_via_pil(self):
         if self.pk:
             if cv is not None:
@@ -187,21 +278,30 @@ class ImageModel(models.Model):
                 app_label=content_type.app_label, modlcls=content_type.model, pk=self.pk))
     
     def _dominant(self):
-        return self.pilimage.convert('RGB').resize((1, 1), Image.NEAREST).getpixel((0, 0))
+        return self.pilimage_as('RGB').resize((1, 1), Image.NEAREST).getpixel((0, 0))
         #return self.pilimage.quantize(1).convert('RGB').getpixel((0, 0))
     
     def _mean(self):
-        return ImageStat.Stat(self.pilimage.convert('RGB')).mean
+        stats = self.colorstats()
+        if stats is not None:
+            return stats.mean
+        return ImageStat.Stat(self.pilimage_as('RGB')).mean
     
     def _average(self):
-        return self.pilimage.convert('RGB').resize((1, 1), Image.ANTIALIAS).getpixel((0, 0))
+        return self.pilimage_as('RGB').resize((1, 1), Image.ANTIALIAS).getpixel((0, 0))
     
     def _median(self):
-        return reduce((lambda x,y: x[0] > y[0] and x or y), self.pilimage.convert('RGB').getcolors(self.pilimage.size[0] * self.pilimage.size[1]))
+        stats = self.colorstats()
+        if stats is not None:
+            return stats.median
+        return reduce((lambda x,y: x[0] > y[0] and x or y), self.pilimage_as('RGB').getcolors(self.pilimage.size[0] * self.pilimage.size[1]))
     
     def _topcolors(self, numcolors=3):
+        stats = self.colorstats()
+        if stats is not None:
+            return stats.top(numcolors)
         if self.pilimage:
-            colors = self.pilimage.convert('RGB').getcolors(self.pilimage.size[0] * self.pilimage.size[1])
+            colors = self.pilimage_as('RGB').getcolors(self.pilimage.size[0] * self.pilimage.size[1])
             fmax = lambda x,y: x[0] > y[0] and x or y
             out = []
             out.append(reduce(fmax, colors))
@@ -211,6 +311,13 @@ class ImageModel(models.Model):
         return []
     
     def _topsat(self, samplesize=10):
+        stats = self.colorstats()
+        if stats is not None:
+            rgb = stats.most_saturated(samplesize)
+            if rgb is None:
+                return ""
+            return "#" + "".join(map(lambda x: "%02X" % int(x*255),
+                hls_to_rgb(*rgb_to_hls(*[float(c)/255 for c in rgb]))))
         try:
             return "#" + "".join(map(lambda x: "%02X" % int(x*255),
                 map(lambda x: hls_to_rgb(x[0], x[1], x[2]), [
@@ -249,6 +356,7 @@ class ImageModel(models.Model):
             self._imgfield.delete(save=False)
         
         content = ContentFile(data)
+        self.clear_decoded()
         self._imgfield.save(name, content, save=save)
     
     def save(self, *args, **kwargs):
@@ -258,8 +366,14 @@ class ImageModel(models.Model):
         if is_new_object:
             self._meta.auto_created = True
             
-            #self.save_base(*[], **dict(kwargs.items() + dict(cls=self.__class__).items()))
-            self.save_base(*[], **kwargs)
+            # the save() below sends post_save again, so the handlers queueing
+            # metadata refreshes skip this one (see modelfields.inserting)
+            self._ik_inserting = True
+            try:
+                #self.save_base(*[], **dict(kwargs.items() + dict(cls=self.__class__).items()))
+                self.save_base(*[], **kwargs)
+            finally:
+                self._ik_inserting = False
             
             self._meta.auto_created = False
         
@@ -286,6 +400,39 @@ class ImageModel(models.Model):
         iksignals.clear_cache.send_now(sender=self.__class__, instance=self)
 
 
+class ProofQuerySet(models.query.QuerySet):
+    
+    @delegate
+    def cached(self, proofkey):
+        """ The first proof with this proofkey that has a rendered image, or None. """
+        if not proofkey:
+            return None
+        for proof in self.filter(proofkey=proofkey).exclude(image='').exclude(image__isnull=True).order_by('pk')[:1]:
+            return proof
+        return None
+    
+    @delegate
+    def lookup(self, image, proofprofile, sourceprofile=None, intent=None, proofintent=None):
+        """
+        An already-rendered proof of an image -- or of any image with the same
+        imagehash -- with these profiles and intents, or None. Only stored hashes
+        are read, so the image isn't opened.
+        
+        """
+        if intent is None:
+            intent = self.model._meta.get_field('intent').default
+        if proofintent is None:
+            proofintent = self.model._meta.get_field('proofintent').default
+        return self.cached(self.model.make_proofkey(
+            getattr(image, 'imagehash', None),
+            self.model.source_hash(image, sourceprofile),
+            proofprofile and proofprofile.icchash,
+            intent, proofintent, self.model.proofflags,
+            *self.model.proof_encoding(image)))
+
+class ProofManager(DelegateManager):
+    __queryset__ = ProofQuerySet
+
 class Proof(ImageModel):
     class Meta:
          abstract = False
@@ -372,6 +519,16 @@ class Proof(ImageModel):
         editable=False,
         null=True)
     
+    # hash of everything that goes into a proof's pixels -- see make_proofkey()
+    proofkey = models.CharField(verbose_name="Proof cache key",
+        max_length=40,
+        db_index=True,
+        editable=False,
+        blank=True,
+        null=True)
+    
+    objects = ProofManager()
+    
     def __init__(self, *args, **kwargs):
         super(Proof, self).__init__(*args, **kwargs)
         
@@ -405,6 +562,71 @@ class Proof(ImageModel):
     
     targetimage = property(_get_targetimage, _set_targetimage)
     targetprofile = IK_sRGB
+    proofflags = ImageCms.FLAGS.get('SOFTPROOFING')
+    proofquality = getattr(settings, 'IK_PROOF_QUALITY', 75)
+    
+    @classmethod
+    def make_proofkey(cls, imagehash, sourcehash, proofhash, intent, proofintent, flags=None,
+        format=None, quality=None):
+        """
+        The content key of a proof: a sha1 of the source image's imagehash, the hashes
+        of its source and proofing profiles, the intents and LCMS flags used, and the
+        format and quality it's saved with -- proofs with the same key have the same
+        bytes. None without an imagehash.
+        
+        """
+        if not (imagehash and sourcehash and proofhash):
+            return None
+        return hashlib.sha1("\n".join([str(part) for part in (
+            imagehash, sourcehash.lower(), proofhash.lower(), intent, proofintent, flags,
+            format, quality)])).hexdigest()
+    
+    @classmethod
+    def source_hash(cls, image, sourceprofile=None):
+        """
+        The icchash of the profile an image is proofed from: the sourceprofile given,
+        or else the image's own profile if it's stored as an ICCModel, or else sRGB --
+        the same fallback that generate() and generate_batch() render with.
+        
+        """
+        if sourceprofile is not None:
+            return sourceprofile.icchash
+        icchash = getattr(image, 'icchash', None)
+        if icchash and ICCModel.objects.filter(icchash__iexact=icchash).exists():
+            return icchash.lower()
+        return icchasher(IK_sRGB)
+    
+    @classmethod
+    def proof_encoding(cls, image):
+        """
+        The (format, quality) a proof of an image is saved with -- the format going by
+        the extension of the image's file, which the proof's file name keeps too.
+        
+        """
+        name = getattr(getattr(image, '_imgfield', None), 'name', None) or ''
+        Image.init()
+        return Image.EXTENSION.get(os.path.splitext(name)[1].lower(), 'JPEG'), cls.proofquality
+    
+    def compute_proofkey(self):
+        return self.make_proofkey(
+            getattr(self.sourceimage, 'imagehash', None),
+            self.source_hash(self.sourceimage, self.sourceprofile),
+            self.proofprofile and self.proofprofile.icchash,
+            self.intent, self.proofintent, self.proofflags,
+            *self.proof_encoding(self.sourceimage))
+    
+    def release_image(self):
+        """ Delete this proof's image file, unless another proof is using it too. """
+        name = self._imgfield and self._imgfield.name
+        if name and not Proof.objects.filter(image=name).exclude(pk=self.pk).exists():
+            self._imgfield.delete(save=False)
+    
+    def delete(self, *args, **kwargs):
+        # the image file may belong to other proofs as well
+        if kwargs.pop('clear_cache', False):
+            iksignals.clear_cache.send_now(sender=self.__class__, instance=self)
+            self.release_image()
+        super(ImageModel, self).delete(*args, **kwargs)
     
     @property
     def targetname(self):
@@ -414,6 +636,15 @@ class Proof(ImageModel):
                 filepath, basename = os.path.split(str(nn))
                 filename, extension = os.path.splitext(basename)
                 
+                if self.proofkey:
+                    # identical proofs share one file, named by their proofkey
+                    out_filename = self._ik.cache_content_format % {
+                        'key': self.proofkey,
+                        'specname': 'proof',
+                        'extension': extension.lstrip('.'),
+                    }
+                    return os.path.join(self._ik.proof_dir, self.proofkey[:2], self.proofkey[2:4], out_filename)
+                
                 out_filename = "PROOF-" + (self._ik.cache_filename_format % {
                     'filename': filename,
                     'specname': "%s-%s" % (
@@ -457,6 +688,18 @@ class Proof(ImageModel):
                 self.sourceprofile = matching_icc
             self.save()
         
+        self.proofkey = self.compute_proofkey()
+        cached = Proof.objects.cached(self.proofkey)
+        if cached is not None:
+            # the same pixels have been proofed before -- share that file
+            if cached.pk != self.pk:
+                if self._imgfield.name != cached.image.name:
+                    self.release_image()
+                self.w, self.h = cached.w, cached.h # set first, so the image isn't reopened to measure it
+                self.image = cached.image.name
+                self.save()
+            return self
+        
         if not hasattr(self, 'prooftransform') or not reuse_transform:
             self.prooftransform = ImageCms.ImageCmsTransform(
                 self.sourceprofile.icc.lcmsinstance,
@@ -466,16 +709,28 @@ class Proof(ImageModel):
                 self.intent,
                 proof=self.proofprofile.icc.lcmsinstance,
                 proof_intent=self.proofintent,
-                flags=ImageCms.FLAGS.get('SOFTPROOFING'),
+                flags=self.proofflags,
             )
         
         if self.prooftransform:
-            target = self.prooftransform.apply(self.sourceimage.pilimage)
+            target = icc_apply(self.prooftransform, self.sourceimage.pilimage, mode='RGB')
             targetdata = StringIO.StringIO()
-            target.save(targetdata, format=self.sourceimage.pilimage.format)
+            format, quality = self.proof_encoding(self.sourceimage)
+            target.save(targetdata, format=format, quality=quality)
             targetdata.seek(0)
             
-            if self.targetname:
+            if self.targetname and self.proofkey:
+                storage = self._meta.get_field('image').storage
+                name = self.targetname
+                if self._imgfield.name != name:
+                    self.release_image()
+                    if not storage.exists(name):
+                        name = storage.save(name, ContentFile(targetdata.read()))
+                self.w, self.h = target.size
+                self.image = name
+                self.save()
+            
+            elif self.targetname:
                 self.save_image(
                     self.targetname,
                     targetdata,
@@ -484,6 +739,167 @@ class Proof(ImageModel):
             
             else:
                 logg.warning("*** Not saving a perfectly good proofed image due to the lack of a targetname.")
+        
+        return self
+    
+    @classmethod
+    def generate_batch(cls, images, proofprofile, intent=None, proofintent=None,
+        replace=False, workers=None, chunk_size=100):
+        """
+        Proof every image in a queryset against one proofing profile (an ICCModel),
+        and return the new Proof objects -- see ImageWithMetadataQuerySet.proofimages().
+        
+        The source ICCModels are looked up once per distinct icchash, and each LCMS
+        transform is built once per source profile and image mode. Images are read
+        and proofed chunk_size at a time by a pool of IK_PROOF_WORKERS threads
+        (the number of CPUs by default), and each chunk's Proof rows are inserted
+        together. Images that already have a proof with these profiles and intents
+        are skipped, unless 'replace' is set -- in which case the old proofs are
+        deleted first, and everything is rendered afresh, save for files that
+        proofs outside the batch still share.
+        
+        Each proofkey is rendered once: images with the same imagehash share a
+        file, as do images whose proofs were rendered before (unless replacing).
+        
+        """
+        if intent is None:
+            intent = cls._meta.get_field('intent').default
+        if proofintent is None:
+            proofintent = cls._meta.get_field('proofintent').default
+        if workers is None:
+            workers = getattr(settings, 'IK_PROOF_WORKERS', None) or cpu_count()
+        
+        content_type = ContentType.objects.get_for_model(images.model)
+        storage = cls._meta.get_field('image').storage
+        existing = cls.objects.filter(content_type=content_type,
+            proofprofile=proofprofile, intent=intent, proofintent=proofintent)
+        
+        # images without a profile (or with one that isn't stored) are treated as sRGB
+        sRGBhash = icchasher(IK_sRGB)
+        hashes = set([hsh for hsh in images.values_list('icchash', flat=True).distinct() if hsh])
+        hashes |= set([hsh.lower() for hsh in hashes]) | set([sRGBhash])
+        iccmodels = dict([(iccmodel.icchash.lower(), iccmodel) for iccmodel in
+            ICCModel.objects.filter(icchash__in=list(hashes))])
+        
+        transformers = {}
+        transformers_lock = threading.Lock()
+        
+        def transformer_for(iccmodel, mode):
+            key = (iccmodel and iccmodel.icchash, mode)
+            with transformers_lock:
+                if key not in transformers:
+                    transformers[key] = ImageCms.ImageCmsTransform(
+                        iccmodel and iccmodel.icc.lcmsinstance or IK_sRGB.lcmsinstance,
+                        cls.targetprofile.lcmsinstance,
+                        mode,
+                        'RGB',
+                        intent,
+                        proof=proofprofile.icc.lcmsinstance,
+                        proof_intent=proofintent,
+                        flags=cls.proofflags,
+                    )
+                return transformers[key]
+        
+        def sourceprofile_for(image):
+            return iccmodels.get((image.icchash or '').lower()) or iccmodels.get(sRGBhash)
+        
+        def new_proof(image, proofkey):
+            proof = cls(
+                sourceprofile=sourceprofile_for(image),
+                proofprofile=proofprofile,
+                intent=intent,
+                proofintent=proofintent,
+                proofkey=proofkey)
+            proof.sourceimage = image
+            return proof
+        
+        def render(item):
+            image, proofkey = item
+            try:
+                pilimage = image.pilimage
+                if pilimage is None:
+                    return None
+                
+                name = new_proof(image, proofkey).targetname
+                if proofkey and storage.exists(name):
+                    # a file named by its proofkey is the same proof, whoever rendered it --
+                    # so with 'replace', it's only rendered afresh if no other proof uses it
+                    if not replace or cls.objects.filter(image=name).exists():
+                        return name, pilimage.size
+                    storage.delete(name)
+                
+                # the images are already spread across the pool, so each one is converted in one shot
+                target = icc_apply(transformer_for(sourceprofile_for(image), pilimage.mode), pilimage, mode='RGB', workers=0)
+                targetdata = StringIO.StringIO()
+                format, quality = cls.proof_encoding(image)
+                target.save(targetdata, format=format, quality=quality)
+                return storage.save(name, ContentFile(targetdata.getvalue())), target.size
+            
+            except Exception, err:
+                logg.error("*** Couldn't proof %r: %s" % (image, err))
+                return None
+            
+            finally:
+                image.clear_decoded()
+        
+        out = []
+        pool = ThreadPool(max(1, workers))
+        try:
+            images = chunked(images, chunk_size)
+            while True:
+                chunk = list(islice(images, chunk_size))
+                if not chunk:
+                    break
+                pks = [image.pk for image in chunk]
+                if replace:
+                    for old in existing.filter(object_id__in=pks):
+                        old.release_image()
+                        old.delete()
+                else:
+                    done = set(existing.filter(object_id__in=pks).values_list('object_id', flat=True))
+                    chunk = [image for image in chunk if image.pk not in done]
+                
+                proofkeys = dict([(image.pk, cls.make_proofkey(image.imagehash,
+                    cls.source_hash(image, sourceprofile_for(image)), proofprofile.icchash,
+                    intent, proofintent, cls.proofflags, *cls.proof_encoding(image))) for image in chunk])
+                
+                # (name, size) pairs by proofkey -- or by pk, for images without one
+                results = {}
+                if not replace:
+                    for proof in cls.objects.filter(proofkey__in=[key for key in proofkeys.values() if key]).exclude(image=''):
+                        results.setdefault(proof.proofkey, (proof.image.name, (proof.w, proof.h)))
+                
+                renders = {}
+                for image in chunk:
+                    key = proofkeys[image.pk] or image.pk
+                    if key not in results:
+                        renders.setdefault(key, (image, proofkeys[image.pk]))
+                results.update(zip(renders.keys(), pool.map(render, renders.values())))
+                
+                proofs = []
+                for image in chunk:
+                    result = results.get(proofkeys[image.pk] or image.pk)
+                    if result is not None:
+                        proof = new_proof(image, proofkeys[image.pk])
+                        proof.w, proof.h = result[1] # set first, so the image isn't reopened to measure it
+                        proof.image = result[0]
+                        proofs.append(proof)
+                
+                if hasattr(cls.objects, 'bulk_create'):
+                    cls.objects.bulk_create(proofs)
+                else:
+                    with transaction.commit_on_success():
+                        for proof in proofs:
+                            # there are no specs to cache, so ImageModel.save() is skipped
+                            models.Model.save(proof, force_insert=True)
+                out.extend(proofs)
+        finally:
+            pool.close()
+            pool.join()
+        
+        logg.info("Proofed %s %s images against %s" % (
+            len(out), content_type.model_class().__name__, proofprofile.icc.getDescription()))
+        return out
     
     def __repr__(self):
         pk = self.pk or '-nil-'
@@ -634,7 +1050,7 @@ More complex callables can be used as well:
 class LumaHistogram(HistogramBase):
     """
     Luma histogram implementation. It uses one 8-bit channel, L -- a copy of
-    the related image is converted to 'L' mode, as per "pil_reference" (below)
+    the related image is converted to 'L' mode once, by ImageModel.histogram_channels(),
     and used when populating LumaHistogram during save and instantiation.
     
     """
@@ -643,9 +1059,7 @@ class LumaHistogram(HistogramBase):
         verbose_name = "Luma Histogram"
         verbose_name_plural = "Luma Histograms"
     
-    L = HistogramChannelField(channel='L',
-            verbose_name="Luma",
-            pil_reference=lambda instance: instance.pilimage.convert('L'))
+    L = HistogramChannelField(channel='L', verbose_name="Luma")
 
 class RGBHistogram(HistogramBase):
     """
@@ -712,6 +1126,62 @@ class ImageWithMetadataQuerySet(models.query.QuerySet):
     @delegate
     def rndicc(self):
         return self.with_profile().rnd()
+    
+    @delegate
+    def proofimages(self, proofprofile, intent=None, proofintent=None, replace=False, workers=None, chunk_size=100):
+        """
+        Soft-proof every image in this queryset against one proofing profile
+        (an ICCModel) and return the new Proof objects -- one transform is built
+        per source profile, the images are proofed by a pool of threads, and
+        the Proof rows are inserted a chunk at a time. See Proof.generate_batch().
+        
+        """
+        return Proof.generate_batch(self, proofprofile, intent=intent, proofintent=proofintent,
+            replace=replace, workers=workers, chunk_size=chunk_size)
+    
+    @delegate
+    def near_duplicates(self, obj, max_distance=6, field_name=None):
+        """
+        Images whose perceptual hashes are within max_distance bits of obj's, closest
+        first -- see imagekit.perceptual. Returns a list, as with similar_histograms().
+        
+        Perceptual hashes are opt-in: the model needs an ImageHashField with one of the
+        perceptual modes, e.g.
+        
+            perceptualhash = ImageHashField(mode='phash', db_index=True)
+        
+        ... which is used unless another is named with field_name.
+        
+        """
+        from imagekit.perceptual import get_index, PERCEPTUAL_MODES
+        if field_name is None:
+            fields = [f.name for f in self.model._meta.fields
+                if isinstance(f, ImageHashField) and f.mode in PERCEPTUAL_MODES]
+            if not fields:
+                raise ImproperlyConfigured("%s has no perceptual ImageHashField for near_duplicates()" % (
+                    self.model.__name__))
+            field_name = fields[0]
+        value = getattr(obj, field_name, None)
+        if not value:
+            return []
+        pks = [pk for pk, distance in get_index(self.model, field_name).search(value, max_distance)
+            if pk != obj.pk]
+        objs = self.in_bulk(pks)
+        return [objs[pk] for pk in pks if pk in objs]
+    
+    @delegate
+    def similar_histograms(self, obj, k=20, metric='chisquare'):
+        """
+        The k images whose luma and RGB histograms are closest to obj's, closest first,
+        by 'chisquare', 'intersection' or 'emd' distance -- see imagekit.histindex.
+        Returns a list, as a queryset can't keep the ordering; images excluded by
+        this queryset's filters are left out, so there may be fewer than k.
+        
+        """
+        from imagekit.histindex import get_index
+        pks = [pk for pk, distance in get_index(self.model).similar(obj, k=k, metric=metric)]
+        objs = self.in_bulk(pks)
+        return [objs[pk] for pk in pks if pk in objs]
 
 class ImageWithMetadataManager(DelegateManager):
     __queryset__ = ImageWithMetadataQuerySet
@@ -777,6 +1247,13 @@ class ImageWithMetadata(ImageModel):
             if self.iccmodel:
                 sourceprofile = self.iccmodel
         
+        # an existing proof of this image with these profiles and intents is returned as-is
+        cached = Proof.objects.filter(content_type=self.content_type, object_id=self.pk).lookup(
+            self, proofprofile, sourceprofile=sourceprofile,
+            intent=kwargs.get('intent'), proofintent=kwargs.get('proofintent'))
+        if cached is not None:
+            return cached
+        
         proof = Proof(
             content_type=self.content_type,
             object_id=self.pk,
@@ -1,5 +1,7 @@
 # Imagekit options
+from django.conf import settings
 from imagekit import specs
+from django.db.models import signals
 from imagekit import signals as iksignals
 #from imagekit.utils import logg
 
@@ -18,7 +20,33 @@ class Options(object):
     
     save_count_as = None
     cache_filename_format = "%(filename)s_%(specname)s.%(extension)s"
+    
+    # With cache_keying = 'content', cached files are named by a hash of the
+    # source image hash (read from cache_source_hash_field) and the spec's
+    # processor fingerprint, instead of by cache_filename_format.
+    cache_keying = 'filename'
+    cache_content_format = "%(key)s.%(extension)s"
+    cache_source_hash_field = 'imagehash'
+    
+    # A SpecCacheBase instance remembering which cached files exist;
+    # None uses the default one configured by settings.IK_SPEC_CACHE.
+    spec_cache = None
     admin_thumbnail_spec = 'admin_thumbnail'
+    
+    # What a spec's url returns while another request is rendering its file:
+    # a URL, or a callable taking (instance, spec) that returns one. With the
+    # default of None, the request waits for the render to finish instead.
+    render_placeholder = None
+    
+    # With batch_metadata on, the ICC, EXIF, hash, color and histogram fields
+    # of an ImageWithMetadata don't each enqueue a signal when it's saved --
+    # one refresh_metadata job extracts all of them from a single decoded
+    # image, and stores them with one UPDATE. See refresh_metadata() below.
+    batch_metadata = getattr(settings, 'IK_BATCH_METADATA', True)
+    
+    # Moves this model's signals to other lanes than their own, e.g.
+    # { 'refresh_metadata': 'fast' } -- see imagekit.signals.
+    signal_lanes = {}
     spec_module = 'imagekit.defaults'
     
     def __init__(self, opts):
@@ -42,8 +70,14 @@ class Options(object):
         #logg.info('pre_cache() called: %s' % kwargs)
         instance = kwargs.get('instance', None)
         if instance:
-            for spec_name, spec in instance._ik.specs.items():
-                if spec.pre_cache and spec_name not in ('imagespec', 'spec', None):
+            spec_names = [spec_name for spec_name, spec in instance._ik.specs.items()
+                if spec.pre_cache and spec_name not in ('imagespec', 'spec', None)]
+            
+            if len(spec_names) > 1:
+                # one job renders them all from a single decode
+                iksignals.prepare_specs.send(sender=instance.__class__, instance=instance)
+            else:
+                for spec_name in spec_names:
                     self.prepare_spec(instance=instance, spec_name=spec_name)
     
     def delete_spec(self, **kwargs):
@@ -61,11 +95,38 @@ class Options(object):
         #spec = kwargs.get('spec', None)
         if instance and spec_name:
             prop = instance._ik._props.get(spec_name).accessor(instance, self.specs[spec_name])
-            if not instance._storage.exists(prop.name):
+            if not prop._exists():
                 iksignals.prepare_spec.send(sender=instance.__class__, instance=instance, spec_name=spec_name)
     
+    def remember_image_name(self, **kwargs):
+        instance = kwargs.get('instance', None)
+        if instance is not None:
+            instance._ik_image_name = getattr(instance, self.image_field).name
+    
+    def queue_metadata_refresh(self, **kwargs):
+        #logg.info('queue_metadata_refresh() called: %s' % kwargs)
+        from imagekit.modelfields import inserting
+        instance = kwargs.get('instance', None)
+        if instance and not kwargs.get('raw', False) and not inserting(instance):
+            if self.batch_metadata and self.metadata_fields(instance.__class__):
+                # a new image file (e.g. from save_image()) makes everything
+                # extracted from the old one stale, histograms included
+                name = getattr(instance, self.image_field).name
+                previous = getattr(instance, '_ik_image_name', None)
+                if previous and previous != name:
+                    iksignals.refresh_metadata.send(sender=instance.__class__, instance=instance, force=True)
+                else:
+                    iksignals.refresh_metadata.send(sender=instance.__class__, instance=instance)
+                instance._ik_image_name = name
+    
     def contribute_to_class(self, cls, name):
         self._props = {}
+        for signal_name, lane in self.signal_lanes.items():
+            if lane not in iksignals.LANES:
+                raise ValueError("Unknown signal lane '%s' for %s (must be one of: %s)" % (
+                    lane, signal_name, ', '.join(iksignals.LANES)))
+            getattr(iksignals, signal_name).routes[cls] = lane
+        
         for spec_name, spec in self.specs.items():
             if issubclass(spec, specs.ImageSpec):
                 prop = specs.FileDescriptor(spec)
@@ -85,8 +146,19 @@ class Options(object):
         iksignals.prepare_spec.connect(self.do_prepare_spec, sender=cls,
             dispatch_uid="imagekit-options-prepare-spec")
         
+        iksignals.prepare_specs.connect(self.do_prepare_specs, sender=cls,
+            dispatch_uid="imagekit-options-prepare-specs")
+        
         iksignals.delete_spec.connect(self.do_delete_spec, sender=cls,
             dispatch_uid="imagekit-options-delete-spec")
+        
+        iksignals.refresh_metadata.connect(self.do_refresh_metadata, sender=cls,
+            dispatch_uid="imagekit-options-refresh-metadata")
+        
+        signals.post_init.connect(self.remember_image_name, sender=cls,
+            dispatch_uid="imagekit-options-post-init")
+        signals.post_save.connect(self.queue_metadata_refresh, sender=cls,
+            dispatch_uid="imagekit-options-post-save")
     
     def do_delete_spec(self, **kwargs):
         instance = kwargs.get('instance', None)
@@ -103,4 +175,99 @@ class Options(object):
         prop = instance._ik._props.get(spec_name).accessor(instance, self.specs[spec_name])
         if prop is not None:
             prop._create()
-    
\ No newline at end of file
+    
+    def do_prepare_specs(self, **kwargs):
+        instance = kwargs.get('instance', None)
+        if instance is not None:
+            self.render_specs(instance, [spec_name for spec_name, spec in self.specs.items()
+                if spec.pre_cache and spec_name not in ('imagespec', 'spec', None)])
+    
+    def render_specs(self, instance, spec_names=None):
+        """
+        Render the named specs (all of them, by default) for an instance in
+        one batch -- see specs.SpecBatch. Returns the accessors that were saved.
+        
+        """
+        if spec_names is None:
+            spec_names = [spec_name for spec_name in self.specs.keys()
+                if spec_name not in ('imagespec', 'spec', None)]
+        batch = specs.SpecBatch(instance, [self.specs[spec_name] for spec_name in spec_names])
+        return batch.render()
+    
+    def spec_plan(self):
+        """ A specs.SpecPlan covering all of this model's ImageSpecs. """
+        return specs.SpecPlan([spec for spec_name, spec in sorted(self.specs.items())
+            if issubclass(spec, specs.ImageSpec) and spec_name not in ('imagespec', 'spec', None)])
+    
+    def do_refresh_metadata(self, **kwargs):
+        instance = kwargs.get('instance', None)
+        if instance is not None:
+            self.refresh_metadata(instance, force=bool(kwargs.get('force', False)))
+    
+    def metadata_fields(self, cls):
+        """ The fields of a model whose values are extracted from its image. """
+        from imagekit import modelfields
+        return [field for field in cls._meta.fields if isinstance(field, (
+            modelfields.ICCMetaField, modelfields.EXIFMetaField, modelfields.ImageHashField,
+            modelfields.RGBColorField, modelfields.Histogram))]
+    
+    def refresh_metadata(self, instance, force=False):
+        """
+        Run the extractor of every metadata field on an instance, then store all
+        of their values with one QuerySet.update(). The extractors all read the
+        instance's decoded image cache, so the image is decoded once for the lot
+        (see ImageModel._decoded()). Fields that already hold a value -- and
+        histograms already stored in their own tables -- are skipped unless
+        force=True, as they are when queued after the instance's image file has
+        been replaced. Returns the names of the fields that were updated.
+        
+        """
+        from imagekit import modelfields
+        refreshers = (
+            (modelfields.ICCMetaField,      'refresh_icc_data'),
+            (modelfields.EXIFMetaField,     'refresh_exif_data'),
+            (modelfields.ImageHashField,    'refresh_hash'),
+            (modelfields.RGBColorField,     'refresh_color'),
+        )
+        
+        cls = instance.__class__
+        updates = {}
+        histograms = []
+        
+        for field in self.metadata_fields(cls):
+            if isinstance(field, modelfields.Histogram):
+                histograms.append(field)
+                continue
+            if isinstance(field, modelfields.RGBColorField) and field.extractor is None:
+                continue
+            if getattr(instance, field.name, None) and not force:
+                continue
+            
+            names = [field.name]
+            if isinstance(field, modelfields.ICCMetaField) and field.hash_field:
+                names.append(field.hash_field)
+            before = [getattr(instance, name, None) for name in names]
+            
+            # called without the dequeue runmode kwargs, the refresh methods
+            # set the values on the instance and don't save it themselves
+            for fieldclass, refresher in refreshers:
+                if isinstance(field, fieldclass):
+                    getattr(field, refresher)(sender=cls, instance=instance)
+                    break
+            
+            for name, value in zip(names, before):
+                if getattr(instance, name, None) != value:
+                    updates[name] = getattr(instance, name, None)
+        
+        if updates and instance.pk is not None:
+            cls._default_manager.filter(pk=instance.pk).update(**updates)
+        updated = updates.keys()
+        
+        for field in histograms:
+            relation = getattr(instance, '_%s_histogram_relation' % field.original_colorspace.lower(), None)
+            if relation is not None and relation.exists() and not force:
+                continue
+            field.save_related_histogram(sender=cls, instance=instance)
+            updated.append(field.name)
+        
+        return sorted(updated)
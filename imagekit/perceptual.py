@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+perceptual.py
+
+Perceptual image hashes, and a multi-index hash table for finding near-duplicates by
+Hamming distance. See ImageHashField's 'mode' kwarg, and the near_duplicates() method
+of ImageWithMetadata's manager.
+
+The three hashes are the usual 64-bit ones, all computed from a small grayscale
+thumbnail -- which, for JPEGs, is decoded at a reduced scale with Image.draft():
+
+    'ahash'     -- 8x8 pixels, each bit set if the pixel is brighter than the mean
+    'dhash'     -- 9x8 pixels, each bit set if a pixel is brighter than its right-hand neighbor
+    'phash'     -- 32x32 pixels, DCT'd; the lowest 8x8 frequencies, each bit set if the
+                   coefficient is above their median (requires NumPy)
+
+Hashes are stored as 16-character hex strings.
+
+HashIndex splits each hash into 'segments' 16-bit pieces and keeps a dict for each.
+Two hashes within Hamming distance d must match to within d // segments bits in at
+least one piece, so a lookup only has to check the hashes filed under the few
+dict keys near each of the query's pieces -- not the whole table.
+
+Created by FI$H 2000 on 2011-09-01.
+Copyright (c) 2011 Objects In Space And Time, LLC. All rights reserved.
+
+"""
+import math, time, threading
+from itertools import combinations
+from django.conf import settings
+from imagekit.lib import Image
+from imagekit.utils import logg
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PERCEPTUAL_MODES = ('ahash', 'dhash', 'phash')
+HASH_BITS = 64
+
+def thumbnail(im, size):
+    """ Grayscale thumbnail of a (not yet loaded) PIL image, drafted down first where possible. """
+    if im.format == 'JPEG':
+        im.draft('L', (size[0] * 4, size[1] * 4))
+    return im.convert('L').resize(size, Image.ANTIALIAS)
+
+def bits_to_int(bits):
+    out = 0
+    for bit in bits:
+        out = (out << 1) | (bit and 1 or 0)
+    return out
+
+def ahash(im):
+    pixels = list(thumbnail(im, (8, 8)).getdata())
+    mean = sum(pixels) / float(len(pixels))
+    return bits_to_int([pixel > mean for pixel in pixels])
+
+def dhash(im):
+    pixels = list(thumbnail(im, (9, 8)).getdata())
+    return bits_to_int([pixels[row * 9 + col] > pixels[row * 9 + col + 1]
+        for row in xrange(8) for col in xrange(8)])
+
+_dct_matrix = []
+
+def dct_matrix(n=32):
+    """ The orthonormal DCT-II matrix, computed once. """
+    if not _dct_matrix:
+        matrix = numpy.zeros((n, n))
+        for k in xrange(n):
+            scale = math.sqrt((k == 0 and 1.0 or 2.0) / n)
+            for i in xrange(n):
+                matrix[k, i] = scale * math.cos(math.pi * (2 * i + 1) * k / (2.0 * n))
+        _dct_matrix.append(matrix)
+    return _dct_matrix[0]
+
+def phash(im):
+    if numpy is None:
+        raise TypeError("The 'phash' perceptual hash requires NumPy.")
+    pixels = numpy.array(thumbnail(im, (32, 32)).getdata(), dtype=numpy.float64).reshape((32, 32))
+    matrix = dct_matrix(32)
+    low = numpy.dot(numpy.dot(matrix, pixels), matrix.T)[:8, :8].flatten()
+    median = numpy.median(low[1:]) # the DC term would swamp it
+    return bits_to_int([coefficient > median for coefficient in low])
+
+HASHERS = { 'ahash': ahash, 'dhash': dhash, 'phash': phash, }
+
+def image_hash(im, mode='phash'):
+    """ Compute one of the perceptual hashes for a PIL image, as a hex string. """
+    return "%016x" % HASHERS[mode](im)
+
+def hamming(a, b):
+    """ Hamming distance between two hashes, given as ints or hex strings. """
+    if isinstance(a, basestring):
+        a = int(a, 16)
+    if isinstance(b, basestring):
+        b = int(b, 16)
+    return bin(a ^ b).count('1')
+
+
+class HashIndex(object):
+    """
+    Multi-index hash table over the perceptual hashes stored in one model field --
+    see the module notes above.
+    
+    """
+    def __init__(self, modl, field_name, segments=4):
+        self.modl = modl
+        self.field_name = field_name
+        self.segments = segments
+        self.segment_bits = HASH_BITS // segments
+        self._lock = threading.RLock()
+        self.built = None
+        self.clear()
+    
+    def clear(self):
+        with self._lock:
+            self.hashes = {}
+            self.tables = [dict() for segment in xrange(self.segments)]
+    
+    def __len__(self):
+        return len(self.hashes)
+    
+    def _pieces(self, value):
+        mask = (1 << self.segment_bits) - 1
+        return [(value >> (self.segment_bits * segment)) & mask for segment in xrange(self.segments)]
+    
+    def _variants(self, piece, radius):
+        """ Every value within 'radius' bits of a segment-sized piece. """
+        yield piece
+        for distance in xrange(1, radius + 1):
+            for flips in combinations(xrange(self.segment_bits), distance):
+                variant = piece
+                for bit in flips:
+                    variant ^= (1 << bit)
+                yield variant
+    
+    def add(self, pk, value):
+        if isinstance(value, basestring):
+            value = int(value, 16)
+        with self._lock:
+            self.remove(pk)
+            self.hashes[pk] = value
+            for segment, piece in enumerate(self._pieces(value)):
+                self.tables[segment].setdefault(piece, set()).add(pk)
+    
+    def remove(self, pk):
+        with self._lock:
+            value = self.hashes.pop(pk, None)
+            if value is not None:
+                for segment, piece in enumerate(self._pieces(value)):
+                    self.tables[segment].get(piece, set()).discard(pk)
+    
+    def build(self, chunk_size=10000):
+        """ (Re)build the index from the database, reading only pks and hashes. """
+        with self._lock:
+            self.clear()
+            rows = self.modl.objects.exclude(**{ "%s__isnull" % self.field_name: True }).exclude(
+                **{ self.field_name: '' }).order_by('pk').values_list('pk', self.field_name)
+            last_pk = None
+            while True:
+                chunk = rows
+                if last_pk is not None:
+                    chunk = chunk.filter(pk__gt=last_pk)
+                chunk = list(chunk[:chunk_size])
+                for pk, value in chunk:
+                    try:
+                        self.add(pk, value)
+                    except ValueError:
+                        pass # not a hex hash
+                    last_pk = pk
+                if len(chunk) < chunk_size:
+                    break
+            self.built = time.time()
+            logg.info("Built perceptual hash index for %s.%s: %s hashes" % (
+                self.modl.__name__, self.field_name, len(self.hashes)))
+    
+    def search(self, value, max_distance=6):
+        """ Return (pk, distance) pairs for every hash within max_distance of value, closest first. """
+        if isinstance(value, basestring):
+            value = int(value, 16)
+        radius = max_distance // self.segments
+        out = {}
+        with self._lock:
+            for segment, piece in enumerate(self._pieces(value)):
+                table = self.tables[segment]
+                for variant in self._variants(piece, radius):
+                    for pk in table.get(variant, ()):
+                        if pk not in out:
+                            distance = hamming(value, self.hashes[pk])
+                            if distance <= max_distance:
+                                out[pk] = distance
+        return sorted(out.items(), key=lambda item: (item[1], item[0]))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(modl, field_name, build=True):
+    """
+    Return the HashIndex for a model's perceptual hash field, building it the first time
+    it's asked for in this process. With build=False, returns None unless it's already built.
+    
+    Hashes saved or deleted in this process are filed in (or dropped from) the index as
+    it happens; to pick up those from other processes, it's rebuilt once it's older than
+    IK_PERCEPTUAL_INDEX_TTL seconds (600 by default -- None never rebuilds it).
+    
+    """
+    ttl = getattr(settings, 'IK_PERCEPTUAL_INDEX_TTL', 600)
+    with _indexes_lock:
+        index = _indexes.get((modl, field_name))
+        if build and (index is None or (ttl is not None and time.time() - index.built > ttl)):
+            if index is None:
+                index = HashIndex(modl, field_name)
+            index.build()
+            _indexes[(modl, field_name)] = index
+        return index
+
+def update_index(instance, field_name):
+    """ File an instance's new hash in its model's index, if this process has one built. """
+    index = get_index(instance.__class__, field_name, build=False)
+    if index is not None and instance.pk is not None:
+        value = getattr(instance, field_name, None)
+        if value:
+            index.add(instance.pk, value)
+        else:
+            index.remove(instance.pk)
+
+def remove_from_index(instance, field_name):
+    """ Drop a deleted instance from its model's index, if this process has one built. """
+    index = get_index(instance.__class__, field_name, build=False)
+    if index is not None and instance.pk is not None:
+        index.remove(instance.pk)
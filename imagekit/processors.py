@@ -25,18 +25,105 @@ Here's the latest list of supported PIL image modes:
     http://www.pythonware.com/library/pil/handbook/index.htm
 
 """
-import types
+import os, types, math, threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from django.conf import settings as django_settings
 from imagekit.lib import *
 from imagekit.neuquant import NeuQuant
 #from imagekit.stentiford import StentifordModel
 from imagekit.utils import logg, entropy
 from imagekit.utils.memoize import memoize
+from imagekit.utils.lru import LRUCache
 
 try:
     import numpy
 except ImportError:
     numpy = None
 
+def fingerprint_value(value):
+    """ Stable string representation of a processor setting, for fingerprinting. """
+    if hasattr(value, 'getIDString'):
+        # ICCProfile instances: the repr only shows descriptions
+        return "icc:%s" % value.getIDString()
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(["%r: %s" % (k, fingerprint_value(v)) for k, v in sorted(value.items())])
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join([fingerprint_value(v) for v in value])
+    return repr(value)
+
+_icc_pools = {}
+_icc_pools_lock = threading.Lock()
+
+def icc_pool(workers):
+    """
+    The thread pool icc_apply() converts strips in, one per size, made the first time
+    it's needed and kept for the life of the process. Pools are keyed on the process
+    ID as well, as a pool inherited by a forked child has no threads left in it.
+    
+    """
+    key = (os.getpid(), workers)
+    with _icc_pools_lock:
+        if key not in _icc_pools:
+            _icc_pools[key] = ThreadPool(workers)
+        return _icc_pools[key]
+
+def icc_apply(transformer, img, mode=None, strip_height=None, workers=None, min_pixels=None):
+    """
+    Apply an LCMS transform to a PIL image -- in horizontal strips, converted
+    by a pool of threads, if the image is big enough to make it worthwhile.
+    
+    LittleCMS releases the GIL while it converts pixels, so the strips convert
+    in parallel; each is pasted into an output image allocated up front, so only
+    one strip per thread is in flight besides the input and output images.
+    The threads are reused from call to call -- see icc_pool().
+    The defaults come from these settings:
+    
+        IK_ICC_TILE_HEIGHT          -- rows per strip (256)
+        IK_ICC_TILE_WORKERS         -- threads in the pool (the number of CPUs);
+                                       0 turns tiling off altogether
+        IK_ICC_TILE_MIN_PIXELS      -- smaller images are converted in one shot,
+                                       with transformer.apply() (4 megapixels)
+    
+    The 'mode' of the output image is the transform's output mode, unless given.
+    
+    """
+    if strip_height is None:
+        strip_height = getattr(django_settings, 'IK_ICC_TILE_HEIGHT', 256)
+    if workers is None:
+        workers = getattr(django_settings, 'IK_ICC_TILE_WORKERS', None)
+        if workers is None:
+            workers = cpu_count()
+    if min_pixels is None:
+        min_pixels = getattr(django_settings, 'IK_ICC_TILE_MIN_PIXELS', 4 * 10 ** 6)
+    
+    width, height = img.size
+    strip_height = max(1, int(strip_height))
+    if workers < 1 or width * height < min_pixels or height <= strip_height:
+        return transformer.apply(img)
+    
+    if mode is None:
+        mode = getattr(transformer, 'output_mode', None) or transformer.outputMode
+    
+    # the input is loaded before any threads get to it;
+    # crop() is lazy, and will load it again otherwise
+    img.load()
+    out = Image.new(mode, img.size)
+    boxes = [(0, top, width, min(top + strip_height, height)) for top in xrange(0, height, strip_height)]
+    
+    def convert(box):
+        strip = transformer.apply(img.crop(box))
+        out.paste(strip, box)
+        return box
+    
+    if workers == 1:
+        map(convert, boxes)
+    else:
+        icc_pool(workers).map(convert, boxes)
+    
+    return out
+
+
 class ExtInterceptor(type):
     
     do_not_intercept = (
@@ -53,14 +140,98 @@ class ImageProcessor(object):
     """
     __metaclass__ = ExtInterceptor
     
+    # class attributes named here are processor state, not settings,
+    # and are left out of the processor's fingerprint.
+    fingerprint_exclude = ()
+    
+    # True if running this processor on a downscaled copy of its input,
+    # then scaling up, would give (close enough to) the same result -- i.e. it
+    # works per-pixel or is purely geometric. Specs use this to decide how far
+    # ahead in the chain they can look for a Resize when drafting JPEGs.
+    draft_safe = False
+    
     @classmethod
     def process(cls, img, fmt, obj):
         return img, fmt
+    
+    @classmethod
+    def settings(cls):
+        """
+        Return a sorted list of (name, value) pairs for the public, non-callable
+        class attributes that configure this processor (inherited ones included).
+        
+        """
+        out = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in klass.__dict__.items():
+                if name.startswith('_') or name in cls.fingerprint_exclude or name == 'fingerprint_exclude':
+                    continue
+                if isinstance(value, (classmethod, staticmethod, property)) or callable(value):
+                    continue
+                out[name] = value
+        return sorted(out.items())
+    
+    @classmethod
+    def implementation(cls):
+        """
+        Return the class that actually implements process() for this processor --
+        e.g. processors.Resize for any Resize subclass that only changes settings.
+        
+        """
+        for klass in cls.__mro__:
+            if 'process' in klass.__dict__:
+                return klass
+        return cls
+    
+    @classmethod
+    def implementations(cls):
+        """
+        Return every class in this processor's MRO (below ImageProcessor) that
+        defines methods of its own -- process() or any helper it calls -- most
+        derived first. Subclasses that only change settings aren't included.
+        
+        """
+        out = []
+        for klass in cls.__mro__:
+            if klass in (ImageProcessor, object):
+                continue
+            for name, value in klass.__dict__.items():
+                if name.startswith('__') and name.endswith('__'):
+                    continue
+                if isinstance(value, (classmethod, staticmethod)) or isinstance(value, types.FunctionType):
+                    out.append(klass)
+                    break
+        return out or [cls.implementation()]
+    
+    @classmethod
+    def fingerprint(cls):
+        """
+        Canonical string identifying what this processor does: every class in its
+        MRO that implements behavior, plus the value of every setting. Two processors
+        with equal fingerprints produce the same output from the same input.
+        
+        Changing what a processor's code does doesn't change its fingerprint --
+        set (or bump) a 'version' class attribute when it does, so that outputs
+        cached by content key are rendered afresh.
+        
+        """
+        return "%s(%s)" % ("+".join(["%s.%s" % (impl.__module__, impl.__name__) for impl in cls.implementations()]),
+            ", ".join(["%s=%s" % (name, fingerprint_value(value)) for name, value in cls.settings()]))
+    
+    @classmethod
+    def instance_fingerprint(cls, obj):
+        """
+        Return a string describing whatever per-instance state (besides the
+        source image data) this processor reads from 'obj' -- or an empty string.
+        
+        """
+        return ''
 
 
 class Format(ImageProcessor):
     format = 'JPEG'
     extension = 'jpg'
+    draft_safe = True
     
     @classmethod
     def process(cls, img, fmt, obj):
@@ -95,6 +266,14 @@ class ICCProofTransform(ImageProcessor):
     RGB images sans ICC data will be treated as sRGB IEC61966-2.1 by default.
     Relative colorimetric is the default intent.
     
+    LCMS transforms are kept in 'transformers', an LRU cache keyed by TXID and
+    input mode, and shared by every subclass. It holds up to IK_ICC_TRANSFORM_CACHE_SIZE
+    transforms (64 by default), and if IK_ICC_TRANSFORM_CACHE_BYTES is set, no
+    more than that many bytes' worth of the profiles they were built from.
+    The transforms listed in IK_ICC_TRANSFORM_WARMUP can be built ahead of time,
+    when a worker starts -- see warmup(). Large images are converted a strip
+    at a time, in a pool of threads -- see icc_apply().
+    
     """
     source = None
     destination = None
@@ -104,7 +283,18 @@ class ICCProofTransform(ImageProcessor):
     mode = 'RGB' # for now
     intent = ImageCms.INTENT_RELATIVE_COLORIMETRIC
     proof_intent = ImageCms.INTENT_ABSOLUTE_COLORIMETRIC
-    transformers = {}
+    transformers = LRUCache(
+        maxsize=getattr(django_settings, 'IK_ICC_TRANSFORM_CACHE_SIZE', 64),
+        maxweight=getattr(django_settings, 'IK_ICC_TRANSFORM_CACHE_BYTES', None))
+    fingerprint_exclude = ('transformers', 'lastTXID')
+    draft_safe = True
+    
+    @classmethod
+    def instance_fingerprint(cls, obj):
+        # without an explicit source profile, the image's embedded one is used
+        if getattr(cls, 'source', None) is None:
+            return "icchash=%s" % getattr(obj, 'icchash', None)
+        return ''
     
     @classmethod
     def makeTXID(cls, srcID, destination, proof=None):
@@ -120,6 +310,100 @@ class ICCProofTransform(ImageProcessor):
             destination.getIDString(),
         )
     
+    @classmethod
+    def parseTXID(cls, TXID):
+        """ Split a TXID into its (source, proof, destination) ID strings; proof may be None. """
+        ids, _, destinationID = TXID.rpartition('>')
+        srcID, _, proofID = ids.partition(':')
+        return srcID, proofID or None, destinationID
+    
+    @classmethod
+    def build_transformer(cls, TXID, source, destination, proof=None, inmode='RGB'):
+        """ Build the LCMS transform for a TXID and keep it in the cache. """
+        if proof:
+            transformer = ImageCms.ImageCmsTransform(
+                source.lcmsinstance,
+                destination.lcmsinstance,
+                inmode,
+                cls.mode,
+                cls.intent,
+                proof=proof.lcmsinstance,
+                proof_intent=cls.proof_intent,
+            )
+        
+        else: # fall back to vanilla non-proof transform
+            transformer = ImageCms.ImageCmsTransform(
+                source.lcmsinstance,
+                destination.lcmsinstance,
+                inmode,
+                cls.mode,
+                cls.intent,
+            )
+        
+        cls.transformers.set((TXID, inmode), transformer,
+            weight=sum([len(profile.data) for profile in (source, destination, proof) if profile]))
+        return transformer
+    
+    @classmethod
+    def warmup(cls, TXIDs=None, profiles=()):
+        """
+        Build the transforms for a list of TXIDs -- by default, those listed in
+        IK_ICC_TRANSFORM_WARMUP -- so that they're ready before the first image
+        needs them. Each is either a TXID, built for RGB input, or a (TXID, mode)
+        pair for another input mode, e.g. ('...', 'CMYK'). Profiles are looked up
+        by ID string among those passed in, sRGB, the destination and proof profiles
+        of every ICC processor class, and (for any still missing) the stored
+        ICCModel profiles. Returns the number of transforms built.
+        
+        Nothing calls this by itself: call it where a worker starts up (ikflush's
+        worker processes do), rather than on the first image it converts.
+        
+        """
+        if TXIDs is None:
+            TXIDs = getattr(django_settings, 'IK_ICC_TRANSFORM_WARMUP', ())
+        if not TXIDs:
+            return 0
+        TXIDs = [isinstance(TXID, basestring) and (TXID, 'RGB') or tuple(TXID) for TXID in TXIDs]
+        
+        known = {}
+        def know(profile):
+            if profile and profile.getIDString():
+                known.setdefault(profile.getIDString(), profile)
+        
+        for profile in list(profiles) + [IK_sRGB]:
+            know(profile)
+        
+        klasses = [ImageProcessor]
+        while klasses:
+            klass = klasses.pop()
+            klasses.extend(klass.__subclasses__())
+            know(klass.__dict__.get('destination', None))
+            know(klass.__dict__.get('proof', None))
+        
+        wanted = set()
+        for TXID, inmode in TXIDs:
+            wanted.update([ID for ID in cls.parseTXID(TXID) if ID])
+        
+        if wanted - set(known.keys()):
+            from imagekit.models import ICCModel
+            for iccmodel in ICCModel.objects.exclude(icc__isnull=True).only('icc').iterator():
+                know(iccmodel.icc)
+                if not wanted - set(known.keys()):
+                    break
+        
+        built = 0
+        for TXID, inmode in TXIDs:
+            srcID, proofID, destinationID = cls.parseTXID(TXID)
+            if srcID in known and destinationID in known and (proofID is None or proofID in known):
+                cls.build_transformer(TXID, known[srcID], known[destinationID],
+                    proofID and known[proofID] or None, inmode=inmode)
+                built += 1
+            else:
+                logg.warning("*** Couldn't warm up ICC transform %s: not all of its profiles were found" % TXID)
+        
+        logg.info("Warmed up %s ICC transforms" % built)
+        return built
+    
     @classmethod
     def process(cls, img, fmt, obj, source=None, destination=None, proofing=True, TXID=None):
         if img.mode == "L":
@@ -144,37 +428,18 @@ class ICCProofTransform(ImageProcessor):
             logg.warning("ICCProofTransform.process() was invoked explicitly but without a specified proofing profile.")
             logg.warning("ICCProofTransform.process() executing as a non-proof transformation...")
         
-        if TXID is not None:
-            if TXID not in cls.transformers:
-                raise AttributeError("WTF: the TXID %s wasn't found in ICCProofTransform.transformers[].")
-        
-        else:
+        if TXID is None:
             TXID = cls.makeTXID(source.getIDString(), destination, cls.proof)
         
-        if TXID not in cls.transformers:
-            
-            if cls.proof:
-                cls.transformers[TXID] = ImageCms.ImageCmsTransform(
-                    source.lcmsinstance,
-                    destination.lcmsinstance,
-                    img.mode,
-                    cls.mode,
-                    cls.intent,
-                    proof=cls.proof.lcmsinstance,
-                    proof_intent=cls.proof_intent,
-                )
-            
-            else: # fall back to vanilla non-proof transform
-                cls.transformers[TXID] = ImageCms.ImageCmsTransform(
-                    source.lcmsinstance,
-                    destination.lcmsinstance,
-                    img.mode,
-                    cls.mode,
-                    cls.intent,
-                )
+        # the same profiles make a different transform for each input mode
+        transformer = cls.transformers.get((TXID, img.mode))
+        if transformer is None:
+            # with a TXID passed in, it may have been evicted since --
+            # so it's rebuilt from the profiles, like any other
+            transformer = cls.build_transformer(TXID, source, destination, cls.proof, inmode=img.mode)
         
         cls.lastTXID = TXID
-        return cls.transformers[TXID].apply(img), img.format
+        return icc_apply(transformer, img, mode=cls.mode), img.format
 
 
 class ICCTransform(ImageProcessor):
@@ -189,6 +454,13 @@ class ICCTransform(ImageProcessor):
     """
     source = None
     destination = None
+    draft_safe = True
+    
+    @classmethod
+    def instance_fingerprint(cls, obj):
+        if getattr(cls, 'source', None) is None:
+            return "icchash=%s" % getattr(obj, 'icchash', None)
+        return ''
     
     # ICCTransform.process() hands everything off to ICCProofTransform.process();
     # all it needs to do is set the kwarg proofing=False.
@@ -370,6 +642,36 @@ class Resize(ImageProcessor):
     crop = False
     upscale = False
     
+    @classmethod
+    def instance_fingerprint(cls, obj):
+        if cls.crop:
+            return "crop=%s,%s" % (
+                getattr(obj, obj._ik.crop_horz_field, 1),
+                getattr(obj, obj._ik.crop_vert_field, 1))
+        return ''
+    
+    @classmethod
+    def required_size(cls, size):
+        """
+        Smallest input size from which this Resize still yields its full-size
+        output, for an input of 'size' -- the input itself if we'd upscale.
+        
+        """
+        cur_width, cur_height = size
+        if cls.width is None and cls.height is None:
+            return size
+        if cls.crop and not cls.width is None and not cls.height is None:
+            ratio = max(float(cls.width)/cur_width, float(cls.height)/cur_height)
+        elif not cls.width is None and not cls.height is None:
+            ratio = min(float(cls.width)/cur_width, float(cls.height)/cur_height)
+        elif cls.width is None:
+            ratio = float(cls.height)/cur_height
+        else:
+            ratio = float(cls.width)/cur_width
+        if ratio >= 1.0:
+            return size
+        return (int(math.ceil(cur_width*ratio)), int(math.ceil(cur_height*ratio)))
+    
     @classmethod
     def process(cls, img, fmt, obj):
         cur_width, cur_height = img.size
@@ -528,6 +830,20 @@ class Transpose(ImageProcessor):
     }
     
     method = 'auto'
+    draft_safe = True
+    
+    @classmethod
+    def swaps_axes(cls):
+        """ Whether this transpose may exchange width and height. """
+        return cls.method in ('auto', 'ROTATE_90', 'ROTATE_270')
+    
+    @classmethod
+    def instance_fingerprint(cls, obj):
+        # the orientation tag isn't part of the pixel data; use the stored EXIF if we have it
+        if cls.method == 'auto':
+            exif = getattr(obj, 'exif', None) or {}
+            return "orientation=%s" % exif.get('Image Orientation', None)
+        return ''
     
     @classmethod
     def process(cls, img, fmt, obj):
@@ -16,63 +16,360 @@ with processor-laden ImageSpec definitions to be saved
 and edited without beachballing the client and melting
 the webserver.
 
+Most of the signals below are CoalescingSignals: while one of
+them is waiting in the queue for a given model instance (and
+any other arguments), sending it again for that instance is
+absorbed by the pending job instead of queueing a duplicate.
+The pending job reloads the instance when it runs, so it sees
+whatever the absorbed saves changed. Settings:
+
+    IK_SIGNAL_COALESCE_TIMEOUT  -- seconds a pending key lasts
+                                   if its job never runs (600)
+    IK_SIGNAL_DEBOUNCE          -- if a duplicate was absorbed
+                                   fewer than this many seconds
+                                   before a job is dequeued, the
+                                   job goes to the back of the
+                                   queue instead, so a burst of
+                                   saves is handled once (0, off)
+    IK_SIGNAL_DEBOUNCE_REQUEUES -- how many times a job can go
+                                   to the back of the queue that
+                                   way before it's run anyway (8);
+                                   each requeue waits a little
+                                   longer than the last, so a
+                                   worker with nothing else to do
+                                   doesn't spin on the one job
+    IK_SIGNAL_CACHE_ALIAS       -- the Django cache holding the
+                                   keys; it has to be shared by
+                                   every process that enqueues
+
+The signals mapped with ModelValueMapper carry a snapshot of
+the instance rather than its pk, so they aren't coalesced.
+
+Every signal also belongs to a lane: 'fast' for the derivative
+work that users are waiting on (rendering and deleting specs),
+'bulk' for metadata and histograms. IK_SIGNAL_LANES maps lanes
+to signalqueue queue names (keys of SQ_QUEUES), so each lane
+can have its own queue and workers:
+
+    IK_SIGNAL_LANES = {
+        'fast':     'imagekit-fast',
+        'bulk':     'imagekit-bulk',
+    }
+
+Lanes left out go to the 'default' queue. A model can move a
+signal to another lane with IKOptions.signal_lanes, e.g.
+{ 'refresh_metadata': 'fast' }. LANES is in priority order --
+dequeue() runs a job from the first lane that has one -- and
+lane_stats() reports each lane's depth, throughput and latency.
+
 Created by FI$H 2000 on 2011-10-01.
 Copyright (c) 2011 Objects In Space And Time, LLC. All rights reserved.
 
 
 """
+import hashlib, time
+from django.conf import settings
 from signalqueue import mappings
 from signalqueue.dispatcher import AsyncSignal
+from imagekit.utils import logg
+
+
+"""
+Lanes, highest priority first.
+
+"""
+LANES = ('fast', 'bulk')
+
+def lane_queue(lane):
+    """ The signalqueue queue name for a lane. """
+    return getattr(settings, 'IK_SIGNAL_LANES', {}).get(lane, 'default')
+
+def stats_cache():
+    from django.core.cache import get_cache, cache
+    alias = getattr(settings, 'IK_SIGNAL_CACHE_ALIAS', None)
+    return alias and get_cache(alias) or cache
+
+def _count(lane, counter, delta=1):
+    key = "imagekit-lane:%s:%s" % (lane, counter)
+    cache = stats_cache()
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, int(delta))
+    except ValueError:
+        # evicted in between
+        cache.set(key, int(delta), None)
+
 
+class LaneSignal(AsyncSignal):
+    """
+    AsyncSignal that enqueues onto the queue for its lane (or the lane its
+    sender was routed to) and keeps the lane's counters -- see the notes above.
+    
+    """
+    def __init__(self, providing_args=None, lane='bulk'):
+        self.lane = lane
+        self.routes = {}
+        super(LaneSignal, self).__init__(providing_args=providing_args)
+    
+    def lane_for(self, sender):
+        return self.routes.get(sender, self.lane)
+    
+    def queue_for(self, sender):
+        return lane_queue(self.lane_for(sender))
+    
+    def enqueue(self, sender, **named):
+        from signalqueue import SQ_RUNMODES as runmodes
+        if self.runmode == runmodes['SQ_SYNC']:
+            from signalqueue import SignalDispatchError
+            raise SignalDispatchError("enqueue() called in SQ_SYNC mode")
+        
+        from signalqueue.worker import queues
+        named['enqueued_at'] = time.time()
+        queued = queues[self.queue_for(sender)].enqueue(self, sender=sender, **named)
+        if queued is not None:
+            _count(self.lane_for(sender), 'enqueued')
+        return queued
+    
+    def send_now(self, sender, **named):
+        enqueued_at = named.pop('enqueued_at', None)
+        if named.get('dequeue_runmode', None) is not None:
+            lane = self.lane_for(sender)
+            _count(lane, 'dequeued')
+            if enqueued_at is not None:
+                latency = int(max(time.time() - float(enqueued_at), 0) * 1000)
+                _count(lane, 'latency_ms', latency)
+                cache = stats_cache()
+                if latency > (cache.get("imagekit-lane:%s:latency_max_ms" % lane) or 0):
+                    cache.set("imagekit-lane:%s:latency_max_ms" % lane, latency, None)
+        return super(LaneSignal, self).send_now(sender, **named)
 
-pre_cache = AsyncSignal(providing_args={
+
+def dequeue(lanes=LANES):
+    """
+    Dequeue and run one job from the first of the lanes that has one waiting.
+    Returns what the queue's dequeue() does, or (None, None) if they're all empty.
+    
+    """
+    from signalqueue.worker import queues
+    for lane in lanes:
+        queue = queues[lane_queue(lane)]
+        if queue.count() > 0:
+            queued_signal = queue.retrieve()
+            if queued_signal is None:
+                continue
+            try:
+                return queue.dequeue(queued_signal=queued_signal)
+            except Exception:
+                # e.g. the instance was deleted -- don't leave its pending key to
+                # absorb the next IK_SIGNAL_COALESCE_TIMEOUT seconds' worth of sends
+                release(queued_signal)
+                raise
+    return (None, None)
+
+def release(queued_signal):
+    """ Drop the pending key of a job that was dequeued but couldn't be run. """
+    import signalqueue
+    regkey, name = (queued_signal.get('signal') or { None: None }).items()[0]
+    for signal in signalqueue.SQ_DMV.get(regkey, ()):
+        if signal.name == name and isinstance(signal, CoalescingSignal):
+            key = signal.queued_key(queued_signal)
+            if key is not None:
+                signal.cache.delete(key)
+
+def lane_stats():
+    """
+    For each lane: its queue, the number of jobs waiting in it ('depth'), the
+    jobs enqueued and dequeued so far, and the mean and maximum time a job
+    spent in the queue, in milliseconds. Lanes sharing a queue report the same depth.
+    
+    """
+    from signalqueue.worker import queues
+    cache = stats_cache()
+    out = {}
+    for lane in LANES:
+        counters = dict([(counter, cache.get("imagekit-lane:%s:%s" % (lane, counter)) or 0)
+            for counter in ('enqueued', 'dequeued', 'latency_ms', 'latency_max_ms')])
+        out[lane] = {
+            'queue':            lane_queue(lane),
+            'depth':            queues[lane_queue(lane)].count(),
+            'enqueued':         counters['enqueued'],
+            'dequeued':         counters['dequeued'],
+            'latency_mean_ms':  counters['dequeued'] and counters['latency_ms'] / counters['dequeued'] or 0,
+            'latency_max_ms':   counters['latency_max_ms'],
+        }
+    return out
+
+
+class CoalescingSignal(LaneSignal):
+    """
+    AsyncSignal whose pending jobs absorb duplicates, keyed on
+    (signal, model, pk, other arguments) -- see the notes above.
+    
+    """
+    prefix = 'imagekit-signal'
+    
+    def __init__(self, providing_args=None, lane='bulk', coalesce_on='instance'):
+        self.coalesce_on = coalesce_on
+        super(CoalescingSignal, self).__init__(providing_args=providing_args, lane=lane)
+    
+    @property
+    def cache(self):
+        return stats_cache()
+    
+    ignored = ('dequeue_runmode', 'enqueue_runmode', 'enqueued_at', 'requeues')
+    
+    def _key(self, app_label, modl_name, pk, args):
+        return "%s:%s" % (self.prefix, hashlib.sha1(str((
+            self.regkey, self.name, app_label, modl_name, pk, args))).hexdigest())
+    
+    def coalescing_key(self, sender, **named):
+        """ The key for a signal call, or None if it can't be coalesced. """
+        instance = named.get(self.coalesce_on, None)
+        pk = getattr(instance, 'pk', None)
+        if pk is None:
+            return None
+        args = ["%s=%s" % (k, named[k]) for k in sorted(named.keys())
+            if k != self.coalesce_on and k not in self.ignored]
+        return self._key(instance._meta.app_label, instance.__class__.__name__.lower(), pk, args)
+    
+    def queued_key(self, queued_signal):
+        """ The key for a signal call, from its serialized form in the queue. """
+        ref = queued_signal.get(self.coalesce_on, None)
+        if not isinstance(ref, dict) or ref.get('obj_id', None) is None:
+            return None
+        try:
+            args = ["%s=%s" % (k, self.mapping.remap(queued_signal[k])) for k in sorted(queued_signal.keys())
+                if k not in ('signal', 'sender', self.coalesce_on) and k not in self.ignored]
+        except Exception:
+            return None
+        return self._key(ref.get('app_label'), ref.get('modl_name'), ref.get('obj_id'), args)
+    
+    def enqueue(self, sender, **named):
+        timeout = int(getattr(settings, 'IK_SIGNAL_COALESCE_TIMEOUT', 600))
+        key = timeout > 0 and self.coalescing_key(sender, **named) or None
+        
+        # the key holds (when the job was queued, when a duplicate was last absorbed)
+        if key is not None and not self.cache.add(key, (time.time(), None), timeout):
+            # a job is already pending -- note the time, for the debounce
+            pending = self.cache.get(key)
+            queued_at = isinstance(pending, (tuple, list)) and pending[0] or time.time()
+            self.cache.set(key, (queued_at, time.time()), timeout)
+            logg.info("~~~ Coalesced '%s' for %s %s into the pending job." % (
+                self.name, named[self.coalesce_on].__class__.__name__, named[self.coalesce_on].pk))
+            return None
+        
+        return super(CoalescingSignal, self).enqueue(sender, **named)
+    
+    def send_now(self, sender, **named):
+        requeues = int(named.pop('requeues', None) or 0)
+        
+        if named.get('dequeue_runmode', None) is not None:
+            key = self.coalescing_key(sender, **named)
+            
+            if key is not None:
+                debounce = float(getattr(settings, 'IK_SIGNAL_DEBOUNCE', 0))
+                limit = int(getattr(settings, 'IK_SIGNAL_DEBOUNCE_REQUEUES', 8))
+                pending = self.cache.get(key)
+                absorbed = isinstance(pending, (tuple, list)) and pending[1] or None
+                
+                if debounce > 0 and absorbed is not None and requeues < limit:
+                    remaining = debounce - (time.time() - absorbed)
+                    if remaining > 0:
+                        # back off before going round again, but no longer than the debounce has left
+                        time.sleep(min(remaining, 0.05 * 2 ** requeues))
+                        self.requeue(sender, requeues=requeues + 1, **named)
+                        return []
+                
+                # later sends should queue a new job
+                self.cache.delete(key)
+        
+        return super(CoalescingSignal, self).send_now(sender, **named)
+    
+    def requeue(self, sender, **named):
+        """
+        Push a dequeued call onto the back of its queue, with its original
+        enqueue_runmode -- the handlers compare it against the runmode they're
+        dequeued in, to decide whether to save -- and a count of its requeues.
+        
+        """
+        from signalqueue.worker import queues
+        from imagekit.utils.json import json
+        
+        queue_json = {
+            'signal': { self.regkey: self.name },
+            'enqueue_runmode': named.pop('enqueue_runmode', None) }
+        named.pop('dequeue_runmode', None)
+        
+        if sender is not None:
+            queue_json.update({
+                'sender': dict(
+                    app_label=sender._meta.app_label,
+                    modl_name=sender._meta.object_name.lower()) })
+        
+        for k, v in named.items():
+            queue_json.update({ k: self.mapping.demap(v), })
+        
+        queues[self.queue_for(sender)].push(json.dumps(queue_json))
+
+
+pre_cache = CoalescingSignal(lane='fast', providing_args={
     'instance':             mappings.ModelIDMapper,
 })
 
-clear_cache = AsyncSignal(providing_args={
+clear_cache = CoalescingSignal(lane='fast', providing_args={
     'instance':             mappings.ModelIDMapper,
 })
 
 
-prepare_spec = AsyncSignal(providing_args={
+prepare_spec = CoalescingSignal(lane='fast', providing_args={
     'instance':             mappings.ModelIDMapper,
     'spec_name':            mappings.LiteralValueMapper,
 })
 
-delete_spec = AsyncSignal(providing_args={
+prepare_specs = CoalescingSignal(lane='fast', providing_args={
+    'instance':             mappings.ModelIDMapper,
+})
+
+delete_spec = CoalescingSignal(lane='fast', providing_args={
     'instance':             mappings.ModelIDMapper, 
     'spec_name':            mappings.LiteralValueMapper,
 })
 
-refresh_hash = AsyncSignal(providing_args={
+refresh_hash = CoalescingSignal(providing_args={
     'instance':             mappings.ModelIDMapper,
 })
 
 
-refresh_color = AsyncSignal(providing_args={
+refresh_color = LaneSignal(providing_args={
     'instance':             mappings.ModelValueMapper,
 })
 
 
-refresh_icc_data = AsyncSignal(providing_args={
+refresh_icc_data = LaneSignal(providing_args={
     'instance':             mappings.ModelValueMapper,
 })
 
 
-refresh_exif_data = AsyncSignal(providing_args={
+refresh_exif_data = LaneSignal(providing_args={
     'instance':             mappings.ModelValueMapper,
 })
 
 
-save_related_histogram = AsyncSignal(providing_args={
+refresh_metadata = CoalescingSignal(providing_args={
+    'instance':             mappings.ModelIDMapper,
+    'force':                mappings.LiteralValueMapper,
+})
+
+
+save_related_histogram = CoalescingSignal(providing_args={
     'instance':             mappings.ModelIDMapper,
 })
 
-refresh_histogram_channel = AsyncSignal(providing_args={
+refresh_histogram_channel = LaneSignal(providing_args={
     'instance':             mappings.ModelIDMapper, 
     'channel_name':         mappings.LiteralValueMapper,
 })
 
-clear_histogram_channels = AsyncSignal(providing_args={
+clear_histogram_channels = LaneSignal(providing_args={
     'instance':             mappings.ModelIDMapper, 
 })
@@ -6,13 +6,14 @@ spec found.
 
 """
 
-import os, warnings
-from StringIO import StringIO
+import os, warnings, hashlib, math, tempfile, threading, time, uuid
 from imagekit import processors
 from imagekit.lib import *
 from imagekit import signals
-from imagekit.utils import img_to_fobj, logg
+from imagekit.utils import img_to_fobj, open_source, logg
+from imagekit.utils.lru import LRUCache
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.files.base import ContentFile
 from django.contrib.contenttypes.models import ContentType
@@ -28,6 +29,272 @@ else:
     else:
         matrixlike = (numpy.ndarray,)
 
+class SpecCacheBase(object):
+    """
+    Remembers which spec outputs exist in storage, along with their
+    width, height and format -- so that rendering a page full of thumbnails
+    doesn't cost one storage.exists() round-trip per thumbnail.
+    
+    Entries are keyed by the cached file's storage name; values are dicts
+    (possibly empty, if all we know is that the file exists). Only positive
+    results are cached -- a miss always falls through to the storage backend.
+    
+    """
+    def get(self, name):
+        raise NotImplementedError
+    
+    def set(self, name, meta):
+        raise NotImplementedError
+    
+    def delete(self, name):
+        raise NotImplementedError
+
+
+class LocalSpecCache(SpecCacheBase):
+    """
+    In-process LRU spec cache. Other processes can't tell it when they delete
+    or re-render a file, so entries only live for 'ttl' seconds -- this is only
+    exact for single-process deployments.
+    
+    """
+    
+    def __init__(self, maxsize=10000, ttl=30):
+        self._lru = LRUCache(maxsize=maxsize)
+        self.ttl = ttl
+    
+    def get(self, name):
+        entry = self._lru.get(name)
+        if entry is None:
+            return None
+        expires, meta = entry
+        if expires is not None and expires < time.time():
+            self._lru.delete(name)
+            return None
+        return meta
+    
+    def set(self, name, meta):
+        self._lru.set(name, (self.ttl is not None and time.time() + self.ttl or None, dict(meta)))
+    
+    def delete(self, name):
+        self._lru.delete(name)
+
+
+class DjangoSpecCache(SpecCacheBase):
+    """ Spec cache backed by Django's cache framework, shared between processes. """
+    
+    prefix = 'imagekit-spec'
+    
+    def __init__(self, alias=None, timeout=None):
+        from django.core.cache import get_cache, cache
+        self._cache = alias and get_cache(alias) or cache
+        self.timeout = timeout
+    
+    def _key(self, name):
+        # storage names can contain characters (and lengths) that memcached won't take
+        return "%s:%s" % (self.prefix, hashlib.sha1(str(name)).hexdigest())
+    
+    def get(self, name):
+        return self._cache.get(self._key(name))
+    
+    def set(self, name, meta):
+        self._cache.set(self._key(name), dict(meta), self.timeout)
+    
+    def delete(self, name):
+        self._cache.delete(self._key(name))
+
+
+_spec_cache = []
+
+def get_spec_cache():
+    """
+    Return the default spec cache, as configured by settings.IK_SPEC_CACHE:
+    'django' (the default) to use the Django cache (see IK_SPEC_CACHE_ALIAS and
+    IK_SPEC_CACHE_TIMEOUT), 'local' for an in-process LRU whose entries expire
+    after IK_SPEC_CACHE_TTL seconds (30), or None to disable. Only the Django
+    cache -- configured with a backend the processes share -- sees files deleted
+    by other processes straight away; 'local' is for single-process deployments.
+    
+    If the Django cache resolves to the local-memory or dummy backend -- which
+    the processes don't share -- the 'local' cache is used instead, so that
+    entries for files deleted elsewhere expire after IK_SPEC_CACHE_TTL seconds
+    rather than the Django cache's timeout.
+    
+    """
+    if not _spec_cache:
+        backend = getattr(settings, 'IK_SPEC_CACHE', 'django')
+        if backend == 'django':
+            from django.core.cache.backends.locmem import LocMemCache
+            from django.core.cache.backends.dummy import DummyCache
+            spec_cache = DjangoSpecCache(
+                alias=getattr(settings, 'IK_SPEC_CACHE_ALIAS', None),
+                timeout=getattr(settings, 'IK_SPEC_CACHE_TIMEOUT', None))
+            if isinstance(spec_cache._cache, (LocMemCache, DummyCache)):
+                logg.info("--- the Django cache isn't shared between processes, using the local spec cache")
+                backend = 'local'
+            else:
+                _spec_cache.append(spec_cache)
+        if backend == 'local':
+            _spec_cache.append(LocalSpecCache(
+                maxsize=getattr(settings, 'IK_SPEC_CACHE_SIZE', 10000),
+                ttl=getattr(settings, 'IK_SPEC_CACHE_TTL', 30)))
+        elif not _spec_cache:
+            _spec_cache.append(None)
+    return _spec_cache[0]
+
+
+class RenderLockBase(object):
+    """
+    Single-flight locks for rendering spec outputs, one per output file name,
+    so that concurrent requests for a missing file render it once between them.
+    Subclasses implement try_acquire() (returning a token, or None if the lock
+    is held elsewhere) and release().
+    
+    """
+    poll_interval = 0.05
+    
+    def try_acquire(self, name):
+        raise NotImplementedError
+    
+    def release(self, name, token):
+        raise NotImplementedError
+    
+    def acquire(self, name, blocking=True, timeout=None):
+        """ Return a token for the lock on 'name', or None if it couldn't be had in time. """
+        deadline = timeout is not None and time.time() + timeout or None
+        while True:
+            token = self.try_acquire(name)
+            if token is not None or not blocking:
+                return token
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+
+class LocalRenderLock(RenderLockBase):
+    """ In-process render locks -- the fallback, when nothing shared is available. """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._held = set()
+    
+    def try_acquire(self, name):
+        with self._lock:
+            if name in self._held:
+                return None
+            self._held.add(name)
+            return name
+    
+    def release(self, name, token):
+        with self._lock:
+            self._held.discard(name)
+
+
+class FileRenderLock(RenderLockBase):
+    """
+    Render locks held with flock() on lock files in a directory, shared by every
+    process on the machine -- the default for FileSystemStorage. The directory is
+    settings.IK_RENDER_LOCK_DIR, or 'imagekit-locks' in the system's temp directory.
+    
+    Names are hashed into a fixed set of lock stripes -- 256 files, at most -- rather
+    than getting a lock file each, which would leave one behind for every output
+    ever rendered. (Unlinking them on release instead would let a waiter lock a file
+    that's just been unlinked, while someone else locks its replacement.) Two names
+    sharing a stripe render one after the other.
+    
+    """
+    stripe_digits = 2
+    
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass # made in the meantime
+    
+    def _lockfile(self, name):
+        return os.path.join(self.path, "%s.lock" % hashlib.sha1(str(name)).hexdigest()[:self.stripe_digits])
+    
+    def try_acquire(self, name):
+        import fcntl
+        fd = os.open(self._lockfile(name), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return None
+        return fd
+    
+    def release(self, name, token):
+        import fcntl
+        try:
+            fcntl.flock(token, fcntl.LOCK_UN)
+        finally:
+            os.close(token)
+
+
+class DjangoRenderLock(RenderLockBase):
+    """
+    Render locks held as Django cache keys, shared between machines if the cache is.
+    A lock expires after 'expires' seconds, in case its holder dies with it.
+    
+    """
+    prefix = 'imagekit-render'
+    
+    def __init__(self, alias=None, expires=300):
+        from django.core.cache import get_cache, cache
+        self._cache = alias and get_cache(alias) or cache
+        self.expires = expires
+    
+    def _key(self, name):
+        return "%s:%s" % (self.prefix, hashlib.sha1(str(name)).hexdigest())
+    
+    def try_acquire(self, name):
+        token = uuid.uuid4().hex
+        if self._cache.add(self._key(name), token, self.expires):
+            return token
+        return None
+    
+    def release(self, name, token):
+        if self._cache.get(self._key(name)) == token:
+            self._cache.delete(self._key(name))
+
+
+_render_locks = {}
+_render_locks_lock = threading.Lock()
+
+def get_render_lock(storage):
+    """
+    Return the render lock for a storage, as configured by settings.IK_RENDER_LOCK:
+    'auto' (the default) for a FileRenderLock on FileSystemStorage (see IK_RENDER_LOCK_DIR)
+    and a LocalRenderLock otherwise; 'file', 'local', or 'django' (see IK_RENDER_LOCK_ALIAS); or a
+    RenderLockBase instance to use for everything.
+    
+    """
+    backend = getattr(settings, 'IK_RENDER_LOCK', 'auto')
+    if isinstance(backend, RenderLockBase):
+        return backend
+    
+    location = getattr(storage, 'location', None)
+    if backend in ('auto', 'file') and location:
+        key = ('file', os.path.abspath(getattr(settings, 'IK_RENDER_LOCK_DIR', None) or
+            os.path.join(tempfile.gettempdir(), 'imagekit-locks')))
+    elif backend == 'django':
+        key = ('django', getattr(settings, 'IK_RENDER_LOCK_ALIAS', None))
+    else:
+        key = ('local', None)
+    
+    with _render_locks_lock:
+        if key not in _render_locks:
+            if key[0] == 'file':
+                _render_locks[key] = FileRenderLock(key[1])
+            elif key[0] == 'django':
+                _render_locks[key] = DjangoRenderLock(alias=key[1])
+            else:
+                _render_locks[key] = LocalRenderLock()
+        return _render_locks[key]
+
+
 class Spec(object):
     pre_cache = False
     increment_count = False
@@ -37,6 +304,22 @@ class Spec(object):
     def name(cls):
         return getattr(cls, 'access_as', cls.__name__.lower())
     
+    @classmethod
+    def fingerprint(cls):
+        """
+        Canonical description of the spec's processor chain and every setting
+        that affects its output. Changing e.g. Resize.width changes the fingerprint.
+        
+        """
+        out = ["quality=%r" % getattr(cls, 'quality', None)]
+        out.extend([proc.fingerprint() for proc in cls.processors])
+        return " | ".join(out)
+    
+    @classmethod
+    def instance_fingerprint(cls, obj):
+        """ Per-instance state (crop fields, embedded profile, etc) read by the processors. """
+        return " | ".join([proc.instance_fingerprint(obj) for proc in cls.processors])
+    
     @classmethod
     def _process(cls, image, obj, procs):
         fmt = image.format
@@ -46,11 +329,88 @@ class Spec(object):
             img, fmt = proc.process(img, fmt, obj)
         return img, fmt
 
+def draft_scale(source_size, required_size, headroom=1.0):
+    """
+    Largest JPEG scale denominator that keeps 'source_size' at least
+    'headroom' times 'required_size' in both dimensions.
+    
+    """
+    for scale in (8, 4, 2):
+        if source_size[0] // scale >= required_size[0] * headroom and \
+           source_size[1] // scale >= required_size[1] * headroom:
+            return scale
+    return 1
+
+def draft(image, scale):
+    """ Have PIL decode a JPEG at 1/scale of its size, if scale > 1. """
+    if scale > 1:
+        # ask for exactly the scaled size, so that PIL versions that pick the
+        # scale from either the larger or the smaller ratio agree on it
+        image.draft(image.mode, (
+            int(math.ceil(image.size[0] / float(scale))),
+            int(math.ceil(image.size[1] / float(scale)))))
+    return image
+
+
 class ImageSpec(Spec):
     quality = 70
     
+    # decode JPEGs at no less than this multiple of the size the chain
+    # needs, leaving Resize some real pixels to antialias from
+    draft_headroom = 2.0
+    
+    @classmethod
+    def decode_size(cls, source_size):
+        """
+        Walk the processor chain up to its first Resize, and return the smallest
+        size the source can be decoded at without changing that Resize's output.
+        Returns None if something before it needs the full-resolution image.
+        
+        """
+        maybe_swapped = False
+        for proc in cls.processors:
+            if issubclass(proc, processors.Resize):
+                required = proc.required_size(source_size)
+                if maybe_swapped:
+                    # the Resize may see the source rotated; satisfy both orientations
+                    rw, rh = proc.required_size((source_size[1], source_size[0]))
+                    required = (max(required[0], rh), max(required[1], rw))
+                return required
+            if not getattr(proc, 'draft_safe', False):
+                return None
+            if issubclass(proc, processors.Transpose) and proc.swaps_axes():
+                maybe_swapped = True
+        return None
+    
+    @classmethod
+    def decode_scale(cls, source_size):
+        """
+        The JPEG DCT scaling denominator (1, 2, 4 or 8) to decode the source at:
+        the largest one that keeps the decoded image at least draft_headroom
+        times bigger than decode_size() in both dimensions.
+        
+        """
+        required = cls.decode_size(source_size)
+        if not required:
+            return 1
+        return draft_scale(source_size, required, cls.draft_headroom)
+    
+    @classmethod
+    def prepare(cls, image):
+        """
+        Configure a freshly opened (and not yet loaded) source image before
+        processing -- for JPEGs, this lets the decoder do DCT-domain scaling
+        down to 1/decode_scale() of the source, rather than decoding at full
+        resolution and throwing most of it away.
+        
+        """
+        if image.format == 'JPEG':
+            draft(image, cls.decode_scale(image.size))
+        return image
+    
     @classmethod
     def process(cls, image, obj):
+        cls.prepare(image)
         img, fmt = cls._process(image, obj, cls.processors)
         img.format = fmt
         return img, fmt
@@ -96,13 +456,14 @@ class MatrixAccessor(AccessorBase):
                 return
             # process the original image file
             try:
-                fp = self._obj._imgfield.storage.open(self._obj._imgfield.name)
+                fp = open_source(self._obj._imgfield.storage, self._obj._imgfield.name)
             except IOError:
                 return
             
-            fp.seek(0)
-            fp = StringIO(fp.read())
-            self._img, self._fmt = self.spec.process(Image.open(fp), self._obj)
+            try:
+                self._img, self._fmt = self.spec.process(Image.open(fp), self._obj)
+            finally:
+                fp.close()
             # save the output matrix
             self.data = self._get_matrixdata()
         
@@ -111,6 +472,21 @@ class MatrixAccessor(AccessorBase):
             if self._exists():
                 del self._data
     
+    def _shared(self):
+        """
+        Whether another instance may map to this content-addressed file -- that is,
+        whether one has the same source hash. If the hash isn't stored in a field
+        there's no telling, so the file is assumed to be shared.
+        
+        """
+        field = self._obj._ik.cache_source_hash_field
+        modl = self._obj.__class__
+        if field not in [f.name for f in modl._meta.fields]:
+            return True
+        return modl.objects.filter(**{
+            field: getattr(self._obj, field),
+        }).exclude(pk=self._obj.pk).exists()
+    
     def _exists(self):
         if self._obj._imgfield:
             if self.name:
@@ -137,6 +513,37 @@ class FileAccessor(AccessorBase):
     def __init__(self, obj, spec, **kwargs):
         super(FileAccessor, self).__init__(obj, spec, **kwargs)
     
+    @property
+    def _cache(self):
+        cache = getattr(self._obj._ik, 'spec_cache', None)
+        if cache is None:
+            return get_spec_cache()
+        return cache
+    
+    def _meta(self):
+        """ Whatever the spec cache knows about our output (a dict), or None. """
+        cache = self._cache
+        if cache is not None and self.name:
+            return cache.get(self.name)
+        return None
+    
+    def _remember(self, img=None, fmt=None):
+        cache = self._cache
+        if cache is not None and self.name:
+            meta = {}
+            if img is not None:
+                meta.update({
+                    'width': img.size[0],
+                    'height': img.size[1],
+                    'format': fmt or getattr(img, 'format', None),
+                })
+            cache.set(self.name, meta)
+    
+    def _forget(self):
+        cache = self._cache
+        if cache is not None and self.name:
+            cache.delete(self.name)
+    
     def _get_imgfile(self, format=None):
         if format is None:
             format = self._fmt and self._fmt or (self._img.format and self._img.format or 'JPEG')
@@ -154,32 +561,76 @@ class FileAccessor(AccessorBase):
                     imgfile = img_to_fobj(self._img, format, quality=70)
         return imgfile
     
-    def _create(self):
+    def _create(self, blocking=True):
+        """
+        Render and save the spec's output, if it doesn't exist yet. Only one caller
+        at a time renders a given output (see get_render_lock()) -- the others wait
+        for it, for up to IK_RENDER_LOCK_TIMEOUT seconds, or with blocking=False
+        return straight away. Returns True if the output exists afterwards.
+        
+        """
         if self._exists():
-            return
+            return True
         
         # we need a better answer for fucked images
         if not self.name:
-            return
+            return False
         
-        # process the original image file
-        try:
-            fp = self._obj._imgfield.storage.open(self._obj._imgfield.name)
-        except IOError:
-            return
+        lock = get_render_lock(self._obj._storage)
+        token = lock.acquire(self.name, blocking=blocking,
+            timeout=getattr(settings, 'IK_RENDER_LOCK_TIMEOUT', 30))
+        if token is None:
+            logg.info("--- waited out the render lock for %s" % self.name)
+            return bool(blocking and self._exists())
         
-        fp.seek(0)
-        fp = StringIO(fp.read())
-        self._img, self._fmt = self.spec.process(Image.open(fp), self._obj)
+        try:
+            # someone else may have rendered it while we waited
+            if self._obj._storage.exists(self.name):
+                self._remember()
+                return True
+            
+            # process the original image file
+            try:
+                fp = open_source(self._obj._imgfield.storage, self._obj._imgfield.name)
+            except IOError:
+                return False
+            
+            try:
+                self._img, self._fmt = self.spec.process(Image.open(fp), self._obj)
+            finally:
+                fp.close()
+            
+            self._save()
+            return True
         
-        # save the new image to the cache
+        finally:
+            lock.release(self.name, token)
+    
+    def _save(self):
+        """ Encode the processed image and save it to the cache. """
         logg.info("*** creating: %s" % self.name)
         content = ContentFile(self._get_imgfile(format=self._fmt).read())
         self._obj._storage.save(self.name, content)
+        self._remember(self._img, self._fmt)
     
     def _delete(self):
+        if self.key:
+            # a render from before the source hash was computed
+            leftover = self.unkeyed_name
+            if leftover and self._obj._storage.exists(leftover):
+                logg.info("*** deleting: %s" % leftover)
+                try:
+                    self._obj._storage.delete(leftover)
+                except (NotImplementedError, IOError), err:
+                    logg.info("--- exception thrown when deleting: %s" % err)
+        
         if self._exists():
+            if self.key and self._shared():
+                logg.info("~~~ not deleting content-addressed file: %s" % self.name)
+                return
+            
             logg.info("*** deleting: %s" % self.name)
+            self._forget()
             
             # error checks from https://github.com/jdriscoll/django-imagekit/commit/3e3302c7f794d0f417557d6ce912ebe9f6edb34f
             try:
@@ -188,13 +639,64 @@ class FileAccessor(AccessorBase):
                 logg.info("--- exception thrown when deleting: %s" % err)
                 return
     
+    def _shared(self):
+        """
+        Whether another instance may map to this content-addressed file -- that is,
+        whether one has the same source hash. If the hash isn't stored in a field
+        there's no telling, so the file is assumed to be shared.
+        
+        """
+        field = self._obj._ik.cache_source_hash_field
+        modl = self._obj.__class__
+        if field not in [f.name for f in modl._meta.fields]:
+            return True
+        return modl.objects.filter(**{
+            field: getattr(self._obj, field),
+        }).exclude(pk=self._obj.pk).exists()
+    
     def _exists(self):
         if self._obj._imgfield:
             if self.name:
-                return self._obj._storage.exists(self.name)
+                if self._meta() is not None:
+                    return True
+                exists = self._obj._storage.exists(self.name)
+                if exists:
+                    self._remember()
+                return exists
+    
+    @property
+    def key(self):
+        """
+        Content address for this spec's output: a sha1 of the source image hash
+        and the spec fingerprint. None unless the model's IKOptions ask for
+        cache_keying = 'content' and the source hash has been computed.
+        
+        """
+        if getattr(self._obj._ik, 'cache_keying', 'filename') != 'content':
+            return None
+        source_hash = getattr(self._obj, self._obj._ik.cache_source_hash_field, None)
+        if not source_hash:
+            return None
+        return hashlib.sha1("\n".join([
+            str(source_hash),
+            self.spec.fingerprint(),
+            self.spec.instance_fingerprint(self._obj),
+        ])).hexdigest()
     
     @property
     def name(self):
+        return self._name(self.key)
+    
+    @property
+    def unkeyed_name(self):
+        """
+        The name this spec's output has when it isn't content-addressed --
+        as it's rendered before the source hash is computed.
+        
+        """
+        return self._name(None)
+    
+    def _name(self, key):
         nn = self._obj._imgfield.name
         if nn:
             filepath, basename = os.path.split(str(nn))
@@ -204,11 +706,20 @@ class FileAccessor(AccessorBase):
                 if issubclass(processor, processors.Format):
                     extension = processor.extension
             
-            cache_filename = self._obj._ik.cache_filename_format % {
-                'filename': filename,
-                'specname': self.spec.name(),
-                'extension': extension.lstrip('.'),
-            }
+            if key:
+                # identical sources share one file, regardless of where they were uploaded
+                filepath = os.path.join(key[:2], key[2:4])
+                cache_filename = self._obj._ik.cache_content_format % {
+                    'key': key,
+                    'specname': self.spec.name(),
+                    'extension': extension.lstrip('.'),
+                }
+            else:
+                cache_filename = self._obj._ik.cache_filename_format % {
+                    'filename': filename,
+                    'specname': self.spec.name(),
+                    'extension': extension.lstrip('.'),
+                }
             
             if callable(self._obj._ik.cache_dir):
                 return self._obj._ik.cache_dir(self._obj, filepath, cache_filename)
@@ -217,7 +728,13 @@ class FileAccessor(AccessorBase):
     
     @property
     def url(self):
-        self._create()
+        placeholder = getattr(self._obj._ik, 'render_placeholder', None)
+        if placeholder is not None:
+            # don't hold up the request while someone else renders it
+            if not self._create(blocking=False):
+                return callable(placeholder) and placeholder(self._obj, self.spec) or placeholder
+        else:
+            self._create()
         
         '''
         if self.spec.increment_count:
@@ -233,11 +750,11 @@ class FileAccessor(AccessorBase):
     def view_url(self):
         from django.utils.importlib import import_module
         content_type = ContentType.objects.get_for_model(self._obj.__class__)
-        return reverse('imagekit:image_property',
+        return reverse('imagekit:derivative',
             current_app='imagekit',
             urlconf=import_module('imagekit.urls'),
             kwargs=dict(
-                prop_name=self.spec.name(),
+                spec_name=self.spec.name(),
                 app_label=content_type.app_label, modlcls=content_type.model, pk=self._obj.pk))
     
     @property
@@ -254,13 +771,220 @@ class FileAccessor(AccessorBase):
                 self._img = Image.open(self.file)
         return self._img
     
+    def _dimension(self, key, idx):
+        meta = self._meta()
+        if meta and meta.get(key) is not None:
+            return meta[key]
+        img = self.image
+        if self._exists():
+            self._remember(img, img.format)
+        return img.size[idx]
+    
     @property
     def width(self):
-        return self.image.size[0]
+        return self._dimension('width', 0)
     
     @property
     def height(self):
-        return self.image.size[1]
+        return self._dimension('height', 1)
+
+
+class PlanStep(object):
+    """
+    One node in a SpecPlan: a processor applied to its parent step's output.
+    Steps are identified by the fingerprints of every processor on the path
+    from the source down to them, so equal prefixes map to the same step.
+    
+    """
+    def __init__(self, processor=None, parent=None):
+        self.processor = processor
+        self.parent = parent
+        self.key = parent is not None and parent.key + (processor.fingerprint(),) or ()
+        self.children = []
+        self.specs = []
+    
+    @property
+    def depth(self):
+        return len(self.key)
+    
+    def __repr__(self):
+        if self.processor is None:
+            return "<PlanStep: source>"
+        return "<PlanStep: %s>" % self.key[-1]
+
+
+class SpecPlan(object):
+    """
+    Compiles a set of ImageSpecs into a DAG of processor steps, keyed by
+    (processor class, settings) -- see ImageProcessor.fingerprint() -- so a
+    prefix shared by several specs (e.g. Transpose, then Adjustment, then
+    differently-sized Resizes) is computed once.
+    
+    execute() runs the steps depth-first, and drops each intermediate image
+    as soon as the last step that needs it has run. describe() renders the
+    plan as text, along with how many processor invocations sharing saves.
+    
+    """
+    def __init__(self, specs):
+        self.specs = list(specs)
+        self.root = PlanStep()
+        self._steps = { (): self.root }
+        
+        for spec in self.specs:
+            step = self.root
+            for proc in spec.processors:
+                key = step.key + (proc.fingerprint(),)
+                if key not in self._steps:
+                    child = PlanStep(proc, step)
+                    step.children.append(child)
+                    self._steps[key] = child
+                step = self._steps[key]
+            step.specs.append(spec)
+    
+    @property
+    def steps(self):
+        """ All steps but the source, depth-first -- which is also execution order. """
+        out = []
+        stack = list(reversed(self.root.children))
+        while stack:
+            step = stack.pop()
+            out.append(step)
+            stack.extend(reversed(step.children))
+        return out
+    
+    @property
+    def invocations(self):
+        return len(self._steps) - 1
+    
+    @property
+    def naive_invocations(self):
+        return sum([len(spec.processors) for spec in self.specs])
+    
+    @property
+    def saved(self):
+        return self.naive_invocations - self.invocations
+    
+    def execute(self, img, fmt, obj):
+        """ Run the plan on a decoded source; return a dict of spec -> (img, fmt). """
+        out = {}
+        results = { self.root: (img, fmt) }
+        pending = dict([(step, len(step.children)) for step in self._steps.values()])
+        
+        for spec in self.root.specs:
+            out[spec] = results[self.root]
+        if not pending[self.root]:
+            del results[self.root]
+        
+        for step in self.steps:
+            parent_img, parent_fmt = results[step.parent]
+            results[step] = step.processor.process(parent_img, parent_fmt, obj)
+            
+            pending[step.parent] -= 1
+            if not pending[step.parent]:
+                # nothing downstream needs the parent's image any more
+                del results[step.parent]
+            
+            for spec in step.specs:
+                out[spec] = results[step]
+            if not pending[step]:
+                del results[step]
+        
+        return out
+    
+    def describe(self):
+        lines = ["%s specs, %s processor invocations (%s without sharing, %s saved)" % (
+            len(self.specs), self.invocations, self.naive_invocations, self.saved)]
+        lines.append("source%s" % self._describe_specs(self.root))
+        for step in self.steps:
+            lines.append("%s%s%s" % ("    " * step.depth, step.key[-1], self._describe_specs(step)))
+        return "\n".join(lines)
+    
+    def _describe_specs(self, step):
+        if step.specs:
+            return "  =>  %s" % ", ".join([spec.name() for spec in step.specs])
+        return ""
+
+
+class SpecBatch(object):
+    """
+    Renders several ImageSpecs for one instance from a single read and decode
+    of the source image.
+    
+    The specs are compiled into a SpecPlan, so that a common prefix -- e.g.
+    the [Transpose, Resize] at the start of two specs -- runs once and its
+    output is handed to each branch below it. The source is decoded at the
+    largest draft scale that every spec can live with. All outputs are
+    rendered first, and then saved to storage together.
+    
+    Specs whose output already exists are skipped. Processors are expected
+    to return new images rather than modifying their input in place, since
+    an intermediate image may feed more than one branch.
+    
+    """
+    def __init__(self, obj, specs):
+        self._obj = obj
+        self.accessors = [FileAccessor(obj, spec) for spec in specs
+            if issubclass(spec, ImageSpec)]
+        self.invocations = 0
+    
+    def missing(self):
+        return [accessor for accessor in self.accessors
+            if accessor.name and not accessor._exists()]
+    
+    def render(self):
+        """
+        Render and save every missing spec output; return the accessors that were saved.
+        Outputs whose render locks are held elsewhere are left to whoever holds them.
+        
+        """
+        lock = get_render_lock(self._obj._storage)
+        tokens = []
+        try:
+            accessors = []
+            for accessor in self.missing():
+                token = lock.acquire(accessor.name, blocking=False)
+                if token is not None:
+                    tokens.append((accessor.name, token))
+                    if not self._obj._storage.exists(accessor.name):
+                        accessors.append(accessor)
+            return self._render(accessors)
+        finally:
+            for name, token in tokens:
+                lock.release(name, token)
+    
+    def _render(self, accessors):
+        if not accessors:
+            return []
+        
+        try:
+            fp = open_source(self._obj._imgfield.storage, self._obj._imgfield.name)
+        except IOError:
+            return []
+        
+        plan = SpecPlan([accessor.spec for accessor in accessors])
+        self.invocations = plan.invocations
+        try:
+            image = Image.open(fp)
+            if image.format == 'JPEG':
+                draft(image, min([accessor.spec.decode_scale(image.size) for accessor in accessors]))
+            logg.info("Rendering %s specs from one decode (%s processor invocations saved): %s" % (
+                len(accessors), plan.saved, ", ".join([accessor.spec.name() for accessor in accessors])))
+            results = plan.execute(image.copy(), image.format, self._obj)
+        finally:
+            fp.close()
+        
+        formats = {}
+        for accessor in accessors:
+            img, fmt = results[accessor.spec]
+            if formats.setdefault(id(img), fmt) != fmt:
+                # e.g. [Resize] and [Resize, Format]: one image object, two formats
+                img = img.copy()
+            img.format = fmt
+            accessor._img, accessor._fmt = img, fmt
+        
+        for accessor in accessors:
+            accessor._save()
+        return accessors
 
 
 class DescriptorBase(object):
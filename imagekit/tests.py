@@ -72,10 +72,11 @@ from django.core.files.base import ContentFile
 from django.db import models
 
 from imagekit import processors
-from imagekit.models import ImageModel, ImageWithMetadata
+from imagekit.models import ImageModel, ImageWithMetadata, HistogramBase
+from imagekit.modelfields import HistogramChannelField, ImageHashField
 from imagekit.models import _storage
-from imagekit.specs import ImageSpec
-from imagekit.lib import Image, ICCProfile, IK_ROOT
+from imagekit.specs import ImageSpec, SpecBatch, SpecPlan, LocalSpecCache, get_spec_cache
+from imagekit.lib import Image, ImageCms, ICCProfile, IK_ROOT, IK_sRGB
 
 class ResizeToWidth(processors.Resize):
     width = 100
@@ -202,6 +203,19 @@ class TestImageM(ImageWithMetadata):
         storage = _storage
     
     image = models.ImageField(upload_to='testmimages', storage=_storage)
+    perceptualhash = ImageHashField(mode='phash', editable=True)
+
+
+class TestPackedHistogram(HistogramBase):
+    """
+    Histogram stored in both layouts, as while moving a table over with ikpackhistograms.
+    
+    """
+    class Meta:
+        app_label = 'imagekit'
+        db_table = 'imagekit_testpackedhistogram'
+    
+    L = HistogramChannelField(channel='L', layout='both')
 
 
 def get_image():
@@ -332,6 +346,72 @@ class IKTest(TestCase):
         self.assertEqual(self.p.image.width, self.p.iccproof.width)
         self.assertEqual(self.p.image.height, self.p.iccproof.height)
     
+    def test_icc_transform_cache(self):
+        from imagekit.utils.lru import LRUCache
+        lru = LRUCache(maxsize=3, maxweight=10)
+        lru.set('a', 1, weight=4)
+        lru.set('b', 2, weight=4)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3, weight=4) # over the weight budget: 'b' goes
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.stats()['evictions'], 1)
+        self.assertEqual(lru.stats()['weight'], 8)
+        self.assertEqual((lru.hits, lru.misses), (1, 1))
+        
+        # transforms can be built ahead of time from their TXIDs
+        transformers = processors.ICCProofTransform.transformers
+        TXID = processors.ICCProofTransform.makeTXID(
+            ProofICC.source.getIDString(), ProofICC.destination, ProofICC.proof)
+        transformers.delete((TXID, 'RGB'))
+        self.assertEqual(processors.ICCProofTransform.warmup([TXID]), 1)
+        self.assertTrue((TXID, 'RGB') in transformers)
+        
+        # ... for other input modes too, which are kept apart
+        transformers.delete((TXID, 'CMYK'))
+        self.assertEqual(processors.ICCProofTransform.warmup([(TXID, 'CMYK')]), 1)
+        self.assertTrue((TXID, 'CMYK') in transformers)
+        self.assertTrue(transformers.get((TXID, 'CMYK')) is not transformers.get((TXID, 'RGB')))
+    
+    def test_icc_tiled_apply(self):
+        img = Image.open(get_image()).convert('RGB').crop((0, 0, 400, 300))
+        transformer = ImageCms.ImageCmsTransform(
+            IK_sRGB.lcmsinstance, ProofICC.destination.lcmsinstance,
+            'RGB', 'RGB', ImageCms.INTENT_RELATIVE_COLORIMETRIC)
+        whole = transformer.apply(img)
+        
+        # uneven strips, more threads than strips, and no threads at all
+        for workers in (1, 4, 16):
+            tiled = processors.icc_apply(transformer, img, mode='RGB',
+                strip_height=7, workers=workers, min_pixels=0)
+            self.assertEqual(tiled.size, whole.size)
+            self.assertEqual(tiled.tostring(), whole.tostring())
+        
+        # small images are converted in one shot
+        self.assertEqual(processors.icc_apply(transformer, img, mode='RGB',
+            strip_height=7, workers=4, min_pixels=10 ** 6).tostring(), whole.tostring())
+        
+        # the pools are made once, and reused
+        self.assertTrue(processors.icc_pool(4) is processors.icc_pool(4))
+        self.assertTrue(processors.icc_pool(4) is not processors.icc_pool(16))
+    
+    def test_icc_profile_cache(self):
+        import pickle
+        profile = ICCProfile(os.path.join(IK_ROOT, "icc/sRGB-IEC61966-2-1.icc"))
+        ID = profile.getIDString()
+        data = profile.data
+        self.assertTrue(profile.data is data)
+        self.assertTrue(profile.lcmsinstance is profile.lcmsinstance)
+        
+        # replacing a tag means reassembling the data
+        profile.tags['cprt'] = profile.tags['cprt']
+        self.assertFalse(profile.data is data)
+        self.assertEqual(profile.data, data)
+        self.assertEqual(profile.getIDString(), ID)
+        
+        copied = ICCProfile(data)
+        copied.lcmsinstance
+        self.assertEqual(pickle.loads(pickle.dumps(copied)).getIDString(), ID)
+    
     def test_imagewithmetadata(self):
         pm = TestImageM()
         try:
@@ -405,6 +485,705 @@ class IKTest(TestCase):
             _storage.url(os.path.join(self.p._ik.cache_dir, self.p.image.name.replace('.jpeg', '_to_width.jpeg'))),
         )
     
+    def test_spec_fingerprint(self):
+        self.assertEqual(TestResizeToWidth.fingerprint(), TestResizeToWidth.fingerprint())
+        self.assertNotEqual(TestResizeToWidth.fingerprint(), TestResizeToHeight.fingerprint())
+        self.assertTrue('width=100' in ResizeToWidth.fingerprint())
+        
+        # overriding a helper, or bumping 'version', changes the fingerprint
+        class HelpedResize(ResizeToWidth):
+            @classmethod
+            def required_size(cls, size):
+                return size
+        class VersionedResize(ResizeToWidth):
+            version = 2
+        self.assertNotEqual(HelpedResize.fingerprint(), ResizeToWidth.fingerprint())
+        self.assertNotEqual(VersionedResize.fingerprint(), ResizeToWidth.fingerprint())
+    
+    def test_resize_required_size(self):
+        self.assertEqual(ResizeToWidth.required_size((800, 600)), (100, 75))
+        self.assertEqual(ResizeToWidth.required_size((50, 40)), (50, 40))
+        
+        # nothing to resize to, so nothing to draft down to
+        class Unsized(processors.Resize):
+            width = None
+            height = None
+        self.assertEqual(Unsized.required_size((800, 600)), (800, 600))
+        
+        # cropping to a single dimension only needs that dimension
+        class CroppedToWidth(processors.Resize):
+            width = 100
+            height = None
+            crop = True
+        self.assertEqual(CroppedToWidth.required_size((800, 600)), (100, 75))
+    
+    def test_iccupdate(self):
+        from imagekit.models import ICCModel
+        from imagekit.utils import icchash
+        from imagekit.utils import chunked
+        from imagekit.management.commands.iccupdate import update_icc_cache
+        pms = []
+        for name in ('icc1.jpg', 'icc2.jpg', 'icc3.jpg'):
+            pm = TestImageM()
+            img = self.generate_image()
+            pm.save_image(name, ContentFile(img.read()))
+            img.close()
+            pm.save()
+            pms.append(pm)
+        
+        objs = TestImageM.objects.filter(pk__in=[pm.pk for pm in pms])
+        self.assertEqual([obj.pk for obj in chunked(objs, 2)], sorted([pm.pk for pm in pms]))
+        
+        # a profile embedded in an image whose hash was never stored is still found
+        hsh = icchash(IK_sRGB)
+        ICCModel.objects.filter(icchash__iexact=hsh).delete()
+        TestImageM.objects.filter(pk=pms[0].pk).update(icc=IK_sRGB, icchash=None)
+        update_icc_cache(['imagekit'], { 'chunk_size': 1 })
+        self.assertEqual(ICCModel.objects.filter(icchash__iexact=hsh).count(), 1)
+        
+        # known hashes are matched regardless of case
+        TestImageM.objects.filter(pk=pms[1].pk).update(icc=IK_sRGB, icchash=hsh.upper())
+        update_icc_cache(['imagekit'], { 'chunk_size': 1 })
+        self.assertEqual(ICCModel.objects.filter(icchash__iexact=hsh).count(), 1)
+        
+        # a stale hash without the profile data is skipped, and the rest of the run goes on
+        TestImageM.objects.filter(pk=pms[2].pk).update(icc=None, icchash='0' * 32)
+        count = ICCModel.objects.count()
+        update_icc_cache(['imagekit'], { 'chunk_size': 1 })
+        self.assertEqual(ICCModel.objects.count(), count)
+        
+        for pm in pms:
+            pm.delete(clear_cache=True)
+    
+    def test_ikflush_workers(self):
+        from imagekit.management.commands import ikflush
+        extra = TestImage()
+        img = self.generate_image()
+        extra.save_image('flush.jpeg', ContentFile(img.read()))
+        img.close()
+        extra.save()
+        
+        objs = TestImage.objects.filter(pk__in=[self.p.pk, extra.pk])
+        self.assertEqual(list(ikflush.pk_ranges(objs, 1)), [
+            (self.p.pk, self.p.pk, 1), (extra.pk, extra.pk, 1)])
+        self.assertEqual(list(ikflush.pk_ranges(objs, 500)), [(self.p.pk, extra.pk, 2)])
+        
+        # outputs that already exist are skipped, unless the cache is cleared first
+        job = ('imagekit', 'TestImage', self.p.pk, self.p.pk, False, True)
+        low, high, count, rendered = ikflush.render_chunk(job)
+        self.assertEqual((low, high, count), (self.p.pk, self.p.pk, 1))
+        self.assertEqual(ikflush.render_chunk(job)[3], 0)
+        self.assertTrue(ikflush.render_chunk(job[:4] + (True, True))[3] > 0)
+        
+        path = os.path.join(tempfile.mkdtemp(), 'resume.json')
+        try:
+            self.assertEqual(ikflush.load_resume_state(path), {})
+            ikflush.save_resume_state(path, { 'imagekit.TestImage': extra.pk })
+            self.assertEqual(ikflush.load_resume_state(path), { 'imagekit.TestImage': extra.pk })
+            self.assertFalse(os.path.exists("%s.tmp" % path))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        extra.delete(clear_cache=True)
+    
+    def test_collect_garbage(self):
+        from imagekit.management.commands.ikgc import collect_garbage
+        TestImageM._ik.cache_keying = 'content'
+        try:
+            pm = TestImageM()
+            img = self.generate_image()
+            pm.save_image('gctest.jpg', ContentFile(img.read()))
+            img.close()
+            pm = TestImageM.objects.get(pk=pm.pk)
+            self.assertTrue(pm.imagehash)
+            
+            # rendered under the filename, before the imagehash landed
+            leftover = pm.to_width.unkeyed_name
+            _storage.save(leftover, ContentFile('yo'))
+            pm.to_width.url
+            live = pm.to_width.name
+            self.assertNotEqual(live, leftover)
+            orphan = os.path.join(TestImageM._ik.cache_dir, 'ab', 'cd', 'abcd%s.jpeg' % ('0' * 36))
+            _storage.save(orphan, ContentFile('yo'))
+            
+            self.assertEqual(collect_garbage([], { 'min_age': 0, 'dry_run': True }), 0)
+            self.assertTrue(_storage.exists(orphan))
+            self.assertTrue(_storage.exists(leftover))
+            
+            self.assertEqual(collect_garbage([], { 'min_age': 0 }), 2)
+            self.assertFalse(_storage.exists(orphan))
+            self.assertFalse(_storage.exists(leftover))
+            self.assertTrue(_storage.exists(live))
+            
+            # no other instance has the same imagehash, so clearing the cache deletes it
+            pm.clear_cache()
+            self.assertFalse(_storage.exists(live))
+            pm.delete(clear_cache=True)
+        finally:
+            TestImageM._ik.cache_keying = 'filename'
+    
+    def test_content_addressed_name(self):
+        self.p._ik.cache_keying = 'content'
+        try:
+            self.p.imagehash = 'yo-dogg'
+            key = self.p.to_width.key
+            self.assertTrue(key is not None)
+            self.assertTrue(self.p.to_width.name.endswith('%s.jpeg' % key))
+            self.assertNotEqual(key, self.p.to_height.key)
+            
+            # different source data, different key
+            self.p.imagehash = 'i-heard-you-like-hashes'
+            self.assertNotEqual(key, self.p.to_width.key)
+        finally:
+            self.p._ik.cache_keying = 'filename'
+            del self.p.imagehash
+    
+    def test_spec_cache(self):
+        cache = LocalSpecCache(maxsize=2)
+        cache.set('a', dict(width=1))
+        cache.set('b', {})
+        cache.set('c', {})
+        self.assertTrue(cache.get('a') is None)
+        self.assertEqual(cache.get('b'), {})
+        
+        # entries expire, as other processes may have deleted their files since
+        cache = LocalSpecCache(ttl=-1)
+        cache.set('a', {})
+        self.assertTrue(cache.get('a') is None)
+        
+        cache = get_spec_cache()
+        if cache is not None:
+            width = self.p.to_width.width
+            self.assertEqual(cache.get(self.p.to_width.name).get('width'), width)
+            self.p.to_width._delete()
+            self.assertTrue(cache.get(self.p.to_width.name) is None)
+        
+        # the test settings leave the Django cache on local memory, which isn't shared
+        from imagekit import specs
+        configured = specs._spec_cache[:]
+        try:
+            del specs._spec_cache[:]
+            with self.settings(IK_SPEC_CACHE='django'):
+                self.assertTrue(isinstance(get_spec_cache(), LocalSpecCache))
+        finally:
+            specs._spec_cache[:] = configured
+    
+    def test_open_source(self):
+        from imagekit.utils import open_source
+        fp = open_source(_storage, self.p.image.name)
+        self.assertEqual(Image.open(fp).size, (800, 600))
+        fp.close()
+        
+        # draft decoding can't change the output size
+        self.assertEqual(self.p.to_width.width, 100)
+    
+    def test_decode_scale(self):
+        self.assertEqual(TestResizeToWidth.decode_size((800, 600)), (100, 75))
+        self.assertTrue(TestTrimmer.decode_size((800, 600)) is None)
+        self.assertEqual(TestResizeToWidth.decode_scale((800, 600)), 4)
+        self.assertEqual(TestResizeToWidth.decode_scale((3200, 2400)), 8)
+        self.assertEqual(TestSmarterCropped.decode_scale((3200, 2400)), 1)
+    
+    def test_spec_batch(self):
+        batch = SpecBatch(self.p, [TestResizeToHeight, TestSmartCropped])
+        self.assertEqual(len(batch.render()), 2)
+        
+        # ResizeToHeight runs once, for both specs
+        self.assertEqual(batch.invocations, 2)
+        self.assertEqual(self.p.to_height.height, 100)
+        self.assertEqual(self.p.smartcropped.width, 100)
+        
+        # nothing left to render
+        self.assertEqual(SpecBatch(self.p, [TestResizeToHeight]).render(), [])
+    
+    def test_render_lock(self):
+        from imagekit.specs import LocalRenderLock, get_render_lock
+        lock = LocalRenderLock()
+        token = lock.acquire('test.jpg')
+        self.assertTrue(token is not None)
+        self.assertTrue(lock.acquire('test.jpg', blocking=False) is None)
+        self.assertTrue(lock.acquire('test.jpg', timeout=0.1) is None)
+        lock.release('test.jpg', token)
+        self.assertTrue(lock.acquire('test.jpg', blocking=False) is not None)
+        
+        # while another holds the lock, the output isn't rendered
+        name = self.p.to_width.name
+        lock = get_render_lock(self.p._storage)
+        token = lock.acquire(name)
+        self.assertFalse(self.p.to_width._create(blocking=False))
+        self.failIf(self.p._storage.exists(name))
+        lock.release(name, token)
+        self.assertTrue(self.p.to_width._create(blocking=False))
+    
+    def test_file_render_lock(self):
+        import threading
+        from imagekit.specs import FileRenderLock
+        path = tempfile.mkdtemp()
+        try:
+            lock = FileRenderLock(path)
+            token = lock.acquire('test.jpg')
+            self.assertTrue(token is not None)
+            
+            # flock() contends between open files, so another thread waits just as another process would
+            contender = []
+            thread = threading.Thread(target=lambda: contender.append(lock.acquire('test.jpg', timeout=0.2)))
+            thread.start()
+            thread.join()
+            self.assertEqual(contender, [None])
+            lock.release('test.jpg', token)
+            token = lock.acquire('test.jpg', blocking=False)
+            self.assertTrue(token is not None)
+            lock.release('test.jpg', token)
+            
+            # lock files are striped, not made one per name
+            for idx in xrange(1000):
+                lock.release('%s.jpg' % idx, lock.acquire('%s.jpg' % idx))
+            self.assertTrue(len(os.listdir(path)) <= 256)
+        finally:
+            shutil.rmtree(path)
+    
+    def test_render_placeholder(self):
+        from imagekit.specs import get_render_lock
+        name = self.p.to_width.name
+        lock = get_render_lock(self.p._storage)
+        self.failIf(self.p._storage.location in lock.path)
+        
+        try:
+            # while the output is being rendered elsewhere, url returns the placeholder
+            token = lock.acquire(name)
+            self.p._ik.render_placeholder = '/static/rendering.png'
+            self.assertEqual(self.p.to_width.url, '/static/rendering.png')
+            self.p._ik.render_placeholder = lambda instance, spec: '/static/%s.png' % spec.name()
+            self.assertEqual(self.p.to_width.url, '/static/%s.png' % self.p.to_width.spec.name())
+            self.failIf(self.p._storage.exists(name))
+            
+            # ... and the real thing once it's free
+            lock.release(name, token)
+            self.assertEqual(self.p.to_width.url, self.p._storage.url(name))
+            self.assertTrue(self.p._storage.exists(name))
+        finally:
+            self.p._ik.render_placeholder = None
+    
+    def test_histogram_channels(self):
+        from imagekit.utils import histogram_channels
+        img = self.p.pilimage.convert('RGB')
+        channels = histogram_channels(img)
+        self.assertEqual(sorted(channels.keys()), ['B', 'G', 'L', 'R'])
+        self.assertEqual(channels['G'], img.split()[1].histogram())
+        self.assertEqual(channels['L'], img.convert('L').histogram())
+        
+        # computed once per instance
+        self.assertTrue(self.p.histogram_channels() is self.p.histogram_channels())
+    
+    def test_decoded_cache(self):
+        rgb = self.p.pilimage_as('RGB')
+        self.assertEqual(rgb.mode, 'RGB')
+        self.assertTrue(self.p.pilimage_as('RGB') is rgb)
+        self.assertTrue(self.p.pilimage_as('L') is self.p.pilimage_as('L'))
+        self.assertTrue(max(self.p.analysis_image(64).size) <= 64)
+        
+        # a new image means a new decode
+        img = self.generate_image()
+        self.p.save_image('test2.jpeg', ContentFile(img.read()))
+        img.close()
+        self.assertFalse(self.p.pilimage_as('RGB') is rgb)
+    
+    def test_colorstats(self):
+        from imagekit.colorstats import ColorStats
+        img = self.p.pilimage.convert('RGB').resize((64, 48))
+        stats = ColorStats(img)
+        colors = img.getcolors(64 * 48)
+        
+        self.assertEqual(len(stats), len(colors))
+        self.assertEqual(sum(stats.counts), 64 * 48)
+        self.assertEqual(stats.median[0], max(colors)[0])
+        self.assertEqual([count for count, color in stats.top(5)],
+            sorted([count for count, color in colors], reverse=True)[:5])
+        self.assertTrue(stats.most_saturated(5) in [color for count, color in stats.top(5)])
+    
+    def test_refresh_metadata(self):
+        pm = TestImageM()
+        img = self.generate_image()
+        pm.save_image('mtest.jpg', ContentFile(img.read()))
+        img.close()
+        pm.save()
+        
+        fresh = TestImageM.objects.get(pk=pm.pk)
+        fresh.imagehash = fresh.dominantcolor = None
+        updated = fresh._ik.refresh_metadata(fresh)
+        self.assertTrue('imagehash' in updated)
+        self.assertTrue('dominantcolor' in updated)
+        
+        stored = TestImageM.objects.get(pk=pm.pk)
+        self.assertEqual(stored.imagehash, fresh.imagehash)
+        self.assertEqual(stored.perceptualhash, fresh.perceptualhash)
+        self.assertTrue(stored.dominantcolor)
+        
+        # recomputed values that come out the same aren't reported, or written
+        self.assertFalse('imagehash' in stored._ik.refresh_metadata(stored, force=True))
+        pm.delete(clear_cache=True)
+    
+    def test_refresh_metadata_replaced_image(self):
+        pm = TestImageM()
+        img = self.generate_image() # black
+        pm.save_image('rtest.jpg', ContentFile(img.read()))
+        img.close()
+        before = TestImageM.objects.get(pk=pm.pk)
+        self.assertTrue(before.histogram_luma.L[0] > 0)
+        
+        # a new image file brings new histograms, though the old ones are stored
+        tmp = tempfile.TemporaryFile()
+        Image.new('RGB', (800, 600), (255, 255, 255)).save(tmp, 'JPEG')
+        tmp.seek(0)
+        pm.save_image('rtest-white.jpg', ContentFile(tmp.read()))
+        tmp.close()
+        
+        after = TestImageM.objects.get(pk=pm.pk)
+        self.assertNotEqual(after.imagehash, before.imagehash)
+        self.assertEqual(after.histogram_luma.L[0], 0)
+        self.assertTrue(after.histogram_luma.L[255] > 0)
+        pm.delete(clear_cache=True)
+    
+    def test_refresh_metadata_once(self):
+        from imagekit import signals as iksignals
+        sent = []
+        def count(**kwargs):
+            sent.append(kwargs.get('instance').pk)
+        iksignals.refresh_metadata.connect(count, sender=TestImageM, dispatch_uid='test-refresh-metadata-once')
+        
+        try:
+            # saving the image inserts the new instance, sending post_save twice
+            pm = TestImageM()
+            img = self.generate_image()
+            pm.save_image('oncetest.jpg', ContentFile(img.read()))
+            img.close()
+            self.assertEqual(sent, [pm.pk])
+        finally:
+            iksignals.refresh_metadata.disconnect(dispatch_uid='test-refresh-metadata-once', sender=TestImageM)
+        
+        # stored histograms are left alone unless forced
+        fresh = TestImageM.objects.get(pk=pm.pk)
+        self.assertTrue(fresh._luma_histogram_relation.exists())
+        self.assertFalse('histogram_luma' in fresh._ik.refresh_metadata(fresh))
+        self.assertTrue('histogram_luma' in fresh._ik.refresh_metadata(fresh, force=True))
+        pm.delete(clear_cache=True)
+    
+    def test_proofimages(self):
+        from imagekit.models import ICCModel, Proof
+        pm = TestImageM()
+        img = self.generate_image()
+        pm.save_image('ptest.jpg', ContentFile(img.read()))
+        img.close()
+        pm.save()
+        
+        proofprofile = ICCModel()
+        proofprofile.iccfile.save('proof-sRGB.icc', ContentFile(IK_sRGB.data))
+        proofprofile.save()
+        
+        proofs = TestImageM.objects.filter(pk=pm.pk).proofimages(proofprofile, workers=2)
+        self.assertEqual(len(proofs), 1)
+        self.assertEqual((proofs[0].w, proofs[0].h), (pm.image.width, pm.image.height))
+        self.assertEqual(Proof.objects.filter(object_id=pm.pk, proofprofile=proofprofile).count(), 1)
+        
+        # images that have already been proofed are skipped
+        self.assertEqual(TestImageM.objects.filter(pk=pm.pk).proofimages(proofprofile), [])
+        pm.delete(clear_cache=True)
+    
+    def test_proof_cache(self):
+        from imagekit.models import ICCModel, Proof
+        pms = []
+        for name in ('pcache1.jpg', 'pcache2.jpg'):
+            pm = TestImageM()
+            img = self.generate_image() # the same pixels, twice
+            pm.save_image(name, ContentFile(img.read()))
+            img.close()
+            pm.save()
+            pm._ik.refresh_metadata(pm, force=True)
+            pms.append(pm)
+        
+        proofprofile = ICCModel()
+        proofprofile.iccfile.save('proof-cache-sRGB.icc', ContentFile(IK_sRGB.data))
+        proofprofile.save()
+        
+        proof = pms[0].proofimage(proofprofile).generate(source=pms[0])
+        self.assertTrue(proof.proofkey)
+        self.assertEqual(Proof.objects.lookup(pms[1], proofprofile).pk, proof.pk)
+        self.assertEqual(pms[0].proofimage(proofprofile).pk, proof.pk)
+        
+        # the second image's proof is a cache hit, and shares the first one's file
+        other = pms[1].proofimage(proofprofile).generate(source=pms[1])
+        self.assertNotEqual(other.pk, proof.pk)
+        self.assertEqual(other.proofkey, proof.proofkey)
+        self.assertEqual(other.image.name, proof.image.name)
+        
+        # replacing the second image's proof leaves the file the first one still uses
+        storage = Proof._meta.get_field('image').storage
+        replaced = TestImageM.objects.filter(pk=pms[1].pk).proofimages(proofprofile, replace=True)
+        self.assertEqual(len(replaced), 1)
+        self.assertEqual(replaced[0].image.name, proof.image.name)
+        self.assertTrue(storage.exists(proof.image.name))
+        
+        # lookup() and compute_proofkey() fall back to the same source profile
+        from imagekit.utils import icchash
+        pms[1].icchash = 'ab' * 20 # not a stored ICCModel
+        self.assertEqual(Proof.source_hash(pms[1]), icchash(IK_sRGB))
+        self.assertEqual(Proof.source_hash(pms[1], proofprofile), proofprofile.icchash)
+        
+        # proofs saved differently are keyed apart
+        self.assertEqual(Proof.proof_encoding(pms[0]), ('JPEG', Proof.proofquality))
+        key = Proof.make_proofkey('a', 'b', 'c', 0, 1, None, 'JPEG', 75)
+        self.assertNotEqual(key, Proof.make_proofkey('a', 'b', 'c', 0, 1, None, 'PNG', 75))
+        self.assertNotEqual(key, Proof.make_proofkey('a', 'b', 'c', 0, 1, None, 'JPEG', 90))
+        
+        for pm in pms:
+            pm.delete(clear_cache=True)
+    
+    def test_signal_coalescing(self):
+        from imagekit import signals as iksignals
+        key = iksignals.refresh_metadata.coalescing_key(TestImage, instance=self.p)
+        self.assertEqual(key, iksignals.refresh_metadata.coalescing_key(TestImage,
+            instance=TestImage.objects.get(pk=self.p.pk)))
+        self.assertNotEqual(key, iksignals.refresh_hash.coalescing_key(TestImage, instance=self.p))
+        self.assertNotEqual(
+            iksignals.prepare_spec.coalescing_key(TestImage, instance=self.p, spec_name='thumbnail'),
+            iksignals.prepare_spec.coalescing_key(TestImage, instance=self.p, spec_name='cropped'))
+        self.assertTrue(iksignals.refresh_metadata.coalescing_key(TestImage, instance=TestImage()) is None)
+        
+        # the key can be recovered from a job's serialized form, to release it if the job fails
+        from signalqueue.mappings import ModelIDMapper
+        queued = { 'signal': { iksignals.prepare_spec.regkey: iksignals.prepare_spec.name },
+            'instance': ModelIDMapper.demap(self.p),
+            'spec_name': iksignals.prepare_spec.mapping.demap('thumbnail') }
+        key = iksignals.prepare_spec.coalescing_key(TestImage, instance=self.p, spec_name='thumbnail')
+        self.assertEqual(iksignals.prepare_spec.queued_key(queued), key)
+        iksignals.prepare_spec.cache.set(key, (0, None), 60)
+        iksignals.release(queued)
+        self.assertTrue(iksignals.prepare_spec.cache.get(key) is None)
+    
+    def test_signal_debounce(self):
+        import time
+        from imagekit import signals as iksignals
+        sent = []
+        def count(**kwargs):
+            sent.append(kwargs.get('instance').pk)
+        iksignals.refresh_hash.connect(count, sender=TestImage, dispatch_uid='test-signal-debounce')
+        
+        key = iksignals.refresh_hash.coalescing_key(TestImage, instance=self.p)
+        try:
+            with self.settings(IK_SIGNAL_DEBOUNCE=60):
+                # no duplicate absorbed since the job was queued: it runs straight away
+                iksignals.refresh_hash.cache.set(key, (time.time() - 120, None), 60)
+                iksignals.refresh_hash.send_now(TestImage, instance=self.p,
+                    dequeue_runmode=1, enqueue_runmode=2)
+                self.assertEqual(sent, [self.p.pk])
+                self.assertTrue(iksignals.refresh_hash.cache.get(key) is None)
+                
+                # ... as does a job that has been requeued as often as it may be
+                iksignals.refresh_hash.cache.set(key, (time.time(), time.time()), 60)
+                with self.settings(IK_SIGNAL_DEBOUNCE_REQUEUES=2):
+                    iksignals.refresh_hash.send_now(TestImage, instance=self.p,
+                        dequeue_runmode=1, enqueue_runmode=2, requeues=2)
+                self.assertEqual(sent, [self.p.pk, self.p.pk])
+        finally:
+            iksignals.refresh_hash.disconnect(dispatch_uid='test-signal-debounce', sender=TestImage)
+            iksignals.refresh_hash.cache.delete(key)
+    
+    def test_signal_lanes(self):
+        from imagekit import signals as iksignals
+        self.assertEqual(iksignals.prepare_spec.lane_for(TestImage), 'fast')
+        self.assertEqual(iksignals.refresh_metadata.lane_for(TestImage), 'bulk')
+        with self.settings(IK_SIGNAL_LANES={ 'fast': 'default' }):
+            stats = iksignals.lane_stats()
+            self.assertEqual(sorted(stats.keys()), sorted(iksignals.LANES))
+            self.assertEqual(stats['fast']['queue'], 'default')
+            self.assertTrue(stats['bulk']['depth'] >= 0)
+    
+    def test_derivative_view(self):
+        from django.test.client import RequestFactory
+        from imagekit.views import derivative
+        factory = RequestFactory()
+        args = ('imagekit', 'testimage', self.p.pk, 'to_width')
+        
+        response = derivative(factory.get('/'), *args)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        body = ''.join(response)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        
+        etag = response['ETag']
+        response = derivative(factory.get('/', HTTP_IF_NONE_MATCH=etag), *args)
+        self.assertEqual(response.status_code, 304)
+        
+        response = derivative(factory.get('/', HTTP_RANGE='bytes=10-19'), *args)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(''.join(response), body[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/%s' % len(body))
+        
+        response = derivative(factory.get('/', HTTP_RANGE='bytes=%s-' % len(body)), *args)
+        self.assertEqual(response.status_code, 416)
+        
+        # an invalid range is ignored, and the whole file served
+        response = derivative(factory.get('/', HTTP_RANGE='bytes=5-3'), *args)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), body)
+        
+        # the older image_property URL serves specs the same way, rather than as PNGs
+        from imagekit.views import image_property
+        response = image_property(factory.get('/'), *args)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(''.join(response), body)
+    
+    def test_histogram_index_distances(self):
+        import numpy
+        from imagekit.histindex import rebin, distances, METRICS
+        a = numpy.concatenate([rebin([1] * 256, 32), rebin(range(256), 32)])
+        b = numpy.concatenate([rebin(range(256), 32), rebin(range(256), 32)])
+        rows = numpy.array([a, b])
+        
+        for metric in METRICS:
+            dist = distances(rows, b, metric, 2, 32)
+            self.assertAlmostEqual(dist[1], 0.0, places=5)
+            self.assertTrue(dist[0] > 0.0)
+    
+    def test_histogram_index_snapshot(self):
+        import numpy, shutil, tempfile
+        from imagekit.histindex import HistogramIndex
+        path = tempfile.mkdtemp()
+        try:
+            index = HistogramIndex(TestImage, bins=32, path=path)
+            rows = numpy.zeros((2, index.dimensions), dtype=numpy.float32)
+            rows[0, 0] = rows[1, 1] = 1.0
+            index._snapshot(numpy.array([1, 2], dtype=numpy.int64), rows)
+            index.save()
+            
+            # another process' copy maps the saved generation read-only
+            other = HistogramIndex(TestImage, bins=32, path=path)
+            self.assertTrue(other.load())
+            self.assertFalse(other.rows.flags.writeable)
+            self.assertEqual(len(other), 2)
+            
+            # updates go to the overlay, masking the snapshot row they replace
+            other._put(1, rows[1])
+            other._put(3, rows[0])
+            other.remove(2)
+            self.assertEqual(len(other), 2)
+            self.assertTrue(2 not in other)
+            self.assertEqual([pk for pk, distance in other.search(rows[0], k=5)], [3, 1])
+            
+            # a newer generation is picked up, with the overlay kept on top
+            index._put(4, rows[0])
+            index.save()
+            self.assertTrue(other.refresh(interval=0))
+            self.assertEqual(other.generation, index.generation)
+            self.assertEqual(sorted([pk for pk, distance in other.search(rows[0], k=5)]), [1, 3, 4])
+            self.assertFalse(other.refresh(interval=0))
+        finally:
+            shutil.rmtree(path)
+    
+    def test_hash_modes(self):
+        import hashlib
+        from imagekit.utils import hash_file, hash_pixels
+        img = self.p.pilimage
+        
+        # strips hash the same as the whole buffer
+        self.assertEqual(hash_pixels(img, strip_size=1000), hashlib.sha1(img.tostring()).hexdigest())
+        
+        self.assertEqual(hash_file(_storage, self.p.image.name),
+            hashlib.sha1(_storage.open(self.p.image.name).read()).hexdigest())
+    
+    def test_perceptual_hash(self):
+        from imagekit.perceptual import image_hash, hamming, HashIndex, PERCEPTUAL_MODES
+        img = self.p.pilimage.convert('RGB')
+        smaller = img.resize((img.size[0] / 2, img.size[1] / 2), Image.ANTIALIAS)
+        
+        for mode in PERCEPTUAL_MODES:
+            hsh = image_hash(img.copy(), mode)
+            self.assertEqual(len(hsh), 16)
+            self.assertTrue(hamming(hsh, image_hash(smaller.copy(), mode)) <= 6)
+        
+        index = HashIndex(TestImage, 'pk')
+        index.add(1, 'ffffffffffffffff')
+        index.add(2, 'fffffffffffffff0')
+        index.add(3, '0000000000000000')
+        self.assertEqual(index.search('ffffffffffffffff', 6), [(1, 0), (2, 4)])
+        index.remove(2)
+        self.assertEqual(index.search('ffffffffffffffff', 6), [(1, 0)])
+    
+    def test_near_duplicates(self):
+        from imagekit import perceptual
+        pm = TestImageM()
+        img = self.generate_image()
+        pm.save_image('ndtest.jpg', ContentFile(img.read()))
+        img.close()
+        pm.save()
+        pm = TestImageM.objects.get(pk=pm.pk)
+        self.assertTrue(pm.perceptualhash)
+        
+        # near_duplicates() finds the model's perceptual field by itself
+        index = perceptual.get_index(TestImageM, 'perceptualhash')
+        self.assertEqual(TestImageM.objects.near_duplicates(pm), [])
+        self.assertEqual(index.search(pm.perceptualhash, 0), [(pm.pk, 0)])
+        
+        # deleted images are dropped from the index straight away...
+        pk = pm.pk
+        pm.delete(clear_cache=True)
+        self.assertEqual(index.search(pm.perceptualhash, 0), [])
+        
+        # ... and an index past its TTL is rebuilt
+        index.add(pk, '0000000000000000')
+        index.built -= 3600
+        with self.settings(IK_PERCEPTUAL_INDEX_TTL=60):
+            perceptual.get_index(TestImageM, 'perceptualhash')
+        self.assertEqual(len(index), 0)
+    
+    def test_packed_histogram(self):
+        from imagekit.modelfields import pack_histogram, unpack_histogram
+        bins = [i * 1000 for i in xrange(256)]
+        packed = pack_histogram(bins)
+        self.assertEqual(len(packed), 1368) # base64 of 256 * 4 bytes
+        self.assertEqual(list(unpack_histogram(packed)), bins)
+    
+    def test_pack_histograms(self):
+        from imagekit.management.commands.ikpackhistograms import pack_histograms
+        from imagekit.modelfields import unpack_histogram
+        bins = [i * 3 for i in xrange(256)]
+        histogram = TestPackedHistogram()
+        for i, count in enumerate(bins):
+            setattr(histogram, "_L_%02X" % i, count)
+        histogram.save()
+        TestPackedHistogram.objects.filter(pk=histogram.pk).update(_L_packed='')
+        
+        pack_histograms(['imagekit'], {})
+        packed = TestPackedHistogram.objects.get(pk=histogram.pk)._L_packed
+        self.assertEqual(list(unpack_histogram(packed)), bins)
+        
+        # rows that are already packed are skipped, unless forced
+        TestPackedHistogram.objects.filter(pk=histogram.pk).update(_L_00=999)
+        pack_histograms(['imagekit'], { 'chunk_size': 1 })
+        self.assertEqual(TestPackedHistogram.objects.get(pk=histogram.pk)._L_packed, packed)
+        pack_histograms(['imagekit'], { 'force': True })
+        self.assertEqual(unpack_histogram(TestPackedHistogram.objects.get(pk=histogram.pk)._L_packed)[0], 999)
+    
+    def test_spec_plan(self):
+        class AlsoResizeToHeight(processors.Resize):
+            height = 100
+        class TestAlsoCropped(ImageSpec):
+            access_as = 'alsocropped'
+            processors = [AlsoResizeToHeight, SmartCropped]
+        
+        # steps are shared by processor settings, not by class
+        plan = SpecPlan([TestResizeToHeight, TestSmartCropped, TestNeuQuantizer, TestAlsoCropped])
+        self.assertEqual(plan.naive_invocations, 8)
+        self.assertEqual(plan.invocations, 3)
+        self.assertEqual(plan.saved, 5)
+        self.assertEqual(len(plan.root.children), 1)
+        self.assertTrue('alsocropped' in plan.describe())
+        
+        results = plan.execute(self.p.pilimage.copy(), 'JPEG', self.p)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(results[TestSmartCropped][0] is results[TestAlsoCropped][0])
+        self.assertEqual(results[TestResizeToHeight][0].size[1], 100)
+    
     def tearDown(self):
         # make sure image file is deleted
         pth = self.p.image.name
@@ -9,6 +9,12 @@ app_patterns = patterns('',
     
     url(r'^image-property/(?P<app_label>[\w\_]+)/(?P<modlcls>[\w]+)/(?P<pk>[\w\-]+)/(?P<prop_name>[\w\-\_]+)/$',
         'imagekit.views.image_property', name="image_property"),
+    
+    url(r'^derivative/(?P<app_label>[\w\_]+)/(?P<modlcls>[\w]+)/(?P<pk>[\w\-]+)/(?P<spec_name>[\w\-\_]+)/$',
+        'imagekit.views.derivative', name="derivative"),
+    
+    url(r'^spec-plan/(?P<app_label>[\w\_]+)/(?P<modlcls>[\w]+)/$',
+        'imagekit.views.spec_plan', name="spec_plan"),
 
 )
 
@@ -64,6 +64,106 @@ def img_to_fobj(img, format, **kwargs):
     tmp.seek(0)
     return tmp
 
+def open_source(storage, name, spool_size=None):
+    """
+    Open the named file in storage for reading by PIL, without buffering
+    the whole thing in a string first.
+    
+    Files backed by a real OS-level file (e.g. from FileSystemStorage) are
+    returned as-is, and PIL streams from them. Anything else is copied,
+    chunk by chunk, into a SpooledTemporaryFile that stays in memory up to
+    'spool_size' bytes (settings.IK_SOURCE_SPOOL_SIZE, 10MB by default)
+    and rolls over to disk beyond that.
+    
+    """
+    fp = storage.open(name)
+    if isinstance(getattr(fp, 'file', fp), file):
+        fp.seek(0)
+        return fp
+    
+    if spool_size is None:
+        spool_size = getattr(settings, 'IK_SOURCE_SPOOL_SIZE', 10 * 2 ** 20)
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    if hasattr(fp, 'chunks'):
+        fp.seek(0)
+        for chunk in fp.chunks():
+            spool.write(chunk)
+    else:
+        fp.seek(0)
+        chunk = fp.read(64 * 2 ** 10)
+        while chunk:
+            spool.write(chunk)
+            chunk = fp.read(64 * 2 ** 10)
+    fp.close()
+    spool.seek(0)
+    return spool
+
+def hash_file(storage, name, algorithm='sha1', chunk_size=64 * 2 ** 10):
+    """
+    Hex digest of a stored file's bytes, streamed through hashlib a chunk at a time --
+    nothing is decoded, and only one chunk is in memory at once.
+    
+    """
+    digest = getattr(hashlib, algorithm)()
+    fp = storage.open(name)
+    try:
+        fp.seek(0)
+        if hasattr(fp, 'chunks'):
+            for chunk in fp.chunks(chunk_size):
+                digest.update(chunk)
+        else:
+            chunk = fp.read(chunk_size)
+            while chunk:
+                digest.update(chunk)
+                chunk = fp.read(chunk_size)
+    finally:
+        fp.close()
+    return digest.hexdigest()
+
+def hash_pixels(im, algorithm='sha1', strip_size=None):
+    """
+    Hex digest of a PIL image's pixel data, fed to hashlib in horizontal strips of
+    about 'strip_size' bytes (settings.IK_PIXEL_HASH_STRIP_SIZE, 1MB by default).
+    The strips concatenate to im.tostring(), so the digest is the same as hashing
+    that -- but without building a second, full-size copy of the decoded image.
+    
+    """
+    if strip_size is None:
+        strip_size = getattr(settings, 'IK_PIXEL_HASH_STRIP_SIZE', 2 ** 20)
+    width, height = im.size
+    digest = getattr(hashlib, algorithm)()
+    if not width or not height:
+        digest.update(im.tostring())
+        return digest.hexdigest()
+    
+    row_size = max(len(im.crop((0, 0, width, 1)).tostring()), 1)
+    rows = max(strip_size // row_size, 1)
+    for top in xrange(0, height, rows):
+        digest.update(im.crop((0, top, width, min(top + rows, height))).tostring())
+    return digest.hexdigest()
+
+def chunked(objs, chunk_size=500):
+    """
+    Iterate over a queryset in pk order, chunk_size rows per query, without
+    filling the queryset's result cache -- memory use stays flat no matter
+    how large the table is. Each chunk picks up after the last pk seen
+    (rather than using OFFSET) so later chunks are no slower than early ones.
+    
+    """
+    objs = objs.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = objs
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        count = 0
+        for obj in chunk[:chunk_size].iterator():
+            count += 1
+            last_pk = obj.pk
+            yield obj
+        if count < chunk_size:
+            break
+
 def entropy(im):
     """
     Calculate the entropy of an images' histogram. Used for "smart cropping" in easy-thumbnails;
@@ -82,6 +182,30 @@ def entropy(im):
     
     return -sum([p * math.log(p, 2) for p in hist if p != 0])
 
+def histogram_channels(im, luma=None):
+    """
+    Compute 256-bin histograms for every band of a PIL image with a single
+    histogram() call, returning a dict keyed by band name ('R', 'G', 'B', etc).
+    Luma ('L') is always included -- if the image isn't already in an L mode,
+    it's taken from 'luma' (an 'L' conversion of the image you already have)
+    or else converted once to get it.
+    
+    """
+    bands = im.getbands()
+    hist = im.histogram()
+    out = {}
+    
+    if len(hist) == 256 * len(bands):
+        for i, band in enumerate(bands):
+            out[band] = hist[i*256:(i+1)*256]
+    
+    if 'L' not in out:
+        if luma is None:
+            luma = im.convert('L')
+        out['L'] = luma.histogram()[:256]
+    
+    return out
+
 class ADict(dict):
     """
     ADict -- Convenience class for dictionary key access via attributes.
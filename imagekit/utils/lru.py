@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+lru.py
+
+A small, thread-safe least-recently-used mapping for bounded in-process caches.
+
+"""
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from imagekit.utils.ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Mapping that holds at most 'maxsize' entries, evicting the least
+    recently used one when a new entry would exceed that limit.
+    
+    Entries can also be given a weight (in whatever units the caller
+    likes -- bytes, say) when they're set; with 'maxweight', entries are
+    evicted until the total weight is within it, too. The most recent
+    entry is always kept. Hits, misses and evictions are counted.
+    
+    """
+    def __init__(self, maxsize=1024, maxweight=None):
+        self.maxsize = int(maxsize)
+        self.maxweight = maxweight
+        self._data = OrderedDict()
+        self._weights = {}
+        self._lock = threading.RLock()
+        self.weight = 0
+        self.hits = self.misses = self.evictions = 0
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+    
+    def set(self, key, value, weight=1):
+        with self._lock:
+            self.delete(key)
+            self._data[key] = value
+            self._weights[key] = weight
+            self.weight += weight
+            while len(self._data) > 1 and (len(self._data) > self.maxsize or
+                (self.maxweight is not None and self.weight > self.maxweight)):
+                oldest, oldvalue = self._data.popitem(last=False)
+                self.weight -= self._weights.pop(oldest, 0)
+                self.evictions += 1
+    
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self.weight -= self._weights.pop(key, 0)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.weight = 0
+    
+    def stats(self):
+        """ Counters and sizes, as a dict. """
+        with self._lock:
+            return {
+                'size':         len(self._data),
+                'maxsize':      self.maxsize,
+                'weight':       self.weight,
+                'maxweight':    self.maxweight,
+                'hits':         self.hits,
+                'misses':       self.misses,
+                'evictions':    self.evictions,
+            }
+    
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __len__(self):
+        return len(self._data)
@@ -1,7 +1,14 @@
 
-from django.http import HttpResponse, HttpResponseNotFound
+import calendar, hashlib, mimetypes, re
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified
 from django.db.models.loading import cache
+from django.utils.http import http_date
+from django.views.static import was_modified_since
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_http_methods
+from django.contrib.admin.views.decorators import staff_member_required
+from imagekit import specs
 
 @never_cache
 def image(request, app_label, modlcls, pk):
@@ -26,6 +33,11 @@ def image_property(request, app_label, modlcls, pk, prop_name):
     if modl is None:
         return HttpResponseNotFound()
     
+    # ImageSpecs are served as their cached files are saved, not re-encoded as PNG
+    spec = hasattr(modl, '_ik') and modl._ik.specs.get(prop_name, None) or None
+    if spec is not None and issubclass(spec, specs.ImageSpec):
+        return derivative(request, app_label, modlcls, pk, prop_name)
+    
     try:
         instance = modl.objects.get(pk=pk)
     except modl.DoesNotExist:
@@ -38,4 +50,153 @@ def image_property(request, app_label, modlcls, pk, prop_name):
     
     return HttpResponseNotFound()
 
-    
\ No newline at end of file
+
+@staff_member_required
+def spec_plan(request, app_label, modlcls):
+    """ Debug view: the processor plan ImageKit compiles for a model's specs. """
+    modl = cache.get_model(app_label, modlcls)
+    
+    if modl is None or not hasattr(modl, '_ik'):
+        return HttpResponseNotFound()
+    
+    return HttpResponse(modl._ik.spec_plan().describe(), mimetype="text/plain")
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def stream(fp, start=0, length=None, chunk_size=64 * 1024):
+    """ Yield a file's contents from 'start', for 'length' bytes (or to the end), closing it after. """
+    try:
+        if start:
+            fp.seek(start)
+        while length is None or length > 0:
+            data = fp.read(length is None and chunk_size or min(chunk_size, length))
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+def derivative_etag(accessor, mtime):
+    """
+    A strong ETag for a spec's output: its content key, if the model uses
+    content keying -- otherwise a hash of its name, the spec fingerprint
+    and the cached file's modification time.
+    
+    """
+    key = accessor.key
+    if not key:
+        key = hashlib.sha1("\n".join([
+            str(accessor.name),
+            accessor.spec.fingerprint(),
+            accessor.spec.instance_fingerprint(accessor._obj),
+            str(mtime),
+        ])).hexdigest()
+    return '"%s"' % key
+
+@require_http_methods(["GET", "HEAD"])
+def derivative(request, app_label, modlcls, pk, spec_name):
+    """
+    Serve the cached file for one of an instance's ImageSpecs, as it was saved --
+    in the spec's own format and quality -- rendering it first if need be.
+    
+    Responses carry a strong ETag and Last-Modified, and conditional requests
+    are answered with 304 Not Modified from the spec cache and the storage's
+    file metadata alone, without opening the image. Single byte-range requests
+    are answered with 206 Partial Content. Cache-Control max-age comes from
+    IK_DERIVATIVE_MAX_AGE (a day, by default).
+    
+    """
+    modl = cache.get_model(app_label, modlcls)
+    
+    if modl is None or not hasattr(modl, '_ik'):
+        return HttpResponseNotFound()
+    
+    spec = modl._ik.specs.get(spec_name, None)
+    if spec is None or not issubclass(spec, specs.ImageSpec) or spec_name in ('imagespec', 'spec'):
+        return HttpResponseNotFound()
+    
+    try:
+        instance = modl.objects.get(pk=pk)
+    except (modl.DoesNotExist, ValueError):
+        return HttpResponseNotFound()
+    
+    accessor = getattr(instance, spec_name)
+    accessor._create()
+    if not accessor._exists():
+        return HttpResponseNotFound()
+    
+    storage = instance._storage
+    meta = accessor._meta() or {}
+    if meta.get('size') is None or meta.get('mtime') is None:
+        try:
+            meta['mtime'] = calendar.timegm(storage.modified_time(accessor.name).utctimetuple())
+        except NotImplementedError:
+            meta['mtime'] = None
+        meta['size'] = storage.size(accessor.name)
+        if accessor._cache is not None:
+            accessor._cache.set(accessor.name, meta)
+    
+    mtime, size = meta['mtime'], meta['size']
+    etag = derivative_etag(accessor, mtime)
+    
+    # If-None-Match trumps If-Modified-Since
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match is not None:
+        if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return not_modified(etag, mtime)
+    elif mtime is not None and not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime, size):
+        return not_modified(etag, mtime)
+    
+    content_type = mimetypes.guess_type(accessor.name)[0] or 'application/octet-stream'
+    start, length, status = 0, size, 200
+    
+    range_header = request.META.get('HTTP_RANGE', None)
+    if_range = request.META.get('HTTP_IF_RANGE', None)
+    if range_header and (if_range is None or if_range.strip() == etag):
+        match = RANGE_RE.match(range_header.strip())
+        # multiple ranges aren't supported, and a range ending before it starts is
+        # invalid (RFC 7233, 2.1) -- either way, the header is ignored
+        if match and any(match.groups()) and not (all(match.groups()) and int(match.group(2)) < int(match.group(1))):
+            first, last = match.groups()
+            end = size - 1
+            if not first:
+                # a suffix: the last N bytes
+                start = max(size - int(last), 0)
+                if not int(last):
+                    start = size
+            else:
+                start = int(first)
+                if last:
+                    end = min(int(last), size - 1)
+            
+            if start >= size or end < start:
+                out = HttpResponse(status=416, content_type=content_type)
+                out['Content-Range'] = 'bytes */%s' % size
+                return out
+            
+            length, status = end - start + 1, 206
+    
+    if request.method == 'HEAD':
+        out = HttpResponse('', status=status, content_type=content_type)
+    else:
+        out = HttpResponse(stream(storage.open(accessor.name), start, length), status=status, content_type=content_type)
+    
+    if status == 206:
+        out['Content-Range'] = 'bytes %s-%s/%s' % (start, start + length - 1, size)
+    out['Content-Length'] = str(length)
+    out['Accept-Ranges'] = 'bytes'
+    set_validators(out, etag, mtime)
+    return out
+
+def set_validators(response, etag, mtime):
+    response['ETag'] = etag
+    if mtime is not None:
+        response['Last-Modified'] = http_date(mtime)
+    response['Cache-Control'] = 'public, max-age=%s' % int(getattr(settings, 'IK_DERIVATIVE_MAX_AGE', 86400))
+    return response
+
+def not_modified(etag, mtime):
+    return set_validators(HttpResponseNotModified(), etag, mtime)